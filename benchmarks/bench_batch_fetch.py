@@ -0,0 +1,48 @@
+"""
+N single-ticker price requests against one batched multi-ticker request
+
+    python -m benchmarks.bench_batch_fetch --tickers 20 --latency 0.2
+    python -m benchmarks.bench_batch_fetch --source yfinance --tickers 10
+"""
+import argparse
+import time
+
+from src.graph import price_source
+from src.graph.price_source import get_price_source
+
+
+def bench(source: str, tickers: list, period: str):
+    download = get_price_source(source)
+
+    start = time.perf_counter()
+    for ticker in tickers:
+        download([ticker], period=period)
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    download(tickers, period=period)
+    batched = time.perf_counter() - start
+    return single, batched
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', default='offline')
+    parser.add_argument('--tickers', type=int, default=20)
+    parser.add_argument('--period', default='2y')
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='simulated round-trip of the offline source in seconds')
+    args = parser.parse_args()
+
+    price_source.OFFLINE_LATENCY = args.latency
+    universe = ['AAPL', 'MSFT', 'GOOG', 'AMZN', 'META', 'NVDA', 'TSLA', 'JPM', 'V', 'JNJ',
+                'WMT', 'PG', 'XOM', 'MA', 'HD', 'CVX', 'KO', 'PEP', 'ABBV', 'MRK']
+    if args.source == 'offline':
+        tickers = [f'T{i:03d}' for i in range(args.tickers)]
+    else:
+        tickers = universe[:args.tickers]
+    single, batched = bench(args.source, tickers, args.period)
+    print(f'source={args.source} tickers={len(tickers)} period={args.period}')
+    print(f'{len(tickers)} single calls: {single:.3f}s')
+    print(f'1 batched call:  {batched:.3f}s')
+    print(f'speedup: {single / batched:.1f}x')
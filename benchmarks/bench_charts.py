@@ -0,0 +1,56 @@
+"""
+chart rendering of many long series: a new pyplot figure per ticker with every point, against the
+reused Agg figure with LTTB downsampling, inline and in the process pool
+
+    python -m benchmarks.bench_charts --tickers 24 --years 10
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+
+def render_pyplot(series: dict, out_dir: Path) -> float:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    start = time.perf_counter()
+    for ticker, s in series.items():
+        fig, ax = plt.subplots()
+        s.plot(ax=ax)
+        plt.savefig(out_dir / f'{ticker}_pyplot.png')
+        plt.close(fig)
+    return time.perf_counter() - start
+
+
+def render_pipeline(series: dict, out_dir: Path, pool: str) -> float:
+    from src.graph import charts
+    charts.CHART_POOL = pool
+    start = time.perf_counter()
+    for ticker, s in series.items():
+        charts.submit_chart('bench', [ticker], 'chart', out_dir / f'{ticker}_{pool}.png',
+                            [charts.chart_line(ticker, s)], title=ticker)
+    charts.collect_charts('bench')
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tickers', type=int, default=24)
+    parser.add_argument('--years', type=int, default=10)
+    args = parser.parse_args()
+
+    import pandas as pd
+    from src.graph.price_source import offline_series
+    series = {}
+    for i in range(args.tickers):
+        s = offline_series(f'T{i}')
+        series[f'T{i}'] = s.loc[s.index[-1] - pd.DateOffset(years=args.years):]
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        out_dir = Path(out_dir)
+        print(f'{args.tickers} tickers, {len(next(iter(series.values())))} points each')
+        print(f'pyplot per figure       {render_pyplot(series, out_dir):8.2f}s')
+        print(f'reused figure, inline   {render_pipeline(series, out_dir, "inline"):8.2f}s')
+        # the first use of the process pool also pays for starting its workers
+        print(f'reused figure, process  {render_pipeline(series, out_dir, "process"):8.2f}s')
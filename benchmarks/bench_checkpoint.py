@@ -0,0 +1,52 @@
+"""
+checkpoint cost per step against plan length, full state.json rewrite against the append-only journal
+
+    python -m benchmarks.bench_checkpoint --steps 10 100 1000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+
+def simulate(backend: str, n_steps: int, run_id: str) -> float:
+    from src.graph import checkpoint
+    checkpoint.CHECKPOINT_BACKEND = backend
+    reducers = checkpoint.state_reducers()
+    agent_state = {'run_id': run_id, 'query': 'bench', 'mode': 'test',
+                   'plans': [{'action': 'plan_calculate_return', 'params': {'ticker': f'T{i}', 'period': '1y'}}
+                             for i in range(n_steps)],
+                   'call_stack': [], 'execution_status': [], 'data': {}, 'execution_result': {}}
+    checkpoint.save_state(agent_state)
+
+    elapsed = 0.0
+    for i in range(n_steps):
+        ticker = f'T{i}'
+        update = {'execution_result': {ticker: {'return_1y': 0.1234567, 'vol_1y': 0.2345678,
+                                                'chart': {'status': 'ok', 'path': f'/data/{run_id}/{ticker}.png'}}},
+                  'execution_status': [f'1y return calculation of {ticker} status: success'],
+                  'call_stack': ['executor'],
+                  'nsteps': i + 1,
+                  'next_plan_index': i + 1}
+        start = time.perf_counter()
+        checkpoint.record_update(agent_state, 'executor', update)
+        checkpoint.apply_update(agent_state, update, reducers)
+        checkpoint.save_state(agent_state)
+        elapsed += time.perf_counter() - start
+    if backend == 'journal':
+        checkpoint.get_journal(run_id).close()
+    return elapsed / n_steps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, nargs='+', default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ['AGENTFLOW_DATA_DIR'] = data_dir
+        print(f'{"steps":>6} {"json ms/step":>12} {"journal ms/step":>16}')
+        for n_steps in args.steps:
+            json_cost = simulate('json', n_steps, f'bench_json_{n_steps}')
+            journal_cost = simulate('journal', n_steps, f'bench_journal_{n_steps}')
+            print(f'{n_steps:>6} {json_cost * 1000:>12.3f} {journal_cost * 1000:>16.3f}')
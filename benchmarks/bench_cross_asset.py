@@ -0,0 +1,51 @@
+"""
+correlation matrix of many tickers: a python loop over the pairs (pandas Series.corr on each pair)
+against the pairwise-complete matrix products of src/graph/panel.py, on the same aligned panel
+
+    python -m benchmarks.bench_cross_asset --tickers 50 200 500
+"""
+import argparse
+import time
+
+import numpy as np
+
+
+def corr_per_pair(returns) -> np.ndarray:
+    columns = list(returns.columns)
+    corr = np.eye(len(columns))
+    for i in range(len(columns)):
+        for j in range(i + 1, len(columns)):
+            corr[i, j] = corr[j, i] = returns[columns[i]].corr(returns[columns[j]])
+    return corr
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tickers', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--missing', type=float, default=0.05, help='share of closes removed at random')
+    parser.add_argument('--max-loop-tickers', type=int, default=200, help='skip the pair loop above this')
+    args = parser.parse_args()
+
+    import pandas as pd
+    from src.graph.panel import daily_returns, pairwise_cov
+    from src.graph.price_source import offline_series
+
+    rng = np.random.default_rng(0)
+    print(f'{"tickers":>7} {"pairs":>7} {"pair loop s":>11} {"panel s":>8} {"max diff":>9}')
+    for n in args.tickers:
+        frame = pd.concat({f'T{i}': offline_series(f'T{i}') for i in range(n)}, axis=1)
+        frame = frame.loc[frame.index[-1] - pd.DateOffset(years=args.years):]
+        prices = frame.to_numpy(dtype=np.float64)
+        prices[rng.random(prices.shape) < args.missing] = np.nan
+        start = time.perf_counter()
+        _, corr, _ = pairwise_cov(daily_returns(prices))
+        panel_s = time.perf_counter() - start
+        if n <= args.max_loop_tickers:
+            returns = pd.DataFrame(prices, columns=frame.columns).pct_change(fill_method=None).iloc[1:]
+            start = time.perf_counter()
+            expected = corr_per_pair(returns)
+            loop_s = time.perf_counter() - start
+            print(f'{n:>7} {n * (n - 1) // 2:>7} {loop_s:>11.3f} {panel_s:>8.4f} {np.nanmax(np.abs(corr - expected)):>9.1e}')
+        else:
+            print(f'{n:>7} {n * (n - 1) // 2:>7} {"-":>11} {panel_s:>8.4f} {"-":>9}')
@@ -0,0 +1,182 @@
+"""
+end-to-end runs of build_graph() without network: synthetic prices (price_source='offline') and the scripted llm
+(mode='scripted') with a simulated latency and failure rates. per scenario the end-to-end latency, throughput,
+per node latency and the peak traced memory of a run; --baseline fails when a scenario got slower than a saved report
+
+    python -m benchmarks.bench_e2e --runs 5 --llm-latency 0.2 --output e2e.json
+    python -m benchmarks.bench_e2e --scenarios tickers_10 retries resume --baseline e2e.json --tolerance 0.25
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+TICKERS_10 = ['AAPL', 'MSFT', 'NVDA', 'AMZN', 'GOOG', 'META', 'TSLA', 'JPM', 'XOM', 'KO']
+# synthetic names, the offline price source makes up a series for any ticker
+TICKERS_100 = [''.join(letters) for letters in itertools.product('QWZ', string.ascii_uppercase, 'XY')][:100]
+
+# name -> query, initial state, scripted llm failure rates, tool that crashes once before the run is resumed
+SCENARIOS = {
+    'tickers_1': {'query': 'how did AAPL perform and how risky was it over the past 1 year, plot the price chart'},
+    'tickers_10': {'query': f'compare the performance and risk of {", ".join(TICKERS_10)} for 1y and 3m, '
+                            f'plot the price charts'},
+    # one executor step per plan step: the router and checkpoint cost of a long plan
+    'tickers_100': {'query': f'compare the 1y return and risk of {", ".join(TICKERS_100)}',
+                    'state': {'max_steps': 2 * len(TICKERS_100) + 20}},
+    'tickers_100_batched': {'query': f'compare the 1y return and risk of {", ".join(TICKERS_100)}',
+                            'state': {'batch_fetch': True}},
+    'retries': {'query': f'compare the performance and risk of {", ".join(TICKERS_10)} for the past 1 year',
+                'plan_failure': 1.0, 'answer_failure': 1.0},
+    'resume': {'query': f'compare the performance and risk of {", ".join(TICKERS_10)} for the past 1 year',
+               'crash': 'calculate_metrics_runtime'},
+}
+
+
+class InjectedCrash(Exception):
+    pass
+
+
+@contextmanager
+def crash_once(tool_name: str):
+    """
+    the next call of the tool raises, as if the process died in the middle of the plan
+    """
+    from src.graph.tools import TOOLS_REGISTRY
+    tool = TOOLS_REGISTRY[tool_name]
+
+    def crash(**kwargs):
+        TOOLS_REGISTRY[tool_name] = tool
+        raise InjectedCrash(f'{tool_name} crashed')
+
+    TOOLS_REGISTRY[tool_name] = crash
+    try:
+        yield
+    finally:
+        TOOLS_REGISTRY[tool_name] = tool
+
+
+def run_once(graph_app, scenario: dict, run_id: str) -> dict:
+    from src.graph import scripted_llm
+    from src.graph.resume import resume_run
+    scripted_llm.SCRIPTED_PLAN_FAILURE = scenario.get('plan_failure', 0)
+    scripted_llm.SCRIPTED_ANSWER_FAILURE = scenario.get('answer_failure', 0)
+    state = {'query': scenario['query'], 'mode': 'scripted', 'price_source': 'offline', 'run_id': run_id,
+             **scenario.get('state', {})}
+    start = time.perf_counter()
+    if scenario.get('crash'):
+        with crash_once(scenario['crash']):
+            try:
+                graph_app.invoke(state)
+            except InjectedCrash:
+                pass
+        # the profile of the steps before the crash comes back with the checkpoint
+        result = resume_run(run_id, graph_app)
+    else:
+        result = graph_app.invoke(state)
+    return {'wall_s': time.perf_counter() - start,
+            'ok': bool(result.get('final_answer')),
+            'nsteps': len(result.get('call_stack') or []),
+            'profile': list(result.get('profile') or [])}
+
+
+def run_scenario(graph_app, name: str, runs: int, warmup: int, memory: bool) -> dict:
+    from src.graph.profiling import profile_report
+    from src.graph.util import percentile
+    scenario = SCENARIOS[name]
+    for i in range(warmup):
+        run_once(graph_app, scenario, f'{name}_warmup_{i:03d}')
+    results = []
+    start = time.perf_counter()
+    for i in range(runs):
+        results.append(run_once(graph_app, scenario, f'{name}_{i:03d}'))
+    elapsed = time.perf_counter() - start
+    walls = [r['wall_s'] for r in results]
+    report = profile_report({f'{name}_{i:03d}': r['profile'] for i, r in enumerate(results)})
+    summary = {'runs': runs,
+               'ok': sum(r['ok'] for r in results),
+               'nsteps': results[0]['nsteps'],
+               'e2e_p50_s': percentile(walls, 0.5),
+               'e2e_p95_s': percentile(walls, 0.95),
+               'runs_per_s': runs / elapsed,
+               'llm_calls': sum(v['llm_calls'] for v in report.values()) / runs,
+               'nodes': {key: {'calls': v['calls'], 'p50_s': v['wall_p50_s'], 'p95_s': v['wall_p95_s']}
+                         for key, v in report.items() if key.split(':')[0] in ['node', 'router', 'llm', 'tool']}}
+    if memory:
+        # a separate run, tracemalloc slows the allocations of the timed ones down
+        tracemalloc.start()
+        run_once(graph_app, scenario, f'{name}_memory')
+        summary['mem_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+    return summary
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    scenarios whose p50 end-to-end latency is more than tolerance above the baseline, or with fewer answered runs
+    """
+    regressions = []
+    for name, summary in report.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if summary['e2e_p50_s'] > base['e2e_p50_s'] * (1 + tolerance):
+            regressions.append(f'{name}: p50 {summary["e2e_p50_s"]:.3f}s against {base["e2e_p50_s"]:.3f}s')
+        if summary['ok'] / summary['runs'] < base['ok'] / base['runs']:
+            regressions.append(f'{name}: {summary["ok"]}/{summary["runs"]} runs answered '
+                               f'against {base["ok"]}/{base["runs"]}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs per scenario, they fill the price store')
+    parser.add_argument('--llm-latency', type=float, default=0.0, help='mean simulated llm round-trip, seconds')
+    parser.add_argument('--memory', action='store_true', help='peak traced memory of one more run per scenario')
+    parser.add_argument('--nodes', action='store_true', help='print the per node, llm and tool latency')
+    parser.add_argument('--output', default=None, help='write the report as json, a baseline for later runs')
+    parser.add_argument('--baseline', default=None, help='report of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    # read at import
+    os.environ['AGENTFLOW_SCRIPTED_LATENCY'] = str(args.llm_latency)
+    os.environ['AGENTFLOW_PLAN_TEMPLATES'] = '0'
+    # the per node latencies and llm calls come from the profile records
+    os.environ['AGENTFLOW_PROFILE'] = '1'
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ['AGENTFLOW_DATA_DIR'] = data_dir
+        from src.graph.graph import build_graph
+        graph_app = build_graph().compile()
+        print(f'{"scenario":<20} {"ok":>5} {"steps":>5} {"p50 s":>7} {"p95 s":>7} {"runs/s":>7} {"llm":>4} '
+              f'{"peak MB":>8}')
+        report = {}
+        for name in args.scenarios:
+            s = report[name] = run_scenario(graph_app, name, args.runs, args.warmup, args.memory)
+            peak = f'{s["mem_peak_mb"]:>8.1f}' if 'mem_peak_mb' in s else f'{"-":>8}'
+            print(f'{name:<20} {s["ok"]:>2}/{s["runs"]:<2} {s["nsteps"]:>5} {s["e2e_p50_s"]:>7.3f} '
+                  f'{s["e2e_p95_s"]:>7.3f} {s["runs_per_s"]:>7.2f} {s["llm_calls"]:>4.0f} {peak}')
+    print(f'process max rss: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
+
+    if args.nodes:
+        print(f'\n{"scenario":<20} {"span":<40} {"calls":>5} {"p50 ms":>8} {"p95 ms":>8}')
+        for name, s in report.items():
+            for key, v in s['nodes'].items():
+                print(f'{name:<20} {key:<40} {v["calls"]:>5} {v["p50_s"] * 1000:>8.1f} {v["p95_s"] * 1000:>8.1f}')
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'regression {regression}')
+        sys.exit(1 if regressions else 0)
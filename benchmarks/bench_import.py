@@ -0,0 +1,60 @@
+"""
+cold import time of the graph, checked against a budget, and the heavy modules it must not load
+until they are used
+
+    python -m benchmarks.bench_import --budget-ms 2500
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+MODULE = 'src.graph.graph'
+# loaded on first live llm call, first plot and first yfinance download
+FORBIDDEN = ['google.genai', 'matplotlib', 'matplotlib.pyplot', 'yfinance']
+IMPORTTIME_PATTERN = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def import_time(module: str) -> list:
+    """
+    (module, self us, cumulative us) of a cold import in a fresh interpreter, from -X importtime
+    """
+    env = {**os.environ, 'GEMINI_API_KEY': ''}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, env=env, check=True)
+    return [(m.group(4), int(m.group(1)), int(m.group(2)))
+            for m in map(IMPORTTIME_PATTERN.match, result.stderr.splitlines()) if m]
+
+
+def loaded_modules(module: str, candidates: list) -> list:
+    env = {**os.environ, 'GEMINI_API_KEY': ''}
+    code = f'import sys, {module}; print(" ".join(m for m in {candidates!r} if m in sys.modules))'
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=env, check=True)
+    return result.stdout.split()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget-ms', type=float, default=2500)
+    parser.add_argument('--repeat', type=int, default=3, help='the best of the cold imports is compared')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [import_time(MODULE) for _ in range(args.repeat)]
+    best = min(runs, key=lambda timings: timings[-1][2])
+    total_ms = best[-1][2] / 1000
+    print(f'{"module":<50} {"self ms":>9} {"cumulative ms":>14}')
+    for name, self_us, cumulative_us in sorted(best, key=lambda t: -t[1])[:args.top]:
+        print(f'{name:<50} {self_us / 1000:>9.1f} {cumulative_us / 1000:>14.1f}')
+    print(f'import {MODULE}: {total_ms:.0f} ms, budget {args.budget_ms:.0f} ms')
+
+    failures = []
+    if total_ms > args.budget_ms:
+        failures.append(f'import time {total_ms:.0f} ms is over the budget of {args.budget_ms:.0f} ms')
+    loaded = loaded_modules(MODULE, FORBIDDEN)
+    if loaded:
+        failures.append(f'modules loaded at import: {", ".join(loaded)}')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,89 @@
+"""
+state reducers over long plans: the list concatenation and deepmerge reducers against the in-place
+append_log / merge_shards ones, applied directly and through a LangGraph loop of one node per step
+
+    python -m benchmarks.bench_reducers --steps 10 100 1000
+"""
+import argparse
+import json
+import time
+from typing import TypedDict, Annotated
+
+from deepmerge import always_merger
+from langgraph.graph import StateGraph, END
+
+from src.graph.reducers import append_log, merge_shards, stamp_writes
+
+TICKERS = 50
+REDUCER_KEYS = ['call_stack', 'execution_status', 'profile', 'completed_steps', 'data', 'execution_result']
+
+
+def concat(old, new):
+    return old + new
+
+
+def step_update(i: int) -> dict:
+    """
+    update of one executor step: trace entries, a profile record, a completed step and one ticker's metric
+    """
+    ticker = f'T{i % TICKERS}'
+    return {'call_stack': ['executor'],
+            'execution_status': [f'step {i}: plan_calculate_return done for {ticker}'],
+            'profile': [{'name': 'executor', 'kind': 'node', 'wall_s': 0.001, 'counters': {'bytes_read': 1024}}],
+            'completed_steps': [i],
+            'data': {ticker: f'/tmp/data/{ticker}.parquet'},
+            'execution_result': {ticker: {f'return_{i // TICKERS}y': 0.01 * i, 'chart': {'status': 'ok'}}}}
+
+
+def state_schema(list_reducer, dict_reducer):
+    class BenchState(TypedDict):
+        step: int
+        steps: int
+        call_stack: Annotated[list, list_reducer]
+        execution_status: Annotated[list, list_reducer]
+        profile: Annotated[list, list_reducer]
+        completed_steps: Annotated[list, list_reducer]
+        data: Annotated[dict, dict_reducer]
+        execution_result: Annotated[dict, dict_reducer]
+    return BenchState
+
+
+def run_direct(steps: int, list_reducer, dict_reducer) -> tuple:
+    reducers = {'call_stack': list_reducer, 'execution_status': list_reducer, 'profile': list_reducer,
+                'completed_steps': list_reducer, 'data': dict_reducer, 'execution_result': dict_reducer}
+    state = {key: [] if reducer is list_reducer else {} for key, reducer in reducers.items()}
+    start = time.perf_counter()
+    for i in range(steps):
+        for key, value in step_update(i).items():
+            state[key] = reducers[key](state[key], value)
+    return time.perf_counter() - start, state
+
+
+def run_langgraph(steps: int, list_reducer, dict_reducer) -> tuple:
+    def step(state):
+        # stamped as the status_update decorator does, the in-place reducers apply a write id once
+        return stamp_writes({**step_update(state['step']), 'step': state['step'] + 1}, REDUCER_KEYS)
+
+    graph = StateGraph(state_schema(list_reducer, dict_reducer))
+    graph.add_node('step', step)
+    graph.set_entry_point('step')
+    graph.add_conditional_edges('step', lambda state: END if state['step'] >= state['steps'] else 'step')
+    app = graph.compile()
+    start = time.perf_counter()
+    state = app.invoke({'step': 0, 'steps': steps}, {'recursion_limit': steps + 10})
+    return time.perf_counter() - start, {key: value for key, value in state.items() if key not in ['step', 'steps']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, nargs='+', default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    print(f'{"steps":>6} {"runner":>10} {"concat+deepmerge s":>19} {"append_log+shards s":>20} {"speedup":>8}')
+    for steps in args.steps:
+        for name, runner in [('direct', run_direct), ('langgraph', run_langgraph)]:
+            old_s, old_state = runner(steps, concat, always_merger.merge)
+            new_s, new_state = runner(steps, append_log, merge_shards)
+            # the new reducers must build the same state, as json it is what the checkpoints see
+            assert json.dumps(old_state, sort_keys=True) == json.dumps(new_state, sort_keys=True)
+            print(f'{steps:>6} {name:>10} {old_s:>19.4f} {new_s:>20.4f} {old_s / new_s:>7.1f}x')
@@ -0,0 +1,79 @@
+"""
+load test of the worker service: N queued offline queries drained by 1, 2, 4.. worker processes,
+optionally killing a worker in the middle to check that its job is requeued and resumed
+
+    python -m benchmarks.bench_service --jobs 40 --workers 1 2 4 --llm-latency 0.2 --kill-one
+"""
+import argparse
+import os
+import signal
+import tempfile
+import threading
+import time
+
+
+def kill_one_worker(delay: float):
+    """
+    kill the worker of the first job that has been running for delay seconds
+    """
+    from src.graph.service import jobs_connection
+    while True:
+        row = jobs_connection().execute("select worker, run_id from jobs where state = 'running' and started_at < ? "
+                                        "order by job_id limit 1", (time.time() - delay,)).fetchone()
+        if row is not None:
+            break
+        time.sleep(0.05)
+    pid = int(row['worker'].rsplit('-', 1)[1])
+    print(f'killing worker {row["worker"]} while it runs {row["run_id"]}')
+    os.kill(pid, signal.SIGKILL)
+
+
+def load_test(n_jobs: int, workers: int, kill_after: float = None) -> dict:
+    from src.graph import service
+    from src.graph.util import percentile
+    queries = ['compare the performance and risk of AAPL and MSFT for the past 1 year',
+               'plot NVDA and AMD and compare their 6m return',
+               'what is the 2y volatility of TSLA']
+    for i in range(n_jobs):
+        service.submit(queries[i % len(queries)], mode='test', price_source='offline')
+    if kill_after is not None:
+        threading.Thread(target=kill_one_worker, args=(kill_after,), daemon=True).start()
+    start = time.perf_counter()
+    service.run_service(workers, stop_when_idle=True)
+    elapsed = time.perf_counter() - start
+    rows = service.jobs_connection().execute('select * from jobs').fetchall()
+    latencies = [row['finished_at'] - row['created_at'] for row in rows if row['finished_at']]
+    # from the first claimed job to the last finished one, without the start of the workers
+    drain = max(row['finished_at'] or 0 for row in rows) - min(row['started_at'] for row in rows)
+    return {'workers': workers,
+            'done': sum(row['state'] == 'done' for row in rows),
+            'failed': sum(row['state'] == 'failed' for row in rows),
+            'retried': sum(row['attempts'] > 1 for row in rows),
+            'elapsed_s': elapsed,
+            'drain_s': drain,
+            'jobs_per_s': len(rows) / drain,
+            'latency_p50_s': percentile(latencies, 0.5),
+            'latency_p95_s': percentile(latencies, 0.95)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=40)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--llm-latency', type=float, default=0.2, help='simulated llm round-trip, seconds')
+    parser.add_argument('--kill-one', action='store_true', help='kill a worker 0.3s into its first job')
+    args = parser.parse_args()
+
+    # read by the spawned workers at import
+    os.environ['AGENTFLOW_TEST_LLM_LATENCY'] = str(args.llm_latency)
+    os.environ['AGENTFLOW_JOB_STALE_AFTER'] = '3'
+    os.environ['AGENTFLOW_HEARTBEAT_EVERY'] = '0.5'
+    os.environ['AGENTFLOW_PLAN_TEMPLATES'] = '0'
+    print(f'{"workers":>7} {"done":>5} {"failed":>6} {"retried":>7} {"elapsed s":>9} {"drain s":>8} {"jobs/s":>7} '
+          f'{"p50 s":>6} {"p95 s":>6}')
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as data_dir:
+            os.environ['AGENTFLOW_DATA_DIR'] = data_dir
+            r = load_test(args.jobs, workers, 0.3 if args.kill_one else None)
+            print(f'{r["workers"]:>7} {r["done"]:>5} {r["failed"]:>6} {r["retried"]:>7} {r["elapsed_s"]:>9.2f} '
+                  f'{r["drain_s"]:>8.2f} {r["jobs_per_s"]:>7.2f} {r["latency_p50_s"]:>6.2f} {r["latency_p95_s"]:>6.2f}')
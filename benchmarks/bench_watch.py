@@ -0,0 +1,48 @@
+"""
+cost of bringing a return and a volatility up to date with one new bar: the rolling stats of the watch mode
+against recomputing them from the full series as calculate_return_runtime/calculate_vol_runtime do
+
+    python -m benchmarks.bench_watch --years 1 5 20 --bars 500
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from src.graph.price_source import offline_series
+from src.graph.util import period_delta
+from src.graph.watch import RollingStats
+
+
+def full_recompute(series: pd.Series, period: str) -> tuple:
+    price = series.loc[series.index[-1] - period_delta(period):]
+    return float(price.iloc[-1] / price.iloc[0] - 1), float(price.pct_change().std() * 252 ** 0.5)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--years', type=int, nargs='+', default=[1, 5, 20])
+    parser.add_argument('--bars', type=int, default=500, help='new bars replayed one at a time')
+    args = parser.parse_args()
+
+    history = offline_series('AAPL')
+    print(f'{"period":>7} {"window":>7} {"full us/bar":>12} {"rolling us/bar":>15} {"speedup":>8} {"max vol diff":>13}')
+    for years in args.years:
+        period = f'{years}y'
+        seed, bars = history.iloc[:-args.bars], history.iloc[-args.bars:]
+        stats = RollingStats(period)
+        stats.seed(seed)
+        start = time.perf_counter()
+        for day, price in bars.items():
+            stats.push(day, float(price))
+            rolling = (stats.value('return'), stats.value('vol'))
+        rolling_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(1, args.bars + 1):
+            full = full_recompute(history.iloc[:len(seed) + i], period)
+        full_s = time.perf_counter() - start
+        # both end on the same window
+        assert abs(rolling[0] - full[0]) < 1e-12
+        print(f'{period:>7} {len(stats.window):>7} {full_s / args.bars * 1e6:>12.1f} '
+              f'{rolling_s / args.bars * 1e6:>15.2f} {full_s / rolling_s:>7.0f}x {abs(rolling[1] - full[1]):>13.2e}')
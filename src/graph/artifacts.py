@@ -0,0 +1,187 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+
+from src.graph.logger import get_logger
+from src.graph.profiling import count
+from src.graph.util import load_json, write_json_atomic
+
+logger = get_logger('artifacts')
+
+# parquet or feather (arrow IPC, memory-mapped on read)
+ARTIFACT_FORMAT = os.getenv('AGENTFLOW_ARTIFACT_FORMAT', 'parquet')
+ARTIFACT_SUFFIX = {'parquet': '.parquet', 'feather': '.feather'}
+CACHE_MAX_BYTES = int(os.getenv('AGENTFLOW_ARTIFACT_CACHE_BYTES', 256 * 1024 ** 2))
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_lock = threading.Lock()
+
+
+def artifact_suffix(fmt: str = None) -> str:
+    fmt = fmt or ARTIFACT_FORMAT
+    if fmt not in ARTIFACT_SUFFIX:
+        raise ValueError(f'unsupported artifact format {fmt}, use one of {list(ARTIFACT_SUFFIX)}')
+    return ARTIFACT_SUFFIX[fmt]
+
+
+def to_bytes(df: pd.DataFrame, fmt: str = None) -> bytes:
+    buffer = io.BytesIO()
+    if artifact_suffix(fmt) == '.feather':
+        # feather keeps no index, the dates are stored as a column and restored on read
+        df.reset_index().to_feather(buffer, compression='uncompressed')
+    else:
+        df.to_parquet(buffer)
+    return buffer.getvalue()
+
+
+def _column(table, name):
+    """
+    a column of an arrow table as a read-only numpy view into its buffer, copied only when it is chunked,
+    has nulls or is of a type numpy cannot view
+    """
+    import pyarrow as pa
+    column = table.column(name)
+    if column.num_chunks == 1 and column.null_count == 0:
+        try:
+            return column.chunk(0).to_numpy(zero_copy_only=True)
+        except pa.ArrowInvalid:
+            pass
+    return column.to_numpy()
+
+
+def _read(path: Path) -> pd.Series:
+    count('bytes_read', path.stat().st_size)
+    if path.suffix == '.feather':
+        import pyarrow as pa
+        # an uncompressed IPC file read from a memory map: the price column and the dates are views into the map
+        table = pa.ipc.open_file(pa.memory_map(str(path), 'r')).read_all()
+        index_name, *names = table.column_names
+        index = pd.DatetimeIndex(_column(table, index_name), name=index_name, copy=False)
+        if len(names) == 1:
+            return pd.Series(_column(table, names[0]), index=index, name=names[0], copy=False)
+        # several columns are consolidated into one block, which copies them
+        return pd.DataFrame({name: _column(table, name) for name in names}, index=index)
+    return pd.read_parquet(path).squeeze(axis=1)
+
+
+def _nbytes(series) -> int:
+    # an int for a series, a per-column series for a frame
+    usage = series.memory_usage(index=True, deep=False)
+    return int(usage.sum() if hasattr(usage, 'sum') else usage)
+
+
+def cache_put(path, series):
+    """
+    keep a decoded artifact for the next read of the same file, least recently used entries are
+    dropped above CACHE_MAX_BYTES
+    """
+    global _cache_bytes
+    path = Path(path)
+    key = (str(path.resolve()), path.stat().st_mtime_ns)
+    nbytes = _nbytes(series)
+    if nbytes > CACHE_MAX_BYTES:
+        return
+    with _lock:
+        if key in _cache:
+            _cache_bytes -= _cache.pop(key)[1]
+        _cache[key] = (series, nbytes)
+        _cache_bytes += nbytes
+        while _cache_bytes > CACHE_MAX_BYTES:
+            _, (_, evicted_bytes) = _cache.popitem(last=False)
+            _cache_bytes -= evicted_bytes
+
+
+def read_series(path) -> pd.Series:
+    """
+    read a price artifact, decoded series are cached per process by path and mtime so the
+    return, volatility and plot steps of a ticker decode the file only once.
+    the cached series is shared, callers must not modify it in place
+    """
+    path = Path(path)
+    key = (str(path.resolve()), path.stat().st_mtime_ns)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key][0]
+    series = _read(path)
+    cache_put(path, series)
+    return series
+
+
+def write_artifact(path, df: pd.DataFrame, content: bytes = None):
+    """
+    write a price artifact atomically in the format given by the path suffix and fill the cache with it
+    :param path: artifact path
+    :param df: price frame
+    :param content: already serialized df, to avoid serializing twice
+    """
+    path = Path(path)
+    fmt = 'feather' if path.suffix == '.feather' else 'parquet'
+    content = content if content is not None else to_bytes(df, fmt)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    count('bytes_written', len(content))
+    write_meta(path, df, content)
+    cache_put(path, df.squeeze(axis=1))
+    return path
+
+
+def get_meta_path(path) -> Path:
+    path = Path(path)
+    return path.with_name(f'{path.name}.meta.json')
+
+
+def write_meta(path, df: pd.DataFrame, content: bytes):
+    """
+    sidecar of an artifact: its last index value (the last price date), number of rows and a fingerprint of its
+    content, so the metric cache is keyed without decoding the artifact. mtime_ns ties it to the artifact file
+    """
+    path = Path(path)
+    meta = {'last_date': str(df.index[-1]) if len(df) else None,
+            'rows': len(df),
+            'fingerprint': hashlib.sha256(content).hexdigest()[:16],
+            'mtime_ns': path.stat().st_mtime_ns}
+    write_json_atomic(get_meta_path(path), meta)
+    return meta
+
+
+def artifact_meta(path) -> dict:
+    """
+    sidecar of an artifact, rebuilt from the file when it is missing or older than the artifact
+    (written before sidecars existed, or a crash between the two writes)
+    """
+    path = Path(path)
+    meta = load_json(get_meta_path(path))
+    if meta is not None and meta.get('mtime_ns') == path.stat().st_mtime_ns:
+        return meta
+    content = path.read_bytes()
+    count('bytes_read', len(content))
+    return write_meta(path, read_series(path), content)
+
+
+def remove_artifact(path):
+    Path(path).unlink(missing_ok=True)
+    get_meta_path(path).unlink(missing_ok=True)
+
+
+def move_artifact(path, target) -> Path:
+    """
+    move an artifact and its sidecar, the sidecar stays valid as the move keeps the mtime
+    """
+    target = Path(target)
+    if get_meta_path(path).exists():
+        os.replace(get_meta_path(path), get_meta_path(target))
+    os.replace(path, target)
+    return target
+
+
+def cache_info() -> dict:
+    return {'entries': len(_cache), 'nbytes': _cache_bytes, 'max_bytes': CACHE_MAX_BYTES}
@@ -0,0 +1,124 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from src.graph.catalog import allocate_run_id, set_status
+from src.graph.graph import build_graph
+from src.graph.logger import get_logger
+from src.graph.prefetch import finish_prefetch, prefetch_totals
+from src.graph.metric_cache import metric_cache_stats
+from src.graph.state import AgentState
+from src.graph.util import percentile
+
+logger = get_logger('batch')
+
+
+def read_queries(path) -> list:
+    """
+    one JSON object per line with a query and optional AgentState fields, a bare string is taken as the query
+    """
+    items = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                item = json.loads(line)
+                items.append({'query': item} if isinstance(item, str) else item)
+    return items
+
+
+async def run_query(graph_app, initial_state: AgentState, semaphore: asyncio.Semaphore) -> dict:
+    async with semaphore:
+        start = time.perf_counter()
+        result = {'run_id': initial_state['run_id'], 'query': initial_state['query'], **initial_state['batch']}
+        try:
+            # the graph nodes are synchronous, each run takes a worker thread while it waits on the llm or prices
+            final_state = await asyncio.to_thread(graph_app.invoke, initial_state)
+            result.update({'status': 'ok' if final_state.get('final_answer') else 'no_answer',
+                           'final_answer': final_state.get('final_answer'),
+                           'nsteps': final_state.get('nsteps')})
+        except Exception as e:
+            logger.error(f'run {initial_state["run_id"]} failed: {e}')
+            set_status(initial_state['run_id'], 'failed')
+            finish_prefetch(initial_state['run_id'])
+            result.update({'status': 'error', 'error': repr(e)})
+        result['latency_s'] = time.perf_counter() - start
+        return result
+
+
+async def run_batch(items: list, concurrency: int = 8, defaults: dict = None, output=None) -> dict:
+    """
+    run many queries through one compiled graph at the same time, at most concurrency runs in flight.
+    all runs share the process: the llm client and its rate limiter, the price store and the artifact cache
+    :param items: dicts with a query and optional AgentState fields
+    :param concurrency:
+    :param defaults: AgentState fields applied to every run, e.g. mode, price_source
+    :param output: optional file object, one JSON result per line written as runs finish
+    :return: summary with the per-run results
+    """
+    graph_app = build_graph().compile()
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency,
+                                                                       thread_name_prefix='batch'))
+    semaphore = asyncio.Semaphore(concurrency)
+    # run ids come from the catalog like any other run, the batch and the input line are kept with the run
+    batch_id = f'{datetime.now().strftime("b%Y%m%dT%H%M%S")}-{os.getpid()}'
+    tasks = []
+    for i, item in enumerate(items):
+        state = {'mode': 'test', **(defaults or {}), **item}
+        state.setdefault('run_id', allocate_run_id(state['mode'], state['query']))
+        state['batch'] = {'batch_id': batch_id, 'line': i}
+        tasks.append(run_query(graph_app, AgentState(**state), semaphore))
+
+    start = time.perf_counter()
+    results = []
+    for task in asyncio.as_completed(tasks):
+        result = await task
+        results.append(result)
+        if output is not None:
+            output.write(json.dumps(result, default=str) + '\n')
+            output.flush()
+    elapsed = time.perf_counter() - start
+
+    latencies = [r['latency_s'] for r in results]
+    return {'runs': len(results),
+            'ok': sum(r['status'] == 'ok' for r in results),
+            'errors': sum(r['status'] == 'error' for r in results),
+            'elapsed_s': elapsed,
+            'throughput_per_s': len(results) / elapsed if elapsed else None,
+            'latency_p50_s': percentile(latencies, 0.5),
+            'latency_p95_s': percentile(latencies, 0.95),
+            'prefetch': prefetch_totals(),
+            'metric_cache': metric_cache_stats(),
+            'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run a JSONL file of queries concurrently')
+    parser.add_argument('queries', help='JSONL file, one {"query": ...} per line')
+    parser.add_argument('--output', default=None, help='JSONL file of per-run results')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mode', default='test', help='gemini, test, scripted, record or replay')
+    parser.add_argument('--price-source', default=None, help='yfinance or offline')
+    parser.add_argument('--executor-mode', default=None, help='sequential or parallel')
+    parser.add_argument('--prefetch', action='store_true', help='fetch the prices of the query while planning')
+    args = parser.parse_args()
+
+    defaults = {'mode': args.mode}
+    if args.price_source:
+        defaults['price_source'] = args.price_source
+    if args.executor_mode:
+        defaults['executor_mode'] = args.executor_mode
+    if args.prefetch:
+        defaults['prefetch'] = True
+    output = open(args.output, 'w', encoding='utf-8') if args.output else None
+    try:
+        summary = asyncio.run(run_batch(read_queries(args.queries), args.concurrency, defaults, output))
+    finally:
+        if output is not None:
+            output.close()
+    summary.pop('results')
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,287 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from src.graph.logger import get_logger
+from src.graph.util import get_data_dir
+
+logger = get_logger('catalog')
+
+CATALOG_ENABLED = os.getenv('AGENTFLOW_CATALOG', '1') != '0'
+# runs in these states are finished and may be pruned by gc
+FINISHED_STATUSES = ['done', 'stopped', 'failed']
+# runs in these states still read their artifacts: running (or about to), or kept up to date by a watch
+ACTIVE_STATUSES = ['allocated', 'running', 'watching']
+
+SCHEMA = """
+create table if not exists runs (
+    run_id text primary key,
+    mode text,
+    query text,
+    status text,
+    nsteps integer,
+    created_at real,
+    updated_at real,
+    artifacts text
+);
+create index if not exists runs_status on runs (status, updated_at);
+create table if not exists run_counters (
+    mode text primary key,
+    last_id integer not null
+);
+"""
+
+_local = threading.local()
+# status last written by the router per unfinished run of this process
+_run_status = {}
+
+
+def get_catalog_path():
+    return get_data_dir() / 'catalog.sqlite'
+
+
+def connect() -> sqlite3.Connection:
+    """
+    one connection per thread and catalog file, in autocommit mode so transactions are explicit.
+    a forked process opens its own, sqlite connections cannot be shared across a fork
+    """
+    path = str(get_catalog_path())
+    key = (os.getpid(), path)
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    if key not in connections:
+        connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute('pragma journal_mode=wal')
+        connection.execute('pragma synchronous=normal')
+        connection.executescript(SCHEMA)
+        connections[key] = connection
+    return connections[key]
+
+
+@contextmanager
+def transaction():
+    """
+    write transaction taking the database lock up front, so two processes cannot read the same counter
+    """
+    connection = connect()
+    connection.execute('begin immediate')
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('rollback')
+        raise
+    connection.execute('commit')
+
+
+def _last_id_on_disk(mode: str) -> int:
+    """
+    highest id of the run folders named exactly <mode>_<number>, used once per mode to start the counter
+    """
+    pattern = re.compile(rf'^{re.escape(mode)}_(\d+)$')
+    numbers = [int(match.group(1)) for match in map(pattern.match, os.listdir(get_data_dir())) if match]
+    return max(numbers, default=0)
+
+
+def allocate_run_id(mode: str, query: str = None) -> str:
+    """
+    next run id of the mode, <mode>_0001, <mode>_0002.., unique across threads and processes
+    """
+    if not CATALOG_ENABLED:
+        # without the catalog the run folder is the reservation, created exclusively
+        while True:
+            run_id = f'{mode}_{_last_id_on_disk(mode) + 1:04d}'
+            try:
+                (get_data_dir() / run_id).mkdir(parents=True)
+                return run_id
+            except FileExistsError:
+                continue
+    with transaction() as connection:
+        row = connection.execute('select last_id from run_counters where mode = ?', (mode,)).fetchone()
+        next_id = (row['last_id'] if row else _last_id_on_disk(mode)) + 1
+        connection.execute('insert into run_counters (mode, last_id) values (?, ?) '
+                           'on conflict (mode) do update set last_id = excluded.last_id', (mode, next_id))
+        run_id = f'{mode}_{next_id:04d}'
+        now = time.time()
+        connection.execute('insert or ignore into runs (run_id, mode, query, status, nsteps, created_at, updated_at, '
+                           'artifacts) values (?, ?, ?, ?, 0, ?, ?, ?)',
+                           (run_id, mode, query, 'allocated', now, now, '[]'))
+    return run_id
+
+
+def run_artifacts(agent_state: dict) -> list:
+    """
+    files of the run outside its folder layout: price artifacts and chart paths
+    """
+    paths = set(str(path) for path in (agent_state.get('data') or {}).values())
+    for results in (agent_state.get('execution_result') or {}).values():
+        if isinstance(results, dict):
+            for value in results.values():
+                if isinstance(value, dict) and value.get('path'):
+                    paths.add(value['path'])
+    return sorted(paths)
+
+
+def upsert_run(agent_state: dict, status: str):
+    """
+    record the run with its current status and artifact paths
+    """
+    if not CATALOG_ENABLED:
+        return
+    now = time.time()
+    with transaction() as connection:
+        connection.execute(
+            'insert into runs (run_id, mode, query, status, nsteps, created_at, updated_at, artifacts) '
+            'values (?, ?, ?, ?, ?, ?, ?, ?) '
+            'on conflict (run_id) do update set mode = excluded.mode, query = excluded.query, '
+            'status = excluded.status, nsteps = excluded.nsteps, updated_at = excluded.updated_at, '
+            'artifacts = excluded.artifacts',
+            (agent_state['run_id'], agent_state.get('mode'), agent_state.get('query'), status,
+             agent_state.get('nsteps', 0), now, now, json.dumps(run_artifacts(agent_state))))
+
+
+def add_artifacts(run_id: str, paths: list):
+    """
+    add artifact paths to the run as they are fetched, so the price store does not evict them before the
+    run records its artifacts at its end
+    """
+    if not CATALOG_ENABLED or not paths:
+        return
+    with transaction() as connection:
+        row = connection.execute('select artifacts from runs where run_id = ?', (run_id,)).fetchone()
+        if row is None:
+            return
+        artifacts = set(json.loads(row['artifacts'] or '[]'))
+        if artifacts.issuperset(map(str, paths)):
+            return
+        connection.execute('update runs set artifacts = ?, updated_at = ? where run_id = ?',
+                           (json.dumps(sorted(artifacts | set(map(str, paths)))), time.time(), run_id))
+
+
+def record_hop(agent_state: dict, status: str):
+    """
+    upsert_run for the router hops: writes at the start of the run, when its status changes and at its end,
+    not on every hop
+    """
+    run_id = agent_state['run_id']
+    if _run_status.get(run_id) == status:
+        return
+    upsert_run(agent_state, status)
+    if status in FINISHED_STATUSES:
+        _run_status.pop(run_id, None)
+    else:
+        _run_status[run_id] = status
+
+
+def set_status(run_id: str, status: str):
+    if status in FINISHED_STATUSES:
+        _run_status.pop(run_id, None)
+    if not CATALOG_ENABLED:
+        return
+    with transaction() as connection:
+        connection.execute('update runs set status = ?, updated_at = ? where run_id = ?',
+                           (status, time.time(), run_id))
+
+
+def active_artifacts() -> set:
+    """
+    artifact paths of the runs in ACTIVE_STATUSES, the price store does not evict them
+    """
+    if not CATALOG_ENABLED:
+        return set()
+    rows = connect().execute(f'select artifacts from runs where status in ({", ".join("?" * len(ACTIVE_STATUSES))})',
+                             ACTIVE_STATUSES)
+    return {path for row in rows for path in json.loads(row['artifacts'] or '[]')}
+
+
+def _row(row) -> dict:
+    run = dict(row)
+    run['artifacts'] = json.loads(run['artifacts'] or '[]')
+    return run
+
+
+def get_run(run_id: str):
+    row = connect().execute('select * from runs where run_id = ?', (run_id,)).fetchone()
+    return _row(row) if row else None
+
+
+def list_runs(status: list = None, mode: str = None, limit: int = 50) -> list:
+    """
+    most recently updated runs first
+    """
+    sql, args = 'select * from runs where 1 = 1', []
+    if status:
+        sql += f' and status in ({", ".join("?" * len(status))})'
+        args += list(status)
+    if mode:
+        sql += ' and mode = ?'
+        args.append(mode)
+    sql += ' order by updated_at desc limit ?'
+    args.append(limit)
+    return [_row(row) for row in connect().execute(sql, args)]
+
+
+def gc_runs(older_than_days: float, keep_last: int = 0, dry_run: bool = False) -> list:
+    """
+    delete the folder and artifacts of finished runs not updated for older_than_days, the catalog keeps
+    them with status pruned. shared stores (price store, llm cache) are not touched
+    :param keep_last: number of most recent finished runs kept whatever their age
+    :return: pruned run ids
+    """
+    cutoff = time.time() - older_than_days * 86400
+    rows = connect().execute(
+        f'select * from runs where status in ({", ".join("?" * len(FINISHED_STATUSES))}) '
+        'order by updated_at desc', FINISHED_STATUSES).fetchall()
+    data_dir = get_data_dir().resolve()
+    pruned = []
+    for row in rows[keep_last:]:
+        run = _row(row)
+        if run['updated_at'] >= cutoff:
+            continue
+        run_dir = (data_dir / run['run_id']).resolve()
+        paths = [path for path in map(Path, run['artifacts']) if data_dir in path.resolve().parents]
+        pruned.append(run['run_id'])
+        if dry_run:
+            continue
+        for path in paths:
+            # artifacts of the content-addressed price store are shared between runs
+            if run_dir in path.resolve().parents:
+                path.unlink(missing_ok=True)
+        if run_dir.parent == data_dir and run_dir.is_dir():
+            shutil.rmtree(run_dir)
+        set_status(run['run_id'], 'pruned')
+    logger.info(f'{"would prune" if dry_run else "pruned"} {len(pruned)} runs older than {older_than_days} days')
+    return pruned
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='catalog of agentflow runs')
+    commands = parser.add_subparsers(dest='command', required=True)
+    list_parser = commands.add_parser('list', help='most recent runs')
+    list_parser.add_argument('--status', nargs='*', default=None)
+    list_parser.add_argument('--mode', default=None)
+    list_parser.add_argument('--limit', type=int, default=20)
+    show_parser = commands.add_parser('show', help='one run')
+    show_parser.add_argument('run_id')
+    gc_parser = commands.add_parser('gc', help='delete the artifacts of old finished runs')
+    gc_parser.add_argument('--older-than-days', type=float, required=True)
+    gc_parser.add_argument('--keep-last', type=int, default=0)
+    gc_parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for run in list_runs(args.status, args.mode, args.limit):
+            updated = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['updated_at']))
+            print(f'{run["run_id"]:<28} {run["status"]:<10} {updated} {run["nsteps"]:>3}  {run["query"]}')
+    elif args.command == 'show':
+        print(json.dumps(get_run(args.run_id), indent=2))
+    else:
+        print('\n'.join(gc_runs(args.older_than_days, args.keep_last, args.dry_run)))
@@ -0,0 +1,184 @@
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from src.graph.logger import get_logger
+from src.graph.profiling import count
+from src.graph.reducers import Replace
+
+logger = get_logger('charts')
+
+CHART_WIDTH_PX = int(os.getenv('AGENTFLOW_CHART_WIDTH', 1000))
+CHART_HEIGHT_PX = int(os.getenv('AGENTFLOW_CHART_HEIGHT', 500))
+CHART_DPI = int(os.getenv('AGENTFLOW_CHART_DPI', 100))
+# process: render in a process pool off the executor, thread: in a thread pool, inline: inside the plot step
+CHART_POOL = os.getenv('AGENTFLOW_CHART_POOL', 'process')
+CHART_WORKERS = int(os.getenv('AGENTFLOW_CHART_WORKERS', 2))
+
+_pool = None
+_pool_lock = threading.Lock()
+# run_id -> [(tickers, chart key, future)] of the charts still rendering
+_pending = {}
+_pending_lock = threading.Lock()
+# one figure per rendering thread, reused chart after chart
+_local = threading.local()
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int):
+    """
+    largest triangle three buckets downsampling: keeps the first and last point and, per bucket,
+    the point forming the largest triangle with the previous kept point and the mean of the next bucket
+    :return: indices of the kept points
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = x.astype(np.float64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = end, edges[i + 2] if i + 2 < len(edges) else n
+        mean_x = x[next_start:next_end].mean()
+        mean_y = y[next_start:next_end].mean()
+        area = np.abs((x[a] - mean_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (mean_y - y[a]))
+        a = start + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+
+def chart_line(label: str, series, width: int = None):
+    """
+    (label, dates as int64 ns, values) of a price series, downsampled to about one point per pixel column
+    """
+    series = series.dropna()
+    # the index resolution depends on the artifact format, asi8 alone is not always in ns
+    x = series.index.to_numpy().astype('datetime64[ns]').astype(np.int64)
+    y = series.to_numpy(dtype=np.float64)
+    kept = lttb(x, y, width or CHART_WIDTH_PX)
+    return label, x[kept], y[kept]
+
+
+def _figure():
+    figure = getattr(_local, 'figure', None)
+    if figure is None:
+        # the Agg canvas is used directly, pyplot and its global figure manager are never loaded
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        figure = Figure(figsize=(CHART_WIDTH_PX / CHART_DPI, CHART_HEIGHT_PX / CHART_DPI), dpi=CHART_DPI)
+        FigureCanvasAgg(figure)
+        figure.add_subplot()
+        _local.figure = figure
+    return figure
+
+
+def render_chart(path, lines: list, title: str = '', ylabel: str = '') -> str:
+    """
+    draw the lines on the reused figure and save it as a PNG
+    :param path: PNG path
+    :param lines: (label, dates as int64 ns, values) per line
+    """
+    figure = _figure()
+    ax = figure.axes[0]
+    ax.clear()
+    for label, x, y in lines:
+        ax.plot(x.astype('datetime64[ns]'), y, label=label, linewidth=1)
+    if len(lines) > 1:
+        ax.legend(loc='upper left')
+    ax.set_title(title)
+    ax.set_ylabel(ylabel)
+    ax.grid(True, alpha=0.3)
+    figure.autofmt_xdate()
+    figure.savefig(path)
+    return str(path)
+
+
+def get_chart_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if CHART_POOL == 'process':
+                # spawn: the batch runner has threads, a forked worker would inherit the locks they hold
+                _pool = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                _pool = ThreadPoolExecutor(max_workers=CHART_WORKERS, thread_name_prefix='charts')
+    return _pool
+
+
+@atexit.register
+def shutdown_chart_pool():
+    """
+    charts still rendering are finished, those not started are cancelled
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
+
+def submit_chart(run_id: str, tickers: list, chart_key: str, path, lines: list, title: str = '',
+                 ylabel: str = '', label: str = '') -> dict:
+    """
+    render a chart off the critical path, the returned status is pending until collect_charts picks up the result.
+    inside a worker process of the executor pool the chart is rendered in place, its future could not be collected
+    :param label: the chart in its execution_status entry, see chart_status
+    :return: chart status for execution_result
+    """
+    if CHART_POOL == 'inline' or multiprocessing.parent_process() is not None:
+        render_chart(path, lines, title, ylabel)
+        count('bytes_written', os.path.getsize(path))
+        return chart_record({'status': 'ok', 'path': str(path)}, tickers)
+    future = get_chart_pool().submit(render_chart, path, lines, title, ylabel)
+    with _pending_lock:
+        _pending.setdefault(run_id, []).append((tickers, chart_key, label, future))
+    return chart_record({'status': 'pending', 'path': str(path)}, tickers)
+
+
+def chart_record(chart: dict, tickers: list) -> dict:
+    """
+    a chart of several tickers keeps their list, its file is named by a hash of it. the record replaces the
+    one of an earlier render instead of being merged into it
+    """
+    return Replace({**chart, 'tickers': list(tickers)} if len(tickers) > 1 else chart)
+
+
+def chart_status(label: str, chart: dict) -> list:
+    """
+    execution_status entry of a chart, written once its status is final: by the plot step when the chart was
+    rendered in place, by collect_charts otherwise
+    """
+    return [] if chart['status'] == 'pending' else [f'{label} status: {chart["status"]}']
+
+
+def has_pending_charts(run_id: str) -> bool:
+    with _pending_lock:
+        return bool(_pending.get(run_id))
+
+
+def collect_charts(run_id: str, timeout: float = None) -> dict:
+    """
+    wait for the charts of the run still rendering
+    :return: state update with their final status in execution_result and their execution_status entries
+    """
+    with _pending_lock:
+        pending = _pending.pop(run_id, [])
+    execution_result, status = {}, []
+    for tickers, chart_key, label, future in pending:
+        try:
+            path = future.result(timeout=timeout)
+            count('bytes_written', os.path.getsize(path))
+            chart = chart_record({'status': 'ok', 'path': path}, tickers)
+        except Exception as e:
+            logger.error(f'chart {chart_key} of {tickers} failed: {e}')
+            chart = chart_record({'status': 'failed', 'error': repr(e)}, tickers)
+        for ticker in tickers:
+            execution_result.setdefault(ticker, {})[chart_key] = chart
+        status += chart_status(label, chart)
+    return {'execution_result': execution_result, 'execution_status': status}
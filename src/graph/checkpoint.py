@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import typing
+import uuid
+
+from src.graph.logger import get_logger
+from src.graph.reducers import Replace
+from src.graph.state import AgentState
+from src.graph.util import get_state_path, write_json_atomic
+
+logger = get_logger('checkpoint')
+
+# json: full state.json rewrite on every router hop
+# journal: node updates appended to state.journal.jsonl, compacted into state.json every JOURNAL_COMPACT_EVERY records
+CHECKPOINT_BACKEND = os.getenv('AGENTFLOW_CHECKPOINT', 'json')
+JOURNAL_FSYNC_EVERY = int(os.getenv('AGENTFLOW_JOURNAL_FSYNC_EVERY', 8))
+JOURNAL_COMPACT_EVERY = int(os.getenv('AGENTFLOW_JOURNAL_COMPACT_EVERY', 200))
+GENERATION_KEY = '_checkpoint_generation'
+# a Replace value of a journaled update, json would make it a plain dict merged on replay
+REPLACE_KEY = '__replace__'
+
+_journals = {}
+_lock = threading.Lock()
+
+
+def get_journal_path(run_id):
+    return get_state_path(run_id).with_name('state.journal.jsonl')
+
+
+def state_reducers() -> dict:
+    """
+    reducers of the AgentState channels, the same ones LangGraph applies to node updates
+    """
+    hints = typing.get_type_hints(AgentState, include_extras=True)
+    return {key: hint.__metadata__[0] for key, hint in hints.items() if hasattr(hint, '__metadata__')}
+
+
+def apply_update(agent_state: dict, update: dict, reducers: dict = None) -> dict:
+    reducers = state_reducers() if reducers is None else reducers
+    for key, value in update.items():
+        if key in reducers and agent_state.get(key) is not None:
+            agent_state[key] = reducers[key](agent_state[key], value)
+        else:
+            agent_state[key] = value
+    return agent_state
+
+
+def journal_value(value):
+    if isinstance(value, Replace):
+        return {REPLACE_KEY: dict(value)}
+    if isinstance(value, dict):
+        return {key: journal_value(item) for key, item in value.items()}
+    return value
+
+
+def replay_value(value):
+    if isinstance(value, dict):
+        if len(value) == 1 and REPLACE_KEY in value:
+            return Replace(value[REPLACE_KEY])
+        return {key: replay_value(item) for key, item in value.items()}
+    return value
+
+
+class Journal:
+    """
+    append-only log of node updates of one run, on top of the last state.json snapshot
+    """
+
+    def __init__(self, run_id: str):
+        self.run_id = run_id
+        self.path = get_journal_path(run_id)
+        self.file = None
+        self.records = 0
+        self.unsynced = 0
+        self.has_snapshot = False
+        # records only replay on top of the snapshot of their generation, so a crash between
+        # writing a new snapshot and removing the old journal cannot apply the old records twice
+        self.generation = None
+
+    def append(self, node: str, update: dict):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(json.dumps({'generation': self.generation, 'node': node, 'update': journal_value(update)},
+                                   default=str) + '\n')
+        self.records += 1
+        self.unsynced += 1
+        if self.unsynced >= JOURNAL_FSYNC_EVERY:
+            self.sync()
+        else:
+            self.file.flush()
+
+    def sync(self):
+        if self.file is not None and self.unsynced:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def compact(self, agent_state: AgentState):
+        """
+        write the full state as the new snapshot, then start an empty journal.
+        the snapshot is replaced atomically, a crash leaves either the old snapshot + journal or the new snapshot
+        """
+        self.generation = uuid.uuid4().hex
+        write_json_atomic(get_state_path(self.run_id), {**agent_state, GENERATION_KEY: self.generation})
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.path.unlink(missing_ok=True)
+        self.records = 0
+        self.unsynced = 0
+        self.has_snapshot = True
+
+    def close(self):
+        self.sync()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def get_journal(run_id: str) -> Journal:
+    with _lock:
+        if run_id not in _journals:
+            _journals[run_id] = Journal(run_id)
+        return _journals[run_id]
+
+
+def close_journal(run_id: str):
+    """
+    sync and drop the journal of a run that ended, whatever the outcome, its file handle is closed
+    """
+    with _lock:
+        journal = _journals.pop(run_id, None)
+    if journal is not None:
+        journal.close()
+
+
+def record_update(agent_state: AgentState, node: str, update: dict):
+    """
+    journal the update a node or the router returns, called after every node and router hop with the journal backend
+    """
+    run_id = agent_state.get('run_id')
+    if CHECKPOINT_BACKEND != 'journal' or not run_id:
+        return
+    journal = get_journal(run_id)
+    if journal.has_snapshot:
+        journal.append(node, update)
+
+
+def save_state(agent_state: AgentState):
+    """
+    checkpoint the state on a router hop.
+    with the journal backend the node updates are already journaled, the router only writes a snapshot
+    the first time it sees the run in this process, when the journal is due for compaction and once the run is answered
+    """
+    if CHECKPOINT_BACKEND == 'journal':
+        run_id = agent_state['run_id']
+        journal = get_journal(run_id)
+        finished = bool(agent_state.get('final_answer'))
+        if not journal.has_snapshot or journal.records >= JOURNAL_COMPACT_EVERY or finished:
+            journal.compact(agent_state)
+        if finished:
+            close_journal(run_id)
+        return
+    write_json_atomic(get_state_path(agent_state['run_id']), agent_state)
+
+
+def load_state(run_id: str):
+    """
+    rebuild the state from the last snapshot and the journal written after it,
+    a torn last line left by a crash mid-write is ignored
+    """
+    state_path = get_state_path(run_id)
+    with open(state_path, 'r', encoding='utf-8') as f:
+        agent_state = json.loads(f.read())
+    generation = agent_state.pop(GENERATION_KEY, None)
+    journal_path = get_journal_path(run_id)
+    if generation and journal_path.exists():
+        reducers = state_reducers()
+        with open(journal_path, 'r', encoding='utf-8') as f:
+            for n, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f'ignoring torn journal record {n} of run {run_id}')
+                    break
+                if record['generation'] != generation:
+                    continue
+                apply_update(agent_state, replay_value(record['update']), reducers)
+    return agent_state
@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+
+from src.graph.coverage import metric_name, NON_TICKER_KEYS
+from src.graph.logger import get_logger
+from src.graph.profiling import estimate_tokens
+from src.graph.query import extract_tickers, extract_periods
+from src.graph.validation import plan_tickers, FETCH_ACTIONS
+
+logger = get_logger('context')
+
+COMPACT_CONTEXT = os.getenv('AGENTFLOW_COMPACT_CONTEXT', '1') != '0'
+# estimated prompt tokens of the result table above which it is summarized
+CONTEXT_TOKEN_BUDGET = int(os.getenv('AGENTFLOW_CONTEXT_TOKEN_BUDGET', 1500))
+# rows kept at each end of the ranking when the table is summarized
+SUMMARY_ROWS = 5
+# query words that select the metrics of the context, by metric name
+QUERY_METRIC_WORDS = {'return': ['return', 'performance', 'perform', 'gain', 'loss'],
+                      'vol': ['vol', 'risk', 'risky', 'volatility'],
+                      'chart': ['chart', 'plot', 'graph']}
+# metrics shown as percentages
+PERCENT_METRICS = ['return', 'vol', 'drawdown', 'portfolio']
+
+
+def relevant_results(execution_result: dict, query: str) -> dict:
+    """
+    the part of execution_result the query asks about: tickers and periods named in the query and the metrics
+    its words point to. a filter that would leave nothing is not applied, so a vague query keeps everything
+    """
+    if not COMPACT_CONTEXT or not query:
+        return execution_result
+    lowered = query.lower()
+    tickers = [ticker for ticker in extract_tickers(query) if ticker in execution_result]
+    periods = extract_periods(query)
+    metrics = [metric for metric, words in QUERY_METRIC_WORDS.items() if any(word in lowered for word in words)]
+
+    def keep(key: str) -> bool:
+        name = metric_name(key)
+        if metrics and name in QUERY_METRIC_WORDS and name not in metrics:
+            return False
+        period = key[len(name) + 1:]
+        return not (periods and name in PERCENT_METRICS and period and period not in periods)
+
+    filtered = {}
+    for ticker, results in execution_result.items():
+        if not isinstance(results, dict) or ticker in NON_TICKER_KEYS:
+            filtered[ticker] = results
+            continue
+        if tickers and ticker not in tickers:
+            continue
+        kept = {key: value for key, value in results.items() if keep(key)}
+        filtered[ticker] = kept or results
+    return filtered if any(filtered.values()) else execution_result
+
+
+def format_value(key: str, value) -> str:
+    if isinstance(value, dict):
+        # charts: only the status, the paths are noise for the llm
+        return value.get('status', '?')
+    if isinstance(value, float):
+        if metric_name(key) in PERCENT_METRICS:
+            return f'{value * 100:.2f}%'
+        return f'{value:.4g}'
+    return str(value)
+
+
+def result_table(execution_result: dict) -> tuple:
+    """
+    :return: columns, rows as (ticker, formatted values) for the tickers with dict results
+    """
+    execution_result = {ticker: results for ticker, results in execution_result.items()
+                        if isinstance(results, dict) and ticker not in NON_TICKER_KEYS}
+    columns = []
+    for results in execution_result.values():
+        for key in results:
+            if key not in columns:
+                columns.append(key)
+    rows = [(ticker, [format_value(key, results[key]) if key in results else '-' for key in columns])
+            for ticker, results in execution_result.items()]
+    return columns, rows
+
+
+def render_cross_asset(cross_asset: dict) -> str:
+    """
+    results across tickers: ranked pairs and small matrices of correlations, portfolio numbers, no artifact paths
+    """
+    lines = []
+    for key, value in cross_asset.items():
+        if not isinstance(value, dict):
+            lines.append(f'{key}: {format_value(key, value)}')
+            continue
+        for name in ['most_correlated', 'least_correlated']:
+            if value.get(name) and 'matrix' not in value:
+                lines.append(f'{key} {name.replace("_", " ")}: '
+                             + ', '.join(f'{a}/{b} {rho:.2f}' for a, b, rho in value[name]))
+        if 'matrix' in value:
+            tickers = list(value['matrix'])
+            lines.append(f'{key}:')
+            lines.append(render_table(tickers, [(ticker, [f'{value["matrix"][ticker][other]:.4g}' for other in tickers])
+                                                for ticker in tickers]))
+        elif not any(name in value for name in ['most_correlated', 'least_correlated', 'path']):
+            lines.append(f'{key}: ' + ', '.join(f'{name} {format_value(key, v)}' for name, v in value.items()))
+    return '\n'.join(lines)
+
+
+def render_table(columns: list, rows: list) -> str:
+    lines = [' | '.join(['ticker'] + columns)]
+    lines += [' | '.join([ticker] + values) for ticker, values in rows]
+    return '\n'.join(lines)
+
+
+def numeric_columns(execution_result: dict, columns: list) -> list:
+    return [key for key in columns
+            if any(isinstance(results.get(key), (int, float)) for results in execution_result.values()
+                   if isinstance(results, dict))]
+
+
+def summary_tickers(execution_result: dict, key: str) -> list:
+    """
+    tickers ranked by the column, only the top and bottom SUMMARY_ROWS of a long ranking
+    """
+    values = {ticker: results[key] for ticker, results in execution_result.items()
+              if isinstance(results, dict) and isinstance(results.get(key), (int, float))}
+    ranked = sorted(values, key=values.get, reverse=True)
+    if len(ranked) > 2 * SUMMARY_ROWS:
+        ranked = ranked[:SUMMARY_ROWS] + ranked[-SUMMARY_ROWS:]
+    return ranked
+
+
+def summarize_table(execution_result: dict, columns: list, rows: list) -> str:
+    """
+    a table too large for the budget: per numeric column the mean, the min and the max with their tickers,
+    then only the top and bottom SUMMARY_ROWS rows ranked by the first numeric column
+    """
+    numeric = numeric_columns(execution_result, columns)
+    lines = [f'{len(rows)} tickers, summarized']
+    for key in numeric:
+        values = {ticker: results[key] for ticker, results in execution_result.items()
+                  if isinstance(results, dict) and isinstance(results.get(key), (int, float))}
+        low, high = min(values, key=values.get), max(values, key=values.get)
+        mean = sum(values.values()) / len(values)
+        lines.append(f'{key}: mean {format_value(key, mean)}, min {format_value(key, values[low])} ({low}), '
+                     f'max {format_value(key, values[high])} ({high})')
+    if numeric:
+        shown = summary_tickers(execution_result, numeric[0])
+        lines.append(f'{len(shown)} tickers ranked by {numeric[0]}:')
+        row_of = dict(rows)
+        lines.append(render_table(columns, [(ticker, row_of[ticker]) for ticker in shown]))
+    return '\n'.join(lines)
+
+
+def over_budget(context: str, token_budget: int = None) -> bool:
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    return estimate_tokens(context) > token_budget
+
+
+def render_context(execution_result: dict, query: str = None, token_budget: int = None) -> str:
+    """
+    execution_result as it goes into the answer and critic prompts: the query relevant part as a table with
+    rounded numbers, summarized above the token budget. AGENTFLOW_COMPACT_CONTEXT=0 keeps the raw dict
+    """
+    if not COMPACT_CONTEXT:
+        return str(execution_result)
+    results = relevant_results(execution_result, query)
+    columns, rows = result_table(results)
+    context = render_table(columns, rows)
+    if over_budget(context, token_budget):
+        logger.info(f'context of {len(rows)} tickers over the token budget, summarized')
+        context = summarize_table(results, columns, rows)
+    for key in NON_TICKER_KEYS:
+        if isinstance(results.get(key), dict):
+            context += '\n' + render_cross_asset(results[key])
+    extra = {ticker: value for ticker, value in results.items() if not isinstance(value, dict)}
+    if extra:
+        context += '\n' + json.dumps(extra, default=str)
+    return context
+
+
+def context_results(execution_result: dict, query: str = None, token_budget: int = None) -> dict:
+    """
+    the results render_context shows, what the coverage checks can expect the answer to address
+    """
+    if not COMPACT_CONTEXT:
+        return execution_result
+    results = relevant_results(execution_result, query)
+    columns, rows = result_table(results)
+    if not over_budget(render_table(columns, rows), token_budget):
+        return results
+    numeric = numeric_columns(results, columns)
+    if not numeric:
+        return {}
+    return {ticker: results[ticker] for ticker in summary_tickers(results, numeric[0])}
+
+
+def render_plan(plans) -> str:
+    """
+    one line per step, action and params, instead of the repr of the plan dicts
+    """
+    if not isinstance(plans, list):
+        return str(plans)
+    lines = []
+    for i, plan in enumerate(plans):
+        if not isinstance(plan, dict):
+            lines.append(f'{i}. {plan}')
+            continue
+        params = ' '.join(f'{name}={json.dumps(value)}' for name, value in (plan.get('params') or {}).items())
+        lines.append(f'{i}. {plan.get("action")} {params}')
+    return '\n'.join(lines)
+
+
+def step_flagged(plan: dict, plan_check_msg: list) -> bool:
+    """
+    whether a validation message is about the step: it names the step's action and ticker,
+    or the missing data of one of its tickers
+    """
+    if not isinstance(plan, dict):
+        return True
+    action = str(plan.get('action'))
+    tickers = plan_tickers(plan)
+    for msg in plan_check_msg:
+        if action in msg and (not tickers or any(ticker in msg for ticker in tickers)):
+            return True
+        if action not in FETCH_ACTIONS and any(msg.startswith(f'data for {ticker} ') for ticker in tickers):
+            return True
+    return False
+
+
+def render_plan_feedback(plans, plan_check_msg: list, tried: list = None) -> str:
+    """
+    the previous plan for a planner retry: compact steps, the steps the validation messages are about marked with !,
+    and from the second retry which steps changed since the attempt before
+    """
+    if not COMPACT_CONTEXT:
+        return str(plans)
+    if not isinstance(plans, list):
+        return str(plans)
+    rendered = render_plan(plans).split('\n')
+    feedback = '\n'.join(('! ' if step_flagged(plan, plan_check_msg) else '  ') + line
+                         for plan, line in zip(plans, rendered))
+    if tried:
+        # compared without the step numbers, an inserted step does not change the ones after it
+        previous = {line.split(' ', 1)[1] for line in render_plan(tried[-1]).split('\n') if ' ' in line}
+        changed = [line for line in rendered if line.split(' ', 1)[-1] not in previous]
+        feedback += f'\nchanged since the attempt before: {len(changed)} steps' + (
+            '\n' + '\n'.join(changed) if changed else ', the same plan was returned again')
+    return feedback
+
+
+def measure(agent_state: dict) -> dict:
+    """
+    estimated prompt tokens of the raw and the compact rendering of the run's results and plan
+    """
+    execution_result = agent_state.get('execution_result') or {}
+    plans = agent_state.get('plans') or []
+    query = agent_state.get('query', '')
+    return {'run_id': agent_state.get('run_id'),
+            'results_raw_tokens': estimate_tokens(str(execution_result)),
+            'results_compact_tokens': estimate_tokens(render_context(execution_result, query)),
+            'plan_raw_tokens': estimate_tokens(str(plans)),
+            'plan_compact_tokens': estimate_tokens(render_plan(plans))}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='prompt tokens of the raw and compact context of runs')
+    parser.add_argument('run_ids', nargs='+')
+    parser.add_argument('--show', action='store_true', help='print the compact context')
+    args = parser.parse_args()
+
+    from src.graph.checkpoint import load_state
+    print(f'{"run_id":<24} {"results raw":>11} {"compact":>8} {"plan raw":>9} {"compact":>8}')
+    for run_id in args.run_ids:
+        state = load_state(run_id)
+        m = measure(state)
+        print(f'{run_id:<24} {m["results_raw_tokens"]:>11} {m["results_compact_tokens"]:>8} '
+              f'{m["plan_raw_tokens"]:>9} {m["plan_compact_tokens"]:>8}')
+        if args.show:
+            print(render_context(state.get('execution_result') or {}, state.get('query')))
@@ -0,0 +1,171 @@
+import os
+import re
+
+from src.graph.logger import get_logger
+
+logger = get_logger('coverage')
+
+PRECRITIC_ENABLED = os.getenv('AGENTFLOW_PRECRITIC', '1') != '0'
+# words that show a metric of execution_result is covered by the answer, by metric key prefix
+METRIC_WORDS = {'return': ['return', 'performance'],
+                'vol': ['vol', 'risk'],
+                'chart': ['chart', 'plot']}
+# metrics whose value the answer is expected to quote, and those whose sign it has to get right
+NUMERIC_METRICS = ['return', 'vol']
+SIGNED_METRICS = ['return']
+NUMBER_PATTERN = re.compile(r'(?<![\w.])-?\d+(?:,\d{3})*(?:\.\d+)?')
+# end of a sentence or clause: a line break, or . ! ? ; followed by a space (a decimal point is not)
+SENTENCE_END = re.compile(r'\n|[.!?;](?=\s|$)')
+# words in the few characters before a number that give its direction when it is written without a sign
+DIRECTION_WINDOW = 30
+NEGATIVE_WORDS = ['fell', 'fall', 'falls', 'fallen', 'drop', 'drops', 'dropped', 'down', 'decline', 'declined',
+                  'declines', 'decrease', 'decreased', 'lost', 'lose', 'loss', 'slid', 'plunged', 'negative', 'minus']
+POSITIVE_WORDS = ['rose', 'rise', 'rises', 'up', 'gain', 'gains', 'gained', 'increase', 'increased', 'grew',
+                  'climbed', 'positive', 'plus']
+# relative tolerance on top of the rounding of the quoted number
+RELATIVE_TOLERANCE = 0.01
+# keys of execution_result that hold results across tickers, not the results of a ticker
+NON_TICKER_KEYS = ['cross_asset']
+
+
+def mention_pattern(words: list, whole: bool = True, flags: int = 0) -> re.Pattern:
+    """
+    regex of the words as words of their own (whole, for tickers) or at the start of a word (for metric words:
+    vol matches volatility, not involve)
+    """
+    alternatives = '|'.join(map(re.escape, sorted(words, key=len, reverse=True)))
+    return re.compile(r'(?<![A-Za-z0-9])(' + alternatives + ')' + (r'(?![A-Za-z0-9])' if whole else ''), flags)
+
+
+METRIC_PATTERNS = {metric: mention_pattern(words, whole=False, flags=re.IGNORECASE)
+                   for metric, words in METRIC_WORDS.items()}
+NEGATIVE_PATTERN = mention_pattern(NEGATIVE_WORDS, flags=re.IGNORECASE)
+POSITIVE_PATTERN = mention_pattern(POSITIVE_WORDS, flags=re.IGNORECASE)
+
+
+def metric_name(key: str) -> str:
+    return key.split('_')[0]
+
+
+def required_coverage(execution_result: dict) -> dict:
+    """
+    ticker -> metric names (return, vol, chart) the answer has to mention, entries without such
+    metrics (e.g. failed charts or non-ticker results) are not required
+    """
+    required = {}
+    for ticker, results in execution_result.items():
+        if not isinstance(results, dict) or ticker in NON_TICKER_KEYS:
+            continue
+        metrics = set()
+        for key, value in results.items():
+            if metric_name(key) not in METRIC_WORDS:
+                continue
+            if isinstance(value, dict) and value.get('status', 'ok') != 'ok':
+                continue
+            metrics.add(metric_name(key))
+        if metrics:
+            required[ticker] = sorted(metrics)
+    return required
+
+
+def direction(text: str) -> int:
+    """
+    -1 or 1 by the last direction word of the text (fell, rose..), 0 without one
+    """
+    words = [(match.start(), -1) for match in NEGATIVE_PATTERN.finditer(text)]
+    words += [(match.start(), 1) for match in POSITIVE_PATTERN.finditer(text)]
+    return max(words)[1] if words else 0
+
+
+def quoted_numbers(text: str) -> list:
+    """
+    numbers written in the text, with the precision they are written with and their sign: -1 or 1 when written
+    with a sign or after a direction word (fell 4.2%, rose 3%), 0 when the text does not say
+    :return: (absolute value, rounding, sign) per number
+    """
+    numbers = []
+    previous_end = 0
+    for match in NUMBER_PATTERN.finditer(text):
+        number = match.group().replace(',', '')
+        decimals = len(number.split('.')[1]) if '.' in number else 0
+        if number.startswith('-'):
+            sign = -1
+        elif text[match.start() - 1:match.start()] == '+':
+            sign = 1
+        else:
+            sign = direction(text[max(previous_end, match.start() - DIRECTION_WINDOW):match.start()])
+        numbers.append((abs(float(number)), 0.5 * 10 ** -decimals, sign))
+        previous_end = match.end()
+    return numbers
+
+
+def ticker_spans(text: str, tickers: list) -> dict:
+    """
+    the parts of the text that speak about each ticker: a sentence naming a single ticker belongs to it,
+    in a sentence naming several, each ticker gets the clause from its name up to the next ticker named
+    :return: ticker -> text spans
+    """
+    pattern = mention_pattern(tickers)
+    spans = {ticker: [] for ticker in tickers}
+    for sentence in SENTENCE_END.split(text):
+        mentions = [(match.start(), match.group()) for match in pattern.finditer(sentence)]
+        named = {ticker for _, ticker in mentions}
+        if len(named) == 1:
+            spans[mentions[0][1]].append(sentence)
+            continue
+        for i, (start, ticker) in enumerate(mentions):
+            end = mentions[i + 1][0] if i + 1 < len(mentions) else len(sentence)
+            spans[ticker].append(sentence[start + len(ticker):end])
+    return spans
+
+
+def value_quoted(value: float, numbers: list, signed: bool = False) -> bool:
+    """
+    whether the value is quoted as a fraction or a percentage, up to the rounding of the quote.
+    signed: the quote has to carry the direction of the value, a negative value is written with a minus or
+    a word like fell, a positive one is not written as negative
+    """
+    for candidate in [abs(value), abs(value) * 100]:
+        for number, rounding, sign in numbers:
+            if abs(number - candidate) > rounding + RELATIVE_TOLERANCE * candidate:
+                continue
+            if not signed or (sign == -1 if value < 0 else sign != -1 or value == 0):
+                return True
+    return False
+
+
+def check_coverage(draft_answer: str, execution_result: dict) -> dict:
+    """
+    deterministic check of the draft against execution_result:
+    - a required ticker or metric that is never mentioned: retry, with what is missing as the reason
+    - everything mentioned and every return/vol value quoted within tolerance next to its ticker (in the sentence
+      or clause about it, see ticker_spans), returns with their direction: ok, a value quoted for another ticker
+      or with the wrong sign does not count
+    - otherwise unclear: the values that could not be matched, for the llm critic to judge
+    :return: {'status': 'ok'|'retry'|'unclear', 'reason': str, 'unmatched': list}
+    """
+    required = required_coverage(execution_result)
+    named = {match.group() for match in mention_pattern(required).finditer(draft_answer)} if required else set()
+    missing = [f'ticker {ticker}' for ticker in required if ticker not in named]
+    metrics = sorted({metric for metrics in required.values() for metric in metrics})
+    missing += [f'metric {metric}' for metric in metrics if not METRIC_PATTERNS[metric].search(draft_answer)]
+    if missing:
+        return {'status': 'retry',
+                'reason': f'the answer does not address: {", ".join(missing)}',
+                'unmatched': []}
+
+    spans = ticker_spans(draft_answer, list(required))
+    unmatched = []
+    for ticker in required:
+        numbers = [number for span in spans[ticker] for number in quoted_numbers(span)]
+        for key, value in execution_result[ticker].items():
+            if metric_name(key) in NUMERIC_METRICS and isinstance(value, (int, float)) \
+                    and not value_quoted(value, numbers, metric_name(key) in SIGNED_METRICS):
+                unmatched.append(f'{ticker} {key}={value:.4f}')
+    if unmatched:
+        return {'status': 'unclear',
+                'reason': f'values not found in the answer: {", ".join(unmatched)}',
+                'unmatched': unmatched}
+    return {'status': 'ok',
+            'reason': 'every ticker, metric and value of the context is in the answer',
+            'unmatched': []}
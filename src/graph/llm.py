@@ -0,0 +1,397 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from src.graph.gemini_response import response
+from src.graph.logger import get_logger
+from src.graph.profiling import count, estimate_tokens, span
+from src.graph.scripted_llm import scripted_response
+from src.graph.state import AgentState
+from src.graph.tools import plan_tools
+from src.graph.util import get_data_dir, write_json_atomic, load_json
+
+load_dotenv()
+
+logger = get_logger('llm')
+
+MODEL = 'gemini-2.5-flash'
+LLM_CACHE_ENABLED = os.getenv('AGENTFLOW_LLM_CACHE', '1') != '0'
+LLM_CACHE_TTL = float(os.getenv('AGENTFLOW_LLM_CACHE_TTL', 24 * 3600))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('AGENTFLOW_LLM_CACHE_MAX_ENTRIES', 10000))
+# eviction scans the cache directory once every this many writes
+LLM_CACHE_EVICT_EVERY = 100
+# live calls per second shared by every run of the process, 0 disables the limiter
+LLM_RATE = float(os.getenv('AGENTFLOW_LLM_RATE', 0))
+LLM_BURST = int(os.getenv('AGENTFLOW_LLM_BURST', 5))
+LLM_MAX_RETRIES = int(os.getenv('AGENTFLOW_LLM_MAX_RETRIES', 5))
+# simulated round-trip of the canned test responses, in seconds
+TEST_LLM_LATENCY = float(os.getenv('AGENTFLOW_TEST_LLM_LATENCY', 0))
+
+_writes = 0
+# (run_id, node) -> (cache key, text) of live responses cached once the planner or the critic accepted them
+_held = {}
+_held_lock = threading.Lock()
+_client = None
+_config = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    the genai client, the SDK is only imported and the client built on the first live call
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from google import genai
+                _client = genai.Client(api_key=os.getenv('GEMINI_API_KEY'))
+    return _client
+
+
+def get_config():
+    """
+    GenerateContentConfig of the planner, built on first use
+    """
+    global _config
+    if _config is None:
+        from google.genai import types
+        _config = types.GenerateContentConfig(tools=plan_tools, automatic_function_calling={"disable": True})
+    return _config
+
+
+class RateLimiter:
+    """
+    token bucket shared by every thread of the process
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+rate_limiter = RateLimiter(LLM_RATE, LLM_BURST)
+
+
+def is_quota_error(error: Exception) -> bool:
+    return getattr(error, 'code', None) == 429 or 'RESOURCE_EXHAUSTED' in str(error)
+
+
+def with_backoff(call):
+    """
+    live call through the shared rate limiter, quota errors are retried with exponential backoff and jitter
+    """
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        try:
+            return call()
+        except Exception as e:
+            if not is_quota_error(e) or attempt == LLM_MAX_RETRIES:
+                raise
+            backoff = min(60, 2 ** attempt) * (0.5 + random.random())
+            logger.warning(f'llm quota error, retry {attempt + 1} in {backoff:.1f}s: {e}')
+            time.sleep(backoff)
+
+
+def generate_content(contents, gen_config=None):
+    return with_backoff(lambda: get_client().models.generate_content(model=MODEL, contents=contents,
+                                                                     config=gen_config))
+
+
+def generate_content_stream(contents, gen_config=None):
+    """
+    live streamed call, opened through with_backoff: it is retried until the first chunk arrives, a quota error
+    after that is raised as retrying would repeat the text already yielded
+    """
+    def open_stream():
+        stream = iter(get_client().models.generate_content_stream(model=MODEL, contents=contents, config=gen_config))
+        return next(stream, None), stream
+
+    first, stream = with_backoff(open_stream)
+    if first is not None:
+        yield first
+        yield from stream
+
+
+def get_cache_dir():
+    path = get_data_dir() / '_llm_cache'
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def get_fixture_dir():
+    path = get_data_dir() / '_llm_fixtures'
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def config_fingerprint(gen_config) -> str:
+    """
+    stable description of a GenerateContentConfig, tools are identified by name
+    """
+    if gen_config is None:
+        return ''
+    tools = [getattr(t, '__name__', repr(t)) for t in gen_config.tools or []]
+    other = gen_config.model_dump(mode='json', exclude={'tools'}, exclude_none=True)
+    return json.dumps({'tools': tools, **other}, sort_keys=True, default=str)
+
+
+def cache_key(model: str, contents, gen_config=None) -> str:
+    payload = json.dumps({'model': model, 'contents': contents, 'config': config_fingerprint(gen_config)},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def query_key(node: str, query: str) -> str:
+    return 'query-' + hashlib.sha256(f'{node}\n{query}'.encode()).hexdigest()
+
+
+def _cache_path(key: str):
+    path = get_cache_dir() / key[:2]
+    path.mkdir(exist_ok=True)
+    return path / f'{key}.json'
+
+
+def cache_get(key: str):
+    path = _cache_path(key)
+    entry = load_json(path)
+    if entry is None:
+        return None
+    if LLM_CACHE_TTL and time.time() - entry['created_at'] > LLM_CACHE_TTL:
+        path.unlink(missing_ok=True)
+        return None
+    return entry['text']
+
+
+def cache_put(key: str, node: str, text: str):
+    global _writes
+    write_json_atomic(_cache_path(key), {'created_at': time.time(), 'node': node, 'text': text})
+    _writes += 1
+    if _writes % LLM_CACHE_EVICT_EVERY == 0:
+        evict_cache()
+
+
+def hold_response(agent_state: AgentState, node: str, key: str, text: str, attempt: int):
+    """
+    keep a live response until the run accepts it: a plan that fails validation or an answer the critic
+    sends back must not be served to the next identical prompt. retries are not cached at all
+    """
+    if not LLM_CACHE_ENABLED or attempt > 0:
+        return
+    with _held_lock:
+        _held[(agent_state.get('run_id'), node)] = (key, text)
+
+
+def accept_response(agent_state: AgentState, *nodes: str):
+    """
+    cache the held responses of the nodes, the plan passed check_plans or the critic accepted the answer
+    """
+    for node in nodes:
+        with _held_lock:
+            held = _held.pop((agent_state.get('run_id'), node), None)
+        if held is not None:
+            cache_put(held[0], node, held[1])
+
+
+def drop_response(agent_state: AgentState, *nodes: str):
+    with _held_lock:
+        for node in nodes:
+            _held.pop((agent_state.get('run_id'), node), None)
+
+
+def drop_run_responses(run_id: str):
+    """
+    forget the responses the run still holds when it ends: stopped at max steps or failed before its critic
+    """
+    with _held_lock:
+        for key in [key for key in _held if key[0] == run_id]:
+            del _held[key]
+
+
+def evict_cache(max_entries: int = None):
+    """
+    drop expired responses, then the oldest ones above max_entries. both go by the age since the write, as
+    cache_get does: an entry is never touched after its write, so its mtime is its created_at
+    """
+    max_entries = LLM_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+    entries = []
+    for path in get_cache_dir().glob('*/*.json'):
+        mtime = path.stat().st_mtime
+        if LLM_CACHE_TTL and time.time() - mtime > LLM_CACHE_TTL:
+            path.unlink(missing_ok=True)
+        else:
+            entries.append((mtime, path))
+    entries.sort()
+    for _, path in entries[:max(0, len(entries) - max_entries)]:
+        path.unlink(missing_ok=True)
+
+
+def record_fixture(node: str, key: str, query: str, contents, text: str):
+    """
+    keep a real response per node, addressed by the prompt hash and, as a fallback for prompts that
+    carry live numbers, by the query
+    """
+    path = get_fixture_dir() / node
+    path.mkdir(exist_ok=True)
+    fixture = {'node': node, 'query': query, 'contents': contents, 'text': text}
+    write_json_atomic(path / f'{key}.json', fixture)
+    write_json_atomic(path / f'{query_key(node, query)}.json', fixture)
+
+
+def replay_fixture(node: str, key: str, query: str) -> str:
+    path = get_fixture_dir() / node
+    fixture = load_json(path / f'{key}.json') or load_json(path / f'{query_key(node, query)}.json')
+    if fixture is None:
+        raise KeyError(f'no recorded {node} response for query "{query}", record it with mode="record" first')
+    return fixture['text']
+
+
+def generate(node: str, contents, agent_state: AgentState, gen_config=None, attempt: int = 0) -> str:
+    """
+    text response of the LLM for a node, depending on AgentState['mode']:
+    - test: the canned response of gemini_response
+    - scripted: a response built from the query and the state by scripted_llm, no network
+    - replay: the response recorded for the node, no network
+    - record: a live response, saved as a fixture
+    - gemini: a live response, served from the disk cache when the same model, prompt and config were seen.
+      a live response is only cached once the run accepts it, see accept_response
+    :param node: planner, answer or critic
+    :param contents: prompt contents
+    :param agent_state:
+    :param gen_config: GenerateContentConfig, or a function building it, only called when the llm is used
+    :param attempt: 0 for the first call of the node, a retry neither reads nor fills the cache
+    :return:
+    """
+    with span(f'llm_{node}', 'llm'):
+        text, usage = _generate(node, contents, agent_state, gen_config, attempt)
+        count_llm(contents, text, usage)
+    return text
+
+
+def count_llm(contents, text: str, usage=None):
+    """
+    token counts of the usage metadata of a live response, estimated from the text otherwise
+    """
+    count('llm_calls')
+    prompt_tokens = getattr(usage, 'prompt_token_count', None)
+    response_tokens = getattr(usage, 'candidates_token_count', None)
+    count('llm_prompt_tokens', prompt_tokens if prompt_tokens is not None else estimate_tokens(contents))
+    count('llm_response_tokens', response_tokens if response_tokens is not None else estimate_tokens(text))
+
+
+def offline_response(node: str, agent_state: AgentState) -> tuple:
+    """
+    text and simulated latency of a test or scripted mode response
+    """
+    if agent_state['mode'] == 'scripted':
+        return scripted_response(node, agent_state)
+    return response[node], TEST_LLM_LATENCY
+
+
+def _generate(node: str, contents, agent_state: AgentState, gen_config=None, attempt: int = 0):
+    mode = agent_state['mode']
+    if mode in ['test', 'scripted']:
+        text, latency = offline_response(node, agent_state)
+        if latency:
+            rate_limiter.acquire()
+            time.sleep(latency)
+        return text, None
+    if callable(gen_config):
+        gen_config = gen_config()
+    key = cache_key(MODEL, contents, gen_config)
+    if mode == 'replay':
+        return replay_fixture(node, key, agent_state.get('query', '')), None
+
+    if LLM_CACHE_ENABLED and mode != 'record' and attempt == 0:
+        text = cache_get(key)
+        if text is not None:
+            logger.info(f'{node} response served from the llm cache')
+            return text, None
+    llm_response = generate_content(contents, gen_config)
+    text = llm_response.text
+    if mode == 'record':
+        record_fixture(node, key, agent_state.get('query', ''), contents, text)
+    hold_response(agent_state, node, key, text, attempt)
+    return text, llm_response.usage_metadata
+
+
+def _chunks(text: str, size: int = 40):
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+def generate_stream(node: str, contents, agent_state: AgentState, gen_config=None, attempt: int = 0):
+    """
+    same as generate, but yields the text as it arrives.
+    canned, replayed and cached responses are yielded in small chunks so streaming consumers behave the same
+    """
+    text, stream = '', _generate_stream(node, contents, agent_state, gen_config, attempt)
+    usage = None
+    try:
+        for chunk, usage in stream:
+            text += chunk
+            yield chunk
+    finally:
+        # a stream closed early by the consumer still cost its tokens
+        stream.close()
+        count_llm(contents, text, usage)
+
+
+def _generate_stream(node: str, contents, agent_state: AgentState, gen_config=None, attempt: int = 0):
+    mode = agent_state['mode']
+    if mode in ['test', 'scripted']:
+        text, latency = offline_response(node, agent_state)
+        if latency:
+            rate_limiter.acquire()
+        chunks = list(_chunks(text))
+        for chunk in chunks:
+            if latency:
+                time.sleep(latency / len(chunks))
+            yield chunk, None
+        return
+    if callable(gen_config):
+        gen_config = gen_config()
+    key = cache_key(MODEL, contents, gen_config)
+    if mode == 'replay':
+        for chunk in _chunks(replay_fixture(node, key, agent_state.get('query', ''))):
+            yield chunk, None
+        return
+
+    if LLM_CACHE_ENABLED and mode != 'record' and attempt == 0:
+        text = cache_get(key)
+        if text is not None:
+            logger.info(f'{node} response served from the llm cache')
+            for chunk in _chunks(text):
+                yield chunk, None
+            return
+    text = ''
+    for llm_chunk in generate_content_stream(contents, gen_config):
+        if llm_chunk.text:
+            text += llm_chunk.text
+            # the usage metadata of the last chunk covers the whole response
+            yield llm_chunk.text, llm_chunk.usage_metadata
+    if mode == 'record':
+        record_fixture(node, key, agent_state.get('query', ''), contents, text)
+    hold_response(agent_state, node, key, text, attempt)
@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+from src.graph.artifacts import artifact_meta
+from src.graph.catalog import connect, get_catalog_path, transaction
+from src.graph.logger import get_logger
+from src.graph.profiling import count
+
+logger = get_logger('metric_cache')
+
+METRIC_CACHE_ENABLED = os.getenv('AGENTFLOW_METRIC_CACHE', '1') != '0'
+# tickers per lookup query, below the sqlite limit of bound parameters
+LOOKUP_CHUNK = 400
+
+# metric values computed from a price artifact, shared by the runs and the worker processes through the catalog
+# database. an entry is keyed by the last price date and the content fingerprint of the artifact it was computed
+# from (its sidecar, see artifacts.write_meta): new bars give a new key, and the entries they supersede are deleted
+METRIC_SCHEMA = """
+create table if not exists metric_cache (
+    ticker text not null,
+    metric text not null,
+    period text not null,
+    last_date text not null,
+    fingerprint text not null,
+    value real,
+    created_at real,
+    primary key (ticker, metric, period, last_date, fingerprint)
+);
+"""
+
+_stats = {'hits': 0, 'misses': 0, 'puts': 0, 'invalidated': 0}
+_lock = threading.Lock()
+# catalog files this process has created the table in
+_schema_created = set()
+
+
+def metric_connection():
+    """
+    catalog connection with the metric_cache table, created once per process and catalog file
+    """
+    connection = connect()
+    path = str(get_catalog_path())
+    if path not in _schema_created:
+        connection.executescript(METRIC_SCHEMA)
+        with _lock:
+            _schema_created.add(path)
+    return connection
+
+
+def split_key(key: str) -> tuple:
+    """
+    return_1y -> (return, 1y)
+    """
+    metric, period = key.rsplit('_', 1)
+    return metric, period
+
+
+def get_metrics(paths: dict, keys: list) -> dict:
+    """
+    cached values of the metric keys of the tickers, looked up by the sidecar of each price artifact,
+    the artifacts themselves are not read
+    :param paths: ticker -> price artifact
+    :param keys: metric keys, e.g. ['return_1y', 'vol_1y']
+    :return: ticker -> {key: value} of the hits, tickers without a hit are left out
+    """
+    if not METRIC_CACHE_ENABLED or not paths:
+        return {}
+    metas = {ticker: artifact_meta(path) for ticker, path in paths.items()}
+    split = [split_key(key) for key in keys]
+    metrics = sorted({metric for metric, _ in split})
+    periods = sorted({period for _, period in split})
+    hits = {}
+    tickers = list(metas)
+    for start in range(0, len(tickers), LOOKUP_CHUNK):
+        chunk = tickers[start:start + LOOKUP_CHUNK]
+        rows = metric_connection().execute(
+            f'select * from metric_cache where ticker in ({", ".join("?" * len(chunk))}) '
+            f'and metric in ({", ".join("?" * len(metrics))}) and period in ({", ".join("?" * len(periods))})',
+            chunk + metrics + periods).fetchall()
+        for row in rows:
+            meta = metas[row['ticker']]
+            key = f'{row["metric"]}_{row["period"]}'
+            if key in keys and row['last_date'] == meta['last_date'] and row['fingerprint'] == meta['fingerprint']:
+                hits.setdefault(row['ticker'], {})[key] = row['value']
+    n_hits = sum(len(values) for values in hits.values())
+    n_misses = len(paths) * len(keys) - n_hits
+    with _lock:
+        _stats['hits'] += n_hits
+        _stats['misses'] += n_misses
+    count('metric_cache_hits', n_hits)
+    count('metric_cache_misses', n_misses)
+    return hits
+
+
+def put_metrics(paths: dict, values: dict):
+    """
+    cache computed metric values, the entries of the same ticker, metric and period computed from
+    older prices are deleted
+    :param paths: ticker -> price artifact the values were computed from
+    :param values: ticker -> {key: value}
+    """
+    if not METRIC_CACHE_ENABLED or not values:
+        return
+    rows = []
+    for ticker, ticker_values in values.items():
+        meta = artifact_meta(paths[ticker])
+        for key, value in ticker_values.items():
+            metric, period = split_key(key)
+            rows.append((ticker, metric, period, meta['last_date'], meta['fingerprint'], value))
+    now = time.time()
+    metric_connection()
+    with transaction() as connection:
+        invalidated = 0
+        for ticker, metric, period, last_date, _, _ in rows:
+            invalidated += connection.execute(
+                'delete from metric_cache where ticker = ? and metric = ? and period = ? and last_date < ?',
+                (ticker, metric, period, last_date)).rowcount
+        connection.executemany('insert or replace into metric_cache (ticker, metric, period, last_date, fingerprint, '
+                               'value, created_at) values (?, ?, ?, ?, ?, ?, ?)',
+                               [row + (now,) for row in rows])
+    with _lock:
+        _stats['puts'] += len(rows)
+        _stats['invalidated'] += invalidated
+
+
+def metric_cache_stats() -> dict:
+    """
+    hits and misses of this process, with the hit rate, and the entries of the shared cache
+    """
+    with _lock:
+        stats = dict(_stats)
+    asked = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / asked if asked else None
+    stats['entries'] = metric_connection().execute('select count(*) from metric_cache').fetchone()[0]
+    return stats
+
+
+def clear_metric_cache():
+    with transaction() as connection:
+        connection.execute('delete from metric_cache')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='metric cache shared by the runs')
+    parser.add_argument('command', choices=['stats', 'clear'])
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        print(json.dumps(metric_cache_stats(), indent=2))
+    else:
+        metric_connection()
+        clear_metric_cache()
+        logger.info('metric cache cleared')
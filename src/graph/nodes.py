@@ -1,34 +1,58 @@
-from src.graph.tools import PLAN_TOOL_NAME_MAP, TOOLS_REGISTRY, tool_names, plan_tools
+from src.graph.tools import PLAN_TOOL_NAME_MAP, tool_names, plan_tools
+from src.graph.llm import generate, generate_stream, get_config, accept_response, drop_response, drop_run_responses
+from src.graph.scheduler import run_step, run_wave, next_pending, pending_fetches, run_fetch_batch
 from src.graph.state import AgentState
-from src.graph.util import get_next_run_id, save_state, gemini_json
+from src.graph.util import get_next_run_id, gemini_json
+from src.graph.checkpoint import save_state, record_update, close_journal, state_reducers
 from src.graph.logger import get_logger
-from src.graph.gemini_response import response
-from src.graph.validation import check_plans
-from dotenv import load_dotenv
-from google.genai import types
-from google import genai
-import os
-
-load_dotenv()
+from src.graph.profiling import profiled, span
+from src.graph.validation import check_plans, optimize_plans, FETCH_ACTIONS
+from src.graph.plan_cache import plan_from_template, save_plan_template
+from src.graph.streaming import get_sink, stream_answer
+from src.graph.coverage import check_coverage, PRECRITIC_ENABLED
+from src.graph.charts import has_pending_charts, collect_charts
+from src.graph.catalog import record_hop, set_status
+from src.graph.context import render_context, context_results, render_plan_feedback
+from src.graph.reducers import stamp_writes, trim_traces
+from src.graph.prefetch import start_prefetch, finish_prefetch
 
 logger = get_logger('nodes')
 
-api_key = os.getenv('GEMINI_API_KEY')
-client = genai.Client(api_key=api_key)
-config = types.GenerateContentConfig(tools=plan_tools, automatic_function_calling={"disable": True})
-
+# node steps of an invoke before the run is stopped, AgentState['max_steps'] overrides it
 MAX_STEPS = 20
+# channels with a reducer, their values in a node update are stamped with its write id
+REDUCER_KEYS = list(state_reducers())
+
+
+def run_failed(agent_state: AgentState):
+    """
+    a node or the router raised: the journal of the run is closed and the catalog has the run as failed, so it is
+    not left running (its artifacts pinned in the price store, out of reach of gc) whoever invoked the graph
+    """
+    run_id = agent_state.get('run_id')
+    close_journal(run_id)
+    drop_run_responses(run_id)
+    if run_id:
+        set_status(run_id, 'failed')
 
 
 def status_update(node_func):
+    node_func = profiled('node')(node_func)
+
     def wrapper(agent_state: AgentState):
-        result = node_func(agent_state)
+        try:
+            result = node_func(agent_state)
+        except BaseException:
+            run_failed(agent_state)
+            raise
         nsteps = agent_state.get('nsteps', 0)
         nsteps += 1
         call_stack = [node_func.__name__]
-        return {**result,
-                'nsteps': nsteps,
-                'call_stack': call_stack}
+        update = stamp_writes(trim_traces(agent_state, {**result,
+                                                        'nsteps': nsteps,
+                                                        'call_stack': call_stack}), REDUCER_KEYS)
+        record_update(agent_state, node_func.__name__, update)
+        return update
 
     return wrapper
 
@@ -42,8 +66,15 @@ def planner(agent_state: AgentState) -> dict:
     if len(query) == 0:
         raise ValueError('Please input query')
     logger.info(f'query: {query}')
+    plans = plan_from_template(query, agent_state.get('mode'))
+    if plans is not None:
+        logger.info(f'plans:\n{plans}')
+        return {'plans': plans,
+                'next_plan_index': 0,
+                'execution_status': ['plan reused from a plan template, planner llm skipped']}
     max_trials = 3
     n_trials = 0
+    tried = []
     while not plan_checked:
         prompt = f"""
                     You are an AI assistant who makes plans.
@@ -64,7 +95,7 @@ def planner(agent_state: AgentState) -> dict:
                     Query:
                     "{query}"
 
-                    Previous plan:
+                    Previous plan, one step per line, steps flagged by the validation marked with !:
                     {previous_plan}
 
                     validation failure on previous plan:
@@ -73,27 +104,69 @@ def planner(agent_state: AgentState) -> dict:
                     Return ONLY JSON, no text or explanation.
     """
 
-        if agent_state['mode'] =='test':
-            gemini_response = response['planner']
-        else:
-            plan_response = client.models.generate_content(model='gemini-2.5-flash',
-                                                           contents=[prompt],
-                                                           config=config)
-            gemini_response = plan_response.text
-        plans = gemini_json(gemini_response)
+        gemini_response = generate('planner', [prompt], agent_state, get_config, attempt=n_trials)
+        plans, changes = optimize_plans(gemini_json(gemini_response))
+        plan_changes = [f'plan optimizer: {change}' for change in changes]
         plan_check_msg = check_plans(plans)
         if len(plan_check_msg)==0:
             plan_checked=True
+            # the plan passed validation, its response can be served to the same prompt
+            accept_response(agent_state, 'planner')
             break
+        drop_response(agent_state, 'planner')
+        previous_plan = render_plan_feedback(plans, plan_check_msg, tried)
+        tried.append(plans)
         n_trials +=1
         if n_trials>max_trials:
             break
     if not plan_checked: raise RuntimeError(f'plan {plans} failed validation due to {plan_check_msg}')
     logger.info(f'plans:\n{plans}')
+    save_plan_template(query, plans, agent_state.get('mode'))
     return {'plans': plans,
-            'next_plan_index': 0}
+            'next_plan_index': 0,
+            'execution_status': plan_changes}
+
+
+def with_charts(update: dict, agent_state: AgentState) -> dict:
+    """
+    charts rendered off the executor are collected before the answer, their paths go into execution_result and
+    their final status into execution_status.
+    the price prefetch of the run is closed, its stats go into prefetch_stats
+    """
+    run_id = agent_state['run_id']
+    if has_pending_charts(run_id):
+        with span('collect_charts', 'charts'):
+            update = {**update, **collect_charts(run_id)}
+    prefetch_stats = finish_prefetch(run_id, agent_state.get('data'))
+    if prefetch_stats is not None:
+        update = {**update, 'prefetch_stats': prefetch_stats}
+    return update
+
+
+def journaled(route_func):
+    """
+    journal the update of the router, which is not a step: the charts it collects and the prefetch stats.
+    the journal of the run is closed and the llm responses it still holds dropped when the run ends or fails
+    """
+    route_func = profiled('router')(route_func)
+
+    def wrapper(agent_state: AgentState):
+        try:
+            update = route_func(agent_state)
+        except BaseException:
+            run_failed(agent_state)
+            raise
+        update = stamp_writes(update, REDUCER_KEYS)
+        record_update(agent_state, route_func.__name__, update)
+        if update.get('next_node') == 'END':
+            close_journal(agent_state['run_id'])
+            drop_run_responses(agent_state['run_id'])
+        return update
+
+    return wrapper
 
 
+@journaled
 def router(agent_state: AgentState) -> dict:
     """
     direct the current plan to the executor node or some other node
@@ -110,14 +183,18 @@ def router(agent_state: AgentState) -> dict:
         agent_state['run_id']= run_id
     
     #depends on run_id and mode
-    save_state(agent_state)
+    with span('save_state', 'checkpoint'):
+        save_state(agent_state)
+    record_hop(agent_state, 'running')
 
-    if agent_state.get('nsteps', 0) > MAX_STEPS:
-        return {'next_node': 'END'}
+    if agent_state.get('nsteps', 0) > (agent_state.get('max_steps') or MAX_STEPS):
+        record_hop(agent_state, 'stopped')
+        return with_charts({'next_node': 'END'}, agent_state)
 
     critic_status = agent_state.get('critic_result', {}).get('status')
     if critic_status == 'ok':
-        return {'next_node': 'END'}
+        record_hop(agent_state, 'done')
+        return with_charts({'next_node': 'END'}, agent_state)
     elif critic_status == 'retry':
         return {'next_node': 'answer'}
     plans = agent_state.get('plans')
@@ -133,8 +210,10 @@ def router(agent_state: AgentState) -> dict:
             else:
                 raise NotImplementedError(f'unknow tool name {tool_name}')
         else:  # when the plan from the planner is executed, we move to answer
-            return {'next_node': 'answer'}
+            return with_charts({'next_node': 'answer'}, agent_state)
     else:
+        # the likely prices are fetched while the planner llm runs
+        start_prefetch(agent_state)
         return {'next_node': 'planner',
                 'run_id':run_id}
 
@@ -142,24 +221,27 @@ def router(agent_state: AgentState) -> dict:
 @status_update
 def executor(agent_state: AgentState) -> dict:
     """
-    executor the current plan
+    executor the current plan step, or with executor_mode='parallel' every step whose data is ready
     :param agent_state:
     :return:
     """
+    if agent_state.get('executor_mode') == 'parallel':
+        return run_wave(agent_state)
+
     next_plan_index = agent_state['next_plan_index']
     plans = agent_state.get('plans')
+    completed = set(agent_state.get('completed_steps') or [])
 
-    next_step = plans[next_plan_index]
-    action = next_step['action']
-    tool_name = PLAN_TOOL_NAME_MAP.get(action)
-    tool_func = TOOLS_REGISTRY[tool_name]
-    kwargs = next_step['params'].copy()
-    kwargs['agent_state'] = agent_state
-    logger.info(f'executing plan: {next_step}')
-    result = tool_func(**kwargs)
-    next_plan_index = next_plan_index + 1
+    done = [next_plan_index]
+    if agent_state.get('batch_fetch') and plans[next_plan_index]['action'] in FETCH_ACTIONS:
+        done = pending_fetches(plans, completed)
+        result = run_fetch_batch(plans, done, agent_state)
+    else:
+        result = run_step(plans[next_plan_index], agent_state)
+    completed.update(done)
     return {**result,
-            'next_plan_index': next_plan_index,
+            'completed_steps': done,
+            'next_plan_index': next_pending(plans, completed, next_plan_index + 1),
             }
 
 
@@ -167,6 +249,7 @@ def executor(agent_state: AgentState) -> dict:
 def answer(agent_state: AgentState) -> dict:
     query = agent_state.get('query')
     execution_result = agent_state.get('execution_result',{})
+    context = render_context(execution_result, query)
 
     retry = agent_state.get('critic_result',{}).get('status') =='retry'
     if retry:
@@ -186,7 +269,7 @@ def answer(agent_state: AgentState) -> dict:
                     "{query}"
 
                     Context:
-                    {execution_result}
+                    {context}
 
                     Reason for retry:
                     {reason}
@@ -208,24 +291,55 @@ def answer(agent_state: AgentState) -> dict:
                     "{query}"
 
                     Context:
-                    {execution_result}
+                    {context}
 
         """
-    if agent_state['mode'] == 'test':
-        draft_answer = response['answer']
+    answer_stream = None
+    if agent_state.get('stream_answer') or get_sink(agent_state['run_id']) is not None:
+        draft_answer, answer_stream = stream_answer(generate_stream('answer', prompt, agent_state, attempt=int(retry)),
+                                                    agent_state, context_results(execution_result, query))
+        logger.info(f'answer streamed, first token after {answer_stream["first_token_s"]}s')
     else:
-        answer_response = client.models.generate_content(model='gemini-2.5-flash',
-                                                         contents=prompt)
-        draft_answer = answer_response.text
+        draft_answer = generate('answer', prompt, agent_state, attempt=int(retry))
 
     logger.info(f'draft answer: {draft_answer}')
-    return {'draft_answer': draft_answer}
+    return {'draft_answer': draft_answer,
+            'answer_stream': answer_stream}
 
 
 @status_update
 def critic(agent_state: AgentState) -> dict:
     query = agent_state['query']
     draft_answer = agent_state['draft_answer']
+    missing = (agent_state.get('answer_stream') or {}).get('missing')
+    if missing:
+        # the coverage was checked while the answer streamed, no need to ask the llm
+        critic_result = {'status': 'retry', 'reason': f'the answer does not address: {", ".join(missing)}',
+                         'source': 'stream'}
+        logger.info(f'{critic_result}')
+        drop_response(agent_state, 'answer')
+        return {'critic_result': critic_result,
+                'final_answer': None}
+    unclear = ''
+    if PRECRITIC_ENABLED:
+        coverage = check_coverage(draft_answer, context_results(agent_state.get('execution_result', {}), query))
+        if coverage['status'] != 'unclear':
+            # mechanical coverage decided it, the llm critic is skipped
+            critic_result = {'status': coverage['status'], 'reason': coverage['reason'], 'source': 'precheck'}
+            logger.info(f'{critic_result}')
+            if coverage['status'] == 'ok':
+                accept_response(agent_state, 'answer')
+            else:
+                drop_response(agent_state, 'answer')
+            return {'critic_result': critic_result,
+                    'final_answer': draft_answer if coverage['status'] == 'ok' else None}
+        unclear = f"""
+                3. check the numbers of the draft answer against the context, these could not be matched:
+                {coverage['reason']}
+
+                Context:
+                {render_context(agent_state.get('execution_result', {}), query)}
+    """
     prompt = f"""
                 You are a critic.
 
@@ -234,6 +348,7 @@ def critic(agent_state: AgentState) -> dict:
                 check:
                 1. whether the answer addresses the query
                 2. check the scope, e.g., are all the tickers addressed in the draft answer, any missing metrics (returns, vols etc)
+                {unclear}
 
                 Return ONLY valid JSON with this exact shape:
                 {{critic_result: {{
@@ -249,18 +364,20 @@ def critic(agent_state: AgentState) -> dict:
                 {draft_answer}
 
     """
-    if agent_state['mode'] == 'test':
-        draft_response = response['critic']
-    else:
-        answer_response = client.models.generate_content(model='gemini-2.5-flash',
-                                                         contents=prompt)
-        draft_response = answer_response.text
+    # the draft is an answer the critic sent back before
+    retry = agent_state.get('critic_result', {}).get('status') == 'retry'
+    draft_response = generate('critic', prompt, agent_state, attempt=int(retry))
     critic_result = gemini_json(draft_response)
     status = critic_result["critic_result"].get("status", "").lower()
     critic_result["critic_result"]["status"] = status
+    critic_result["critic_result"]["source"] = 'llm'
     logger.info(f'{critic_result}')
     final_answer = None
     if status == 'ok':
         final_answer = agent_state['draft_answer']
+        accept_response(agent_state, 'answer', 'critic')
+    else:
+        # neither the rejected answer nor the retry verdict is served to the same prompt again
+        drop_response(agent_state, 'answer', 'critic')
     return {**critic_result,
             'final_answer': final_answer}
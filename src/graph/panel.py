@@ -0,0 +1,152 @@
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.graph.artifacts import read_series, write_artifact, artifact_suffix
+from src.graph.logger import get_logger
+from src.graph.util import get_data_dir, period_delta
+
+logger = get_logger('panel')
+
+# panels kept in memory per process, a run usually builds one or two
+PANEL_CACHE_SIZE = 8
+TRADING_DAYS = 252
+
+# dates: sorted DatetimeIndex, tickers: column order, prices: C-contiguous float64 (dates x tickers), nan where
+# a ticker has no close on a date
+Panel = namedtuple('Panel', ['dates', 'tickers', 'prices'])
+
+_panels = OrderedDict()
+_lock = threading.Lock()
+
+
+def panel_key(tickers: list, paths: list) -> str:
+    """
+    the panel is identified by its tickers and the price artifacts it is built from, price store
+    artifacts are content-addressed so a top-up gives a new key
+    """
+    parts = [f'{ticker}={path}:{Path(path).stat().st_mtime_ns}' for ticker, path in zip(tickers, paths)]
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()[:16]
+
+
+def get_panel_path(key: str, run_id: str):
+    path = get_data_dir() / run_id
+    path.mkdir(parents=True, exist_ok=True)
+    return path / f'panel-{key}{artifact_suffix()}'
+
+
+def build_panel(tickers: list, agent_state: dict) -> Panel:
+    """
+    date-aligned price matrix of the tickers from their artifacts in AgentState['data'], built once:
+    kept in memory and written as data/<run_id>/panel-<key> for the next steps and processes of the run
+    """
+    from src.graph.tools import price_path
+    paths = [str(price_path(ticker, agent_state)) for ticker in tickers]
+    key = panel_key(tickers, paths)
+    with _lock:
+        if key in _panels:
+            _panels.move_to_end(key)
+            return _panels[key]
+    path = get_panel_path(key, agent_state['run_id'])
+    if path.exists():
+        frame = read_series(path)
+        frame = frame.to_frame(tickers[0]) if isinstance(frame, pd.Series) else frame
+    else:
+        frame = pd.concat({ticker: read_series(path) for ticker, path in zip(tickers, paths)}, axis=1).sort_index()
+        write_artifact(path, frame)
+    panel = Panel(frame.index, list(tickers), np.ascontiguousarray(frame.to_numpy(dtype=np.float64)))
+    with _lock:
+        _panels[key] = panel
+        while len(_panels) > PANEL_CACHE_SIZE:
+            _panels.popitem(last=False)
+    logger.info(f'price panel of {len(tickers)} tickers x {len(panel.dates)} dates')
+    return panel
+
+
+def window(panel: Panel, period: str) -> np.ndarray:
+    """
+    rows of the panel within the period before its last date
+    """
+    start = panel.dates[-1] - period_delta(period)
+    return panel.prices[panel.dates.searchsorted(start, side='left'):]
+
+
+def daily_returns(prices: np.ndarray) -> np.ndarray:
+    """
+    simple returns between consecutive rows, nan where either close is missing
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return prices[1:] / prices[:-1] - 1
+
+
+def pairwise_cov(returns: np.ndarray) -> tuple:
+    """
+    annualized covariance and correlation of every pair of columns over the rows both have a return
+    (pairwise-complete), from a handful of matrix products instead of a loop over pairs
+    :return: covariance, correlation, number of common returns, all n_tickers x n_tickers
+    """
+    observed = ~np.isnan(returns)
+    x = np.where(observed, returns, 0.0)
+    m = observed.astype(np.float64)
+    n = m.T @ m
+    # sums[i, j]: sum of the returns of i on the rows j has a return too
+    sums = x.T @ m
+    squares = (x * x).T @ m
+    products = x.T @ x
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = (products - sums * sums.T / n) / (n - 1)
+        var = (squares - sums * sums / n) / (n - 1)
+        corr = cov / np.sqrt(var * var.T)
+    cov[n < 2] = np.nan
+    corr[n < 2] = np.nan
+    return cov * TRADING_DAYS, np.clip(corr, -1, 1), n
+
+
+def betas(returns: np.ndarray, benchmark: int) -> np.ndarray:
+    """
+    beta of every column against the benchmark column, pairwise-complete
+    """
+    observed = ~np.isnan(returns)
+    both = observed & observed[:, [benchmark]]
+    x = np.where(both, returns, 0.0)
+    b = np.where(both, returns[:, [benchmark]], 0.0)
+    n = both.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = ((x * b).sum(axis=0) - x.sum(axis=0) * b.sum(axis=0) / n) / (n - 1)
+        var = ((b * b).sum(axis=0) - b.sum(axis=0) ** 2 / n) / (n - 1)
+        return np.where(n >= 2, cov / var, np.nan)
+
+
+def max_drawdowns(prices: np.ndarray) -> np.ndarray:
+    """
+    largest fall from a running peak of every column, as a negative fraction, missing closes skipped
+    """
+    peaks = np.fmax.accumulate(prices, axis=0)
+    with np.errstate(invalid='ignore'):
+        return np.nanmin(prices / peaks - 1, axis=0)
+
+
+def portfolio_vol(cov: np.ndarray, weights: np.ndarray) -> float:
+    """
+    annualized vol of the weighted portfolio, pairs without common returns count as uncorrelated
+    """
+    cov = np.where(np.isnan(cov), 0.0, cov)
+    return float(np.sqrt(max(weights @ cov @ weights, 0.0)))
+
+
+def ranked_pairs(corr: np.ndarray, tickers: list, k: int) -> tuple:
+    """
+    the k most and the k least correlated pairs, from the upper triangle without a loop over pairs
+    :return: lists of [ticker, ticker, correlation], highest first and lowest first
+    """
+    rows, cols = np.triu_indices(len(tickers), k=1)
+    values = corr[rows, cols]
+    valid = ~np.isnan(values)
+    rows, cols, values = rows[valid], cols[valid], values[valid]
+    order = np.argsort(values)
+    pairs = lambda index: [[tickers[rows[i]], tickers[cols[i]], round(float(values[i]), 4)] for i in index]
+    return pairs(order[::-1][:k]), pairs(order[:k])
@@ -0,0 +1,171 @@
+import json
+import os
+import re
+import threading
+import time
+
+from src.graph.logger import get_logger
+from src.graph.query import ticker_spans, period_spans, extract_tickers, extract_periods
+from src.graph.util import get_data_dir, file_lock, load_json, write_json_atomic
+from src.graph.validation import check_plans, optimize_plans, plan_tickers
+
+logger = get_logger('plan_cache')
+
+PLAN_TEMPLATES_ENABLED = os.getenv('AGENTFLOW_PLAN_TEMPLATES', '1') != '0'
+# templates kept over all modes, the least recently used are dropped when a new one is added
+PLAN_TEMPLATES_MAX = int(os.getenv('AGENTFLOW_PLAN_TEMPLATES_MAX', 1000))
+SLOT_PATTERN = re.compile(r'\{[TP]\d+\}')
+
+# the template file as last read by this process, by mtime, and the last use of the templates it reused.
+# a hit is not written back, the last uses are folded into the file when a template is added
+_loaded = (None, {})
+_used = {}
+_lock = threading.Lock()
+
+
+def get_template_path():
+    return get_data_dir() / '_plan_templates.json'
+
+
+def template_namespace(mode: str) -> str:
+    """
+    templates are kept per mode and model: a plan of the canned or scripted responses is never replayed live
+    """
+    from src.graph.llm import MODEL
+    return f'{mode or "test"}/{MODEL}'
+
+
+def load_templates() -> dict:
+    """
+    namespace -> template -> entry, read again only when the file changed
+    """
+    global _loaded
+    path = get_template_path()
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with _lock:
+        if _loaded[0] != mtime:
+            templates = load_json(path, default={})
+            # entries of the flat file written before the templates were kept per mode are dropped
+            _loaded = (mtime, {namespace: entries for namespace, entries in templates.items()
+                               if isinstance(entries, dict) and 'plans' not in entries})
+        return _loaded[1]
+
+
+def query_template(query: str):
+    """
+    the query with its tickers replaced by {T0}, {T1}.. and its periods by {P0}, {P1}.., in order of first appearance
+    :return: template string, tickers, periods
+    """
+    tickers = extract_tickers(query)
+    periods = extract_periods(query)
+    spans = [(start, end, '{T%d}' % tickers.index(ticker)) for start, end, ticker in ticker_spans(query)]
+    spans += [(start, end, '{P%d}' % periods.index(period)) for start, end, period in period_spans(query)]
+    template, position = '', 0
+    for start, end, slot in sorted(spans):
+        if start < position:
+            continue
+        template += query[position:start].lower() + slot
+        position = end
+    template += query[position:].lower()
+    return ' '.join(template.split()), tickers, periods
+
+
+def _abstract(value, slots: dict):
+    if isinstance(value, list):
+        return [_abstract(v, slots) for v in value]
+    return slots.get(value, value)
+
+
+def abstract_plans(plans: list, tickers: list, periods: list):
+    """
+    replace tickers and periods of the plan by the slots of the query template,
+    None when the plan uses a ticker that is not in the query
+    """
+    ticker_slots = {ticker: '{T%d}' % i for i, ticker in enumerate(tickers)}
+    period_slots = {period: '{P%d}' % i for i, period in enumerate(periods)}
+    abstract = []
+    for plan in plans:
+        if any(ticker not in ticker_slots for ticker in plan_tickers(plan)):
+            return None
+        params = {}
+        for name, value in plan['params'].items():
+            if name in ['ticker', 'tickers', 'benchmark']:
+                params[name] = _abstract(value, ticker_slots)
+            elif name in ['period', 'periods']:
+                params[name] = _abstract(value, period_slots)
+            else:
+                params[name] = value
+        abstract.append({'action': plan['action'], 'params': params})
+    return abstract
+
+
+def fill_plans(abstract: list, tickers: list, periods: list) -> list:
+    slots = {'{T%d}' % i: ticker for i, ticker in enumerate(tickers)}
+    slots.update({'{P%d}' % i: period for i, period in enumerate(periods)})
+    return [{'action': plan['action'],
+             'params': {name: _abstract(value, slots) for name, value in plan['params'].items()}}
+            for plan in abstract]
+
+
+def plan_from_template(query: str, mode: str = None):
+    """
+    plan of a structurally identical earlier query of the same mode and model with this query's tickers and
+    periods filled in, None when no template matches or the filled plan does not validate
+    """
+    if not PLAN_TEMPLATES_ENABLED:
+        return None
+    template, tickers, periods = query_template(query)
+    namespace = template_namespace(mode)
+    entry = load_templates().get(namespace, {}).get(template)
+    if entry is None:
+        return None
+    with _lock:
+        _used[(namespace, template)] = time.time()
+    plans = fill_plans(entry['plans'], tickers, periods)
+    if SLOT_PATTERN.search(json.dumps(plans)):
+        # the template has more slots than this query has tickers or periods
+        return None
+    # a fetch period kept literal in the template must still cover the periods filled into the later steps
+    plans, _ = optimize_plans(plans)
+    plan_check_msg = check_plans(plans)
+    if len(plan_check_msg) > 0:
+        logger.info(f'plan template for "{template}" failed validation: {plan_check_msg}')
+        return None
+    logger.info(f'plan reused from template "{template}"')
+    return plans
+
+
+def save_plan_template(query: str, plans: list, mode: str = None):
+    """
+    keep a validated plan as the template of the query shape for the mode, the file is only written when a
+    template is added: the last uses of this process are folded in and the least recently used templates
+    above PLAN_TEMPLATES_MAX are dropped
+    """
+    if not PLAN_TEMPLATES_ENABLED:
+        return
+    template, tickers, periods = query_template(query)
+    abstract = abstract_plans(plans, tickers, periods)
+    if abstract is None:
+        logger.info('plan not kept as template, it uses tickers outside of the query')
+        return
+    namespace = template_namespace(mode)
+    with file_lock(get_template_path().with_suffix('.lock')):
+        templates = {namespace: dict(entries) for namespace, entries in load_templates().items()}
+        with _lock:
+            used = dict(_used)
+            _used.clear()
+        for (used_namespace, used_template), last_used in used.items():
+            entry = templates.get(used_namespace, {}).get(used_template)
+            if entry is not None:
+                templates[used_namespace][used_template] = {**entry, 'last_used': max(entry['last_used'], last_used)}
+        templates.setdefault(namespace, {})[template] = {'plans': abstract, 'created_at': time.time(),
+                                                         'last_used': time.time()}
+        by_use = sorted((entry['last_used'], entry_namespace, entry_template)
+                        for entry_namespace, entry_templates in templates.items()
+                        for entry_template, entry in entry_templates.items())
+        for _, entry_namespace, entry_template in by_use[:max(0, len(by_use) - PLAN_TEMPLATES_MAX)]:
+            del templates[entry_namespace][entry_template]
+        write_json_atomic(get_template_path(), {key: value for key, value in templates.items() if value})
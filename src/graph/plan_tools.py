@@ -49,3 +49,47 @@ def plan_plot(ticker: str) -> dict:
     :param ticker: : str, e.g. AAPL, MSFT
     :return:
     """
+
+
+def plan_plot_multi(tickers: list) -> dict:
+    """
+    function used for llm planning, this function plots the stock prices of several tickers on one chart,
+    rebased to 100 at the start, use it when asked to compare the price charts of tickers
+    :param tickers: list of stock tickers, e.g. ["AAPL", "MSFT"]
+    :return:
+    """
+
+
+def plan_calculate_metrics(tickers: list,
+                           periods: list,
+                           metrics: list) -> dict:
+    """
+    function used for llm planning, this function calculates several metrics for several tickers
+    and periods in one step, prefer it over plan_calculate_return/plan_calculate_vol when more than
+    one ticker or period is asked about
+    :param tickers: list of stock tickers, e.g. ["AAPL", "MSFT"]
+    :param periods: list of time periods, for example ["1y", "3m"]
+    :param metrics: list of metrics, "return" (performance) and/or "vol" (risk)
+    :return:
+    """
+
+
+def plan_calculate_cross_asset(tickers: list,
+                               period: str,
+                               metrics: list,
+                               benchmark: str = None,
+                               weights: list = None) -> dict:
+    """
+    function used for llm planning, this function calculates cross-asset analytics of several tickers
+    over a time period in one step, use it when asked about:
+    - correlation/covariance between stocks, the most or least correlated ones
+    - beta against a benchmark, e.g. SPY
+    - max drawdown
+    - portfolio volatility/risk of several stocks together
+    :param tickers: list of stock tickers, e.g. ["AAPL", "MSFT", "NVDA"]
+    :param period: time period, for example 1y, 3m
+    :param metrics: list of "corr", "cov", "beta", "drawdown", "portfolio_vol"
+    :param benchmark: benchmark ticker, required for "beta", e.g. "SPY"
+    :param weights: portfolio weights in the order of tickers, equal weights when not given
+    :return:
+    """
@@ -0,0 +1,217 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.graph.artifacts import remove_artifact, move_artifact
+from src.graph.logger import get_logger
+from src.graph.profiling import count
+from src.graph.query import extract_tickers, extract_periods
+from src.graph.util import period_days, get_data_dir, get_price_data_path
+
+logger = get_logger('prefetch')
+
+# default of AgentState['prefetch']
+PREFETCH_DEFAULT = os.getenv('AGENTFLOW_PREFETCH', '0') != '0'
+# shortest period prefetched, plans usually fetch more history than the metric periods of the query
+PREFETCH_MIN_PERIOD = os.getenv('AGENTFLOW_PREFETCH_MIN_PERIOD', '2y')
+# a query naming more tickers than this is not prefetched
+PREFETCH_MAX_TICKERS = int(os.getenv('AGENTFLOW_PREFETCH_MAX_TICKERS', 50))
+# directory under data/<run_id> of the prefetched run artifacts (price store disabled), an artifact is moved
+# to its run path when a step takes it, so the prefetch never writes where a step does
+PREFETCH_DIR = 'prefetch'
+
+_pool = None
+_prefetches = {}
+_lock = threading.Lock()
+_totals = {'runs': 0, 'tickers': 0, 'hits': 0, 'misses': 0, 'wasted': 0, 'cancelled': 0, 'saved_s': 0.0}
+
+
+class Prefetch:
+    """
+    speculative price fetch of one run: the tickers and period guessed from the query, fetched in the background
+    """
+
+    def __init__(self, periods: dict, future):
+        self.periods = periods
+        self.future = future
+        self.started = time.perf_counter()
+        self.finished = None
+        self.used = set()
+        # time the steps spent waiting for the prefetch to finish
+        self.waited = 0.0
+        self.stats = {'tickers': len(periods), 'hits': 0, 'misses': 0, 'wasted': 0, 'cancelled': False,
+                      'saved_s': 0.0}
+
+    def done(self, _):
+        self.finished = time.perf_counter()
+
+
+def get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prefetch')
+        return _pool
+
+
+def is_enabled(agent_state: dict) -> bool:
+    enabled = agent_state.get('prefetch')
+    return PREFETCH_DEFAULT if enabled is None else bool(enabled)
+
+
+def guess_periods(query: str) -> dict:
+    """
+    ticker -> period to prefetch: the tickers of the query at its longest period, at least PREFETCH_MIN_PERIOD
+    """
+    tickers = extract_tickers(query)
+    if not tickers or len(tickers) > PREFETCH_MAX_TICKERS:
+        return {}
+    period = max(extract_periods(query) + [PREFETCH_MIN_PERIOD], key=period_days)
+    return {ticker: period for ticker in tickers}
+
+
+def start_prefetch(agent_state: dict):
+    """
+    start fetching the prices the query is likely to need, called by the router on the hop to the planner
+    """
+    run_id = agent_state.get('run_id')
+    if not run_id or not is_enabled(agent_state) or run_id in _prefetches:
+        return None
+    periods = guess_periods(agent_state.get('query', ''))
+    if not periods:
+        return None
+    from src.graph.tools import download_prices
+    # only what the download needs, the state keeps changing while the planner runs
+    state = {'run_id': run_id, 'price_source': agent_state.get('price_source')}
+    prefetch = Prefetch(periods, get_pool().submit(download_prices, periods, state, PREFETCH_DIR))
+    prefetch.future.add_done_callback(prefetch.done)
+    with _lock:
+        _prefetches[run_id] = prefetch
+    logger.info(f'prefetching {periods} while the planner runs')
+    return prefetch
+
+
+def is_prefetch_artifact(path, run_id: str) -> bool:
+    return os.path.dirname(path) == str(get_data_dir() / run_id / PREFETCH_DIR)
+
+
+def claim(ticker: str, path: str, agent_state: dict) -> str:
+    """
+    path a step registers for a prefetched artifact: run artifacts are moved out of the prefetch directory
+    on the first hit, unless a fetch of the run already wrote the ticker's run artifact. price store artifacts
+    are shared and used where they are
+    """
+    run_id = agent_state['run_id']
+    if not is_prefetch_artifact(path, run_id):
+        return path
+    target = get_price_data_path(ticker, run_id)
+    if os.path.exists(path) and str(target) not in (agent_state.get('data') or {}).values():
+        move_artifact(path, target)
+    return str(target)
+
+
+def discard(run_id: str, keep=()):
+    """
+    delete the prefetched run artifacts no step took, the paths in keep are left alone
+    """
+    prefetch_dir = get_data_dir() / run_id / PREFETCH_DIR
+    if not prefetch_dir.is_dir():
+        return
+    keep = {str(path) for path in keep}
+    for path in prefetch_dir.iterdir():
+        if str(path) not in keep and not path.name.endswith('.meta.json'):
+            remove_artifact(path)
+    try:
+        prefetch_dir.rmdir()
+    except OSError:
+        # not empty
+        pass
+
+
+def take_prefetched(periods: dict, agent_state: dict) -> tuple:
+    """
+    the prefetched artifacts of the tickers asked for, when the prefetch covered their period.
+    waits for a prefetch still in flight: its download is already under way
+    :return: update of the prefetched tickers ({} when none), ticker -> period still to fetch
+    """
+    prefetch = _prefetches.get(agent_state.get('run_id'))
+    if prefetch is None:
+        return {}, periods
+    covered = [ticker for ticker, period in periods.items()
+               if ticker in prefetch.periods and period_days(period) <= period_days(prefetch.periods[ticker])]
+    rest = {ticker: period for ticker, period in periods.items() if ticker not in covered}
+    update = {}
+    if covered:
+        wait_start = time.perf_counter()
+        try:
+            result = prefetch.future.result()
+        except Exception as e:
+            logger.warning(f'prefetch failed, fetching again: {e}')
+            result = {}
+        waited = time.perf_counter() - wait_start
+        hits = [ticker for ticker in covered if ticker in result.get('data', {})]
+        rest.update({ticker: periods[ticker] for ticker in covered if ticker not in hits})
+        if hits:
+            with _lock:
+                data = {ticker: claim(ticker, result['data'][ticker], agent_state) for ticker in hits}
+            update = {'data': data,
+                      'data_periods': {ticker: periods[ticker] for ticker in hits},
+                      'execution_status': [f'load {periods[ticker]} price data for {ticker} status: success '
+                                           f'(prefetched while planning)' for ticker in hits]}
+            with _lock:
+                prefetch.used.update(hits)
+                prefetch.stats['hits'] += len(hits)
+                prefetch.waited += waited
+            count('prefetch_hits', len(hits))
+    if rest:
+        with _lock:
+            prefetch.stats['misses'] += len(rest)
+        count('prefetch_misses', len(rest))
+    return update, rest
+
+
+def finish_prefetch(run_id: str, data: dict = None):
+    """
+    close the prefetch of a run once its fetches are done: cancel it when it has not started, count the
+    tickers it fetched that no step used. the prefetched run artifacts no step took are deleted, price store
+    artifacts stay as they are shared
+    :param data: AgentState['data'] of the run, its paths are never deleted
+    :return: prefetch stats of the run, None without a prefetch
+    """
+    with _lock:
+        prefetch = _prefetches.pop(run_id, None)
+    if prefetch is None:
+        return None
+    keep = (data or {}).values()
+    if prefetch.future.cancel():
+        prefetch.stats['cancelled'] = True
+    elif prefetch.future.done():
+        prefetch.stats['wasted'] = len(prefetch.periods) - len(prefetch.used)
+        discard(run_id, keep)
+    else:
+        # still downloading: the result is discarded when it arrives
+        prefetch.stats['wasted'] = len(prefetch.periods) - len(prefetch.used)
+        prefetch.future.add_done_callback(lambda _: discard(run_id, keep))
+    if prefetch.used:
+        # the download ran before the plan asked for it, only the part the steps still waited for was not saved.
+        # counted once per prefetch, it stands in for at least one download of the steps
+        prefetch.stats['saved_s'] = round(max(0.0, (prefetch.finished or time.perf_counter()) - prefetch.started - prefetch.waited), 4)
+    with _lock:
+        _totals['runs'] += 1
+        _totals['cancelled'] += prefetch.stats['cancelled']
+        for key in ['tickers', 'hits', 'misses', 'wasted', 'saved_s']:
+            _totals[key] += prefetch.stats[key]
+    logger.info(f'prefetch of {run_id}: {prefetch.stats}')
+    return prefetch.stats
+
+
+def prefetch_totals() -> dict:
+    """
+    prefetch stats of the runs of this process, with the hit rate over the tickers asked for
+    """
+    with _lock:
+        totals = dict(_totals)
+    asked = totals['hits'] + totals['misses']
+    totals['hit_rate'] = totals['hits'] / asked if asked else None
+    return totals
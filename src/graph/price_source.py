@@ -0,0 +1,84 @@
+import os
+import time
+import zlib
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from src.graph.util import period_delta
+
+DEFAULT_PRICE_SOURCE = os.getenv('AGENTFLOW_PRICE_SOURCE', 'yfinance')
+# simulated round-trip of one offline request, in seconds
+OFFLINE_LATENCY = float(os.getenv('AGENTFLOW_OFFLINE_LATENCY', 0))
+OFFLINE_EPOCH = '2000-01-03'
+
+
+def download_yfinance(tickers: list, period: str = None, start=None) -> dict:
+    """
+    one multi-ticker request to yfinance, split into a close price frame per ticker
+    :param tickers: list of tickers
+    :param period: period ending today, e.g. 1y, 6m, 5d
+    :param start: start date, used instead of period for top-up fetches
+    :return: dict of ticker -> DataFrame with a Close column
+    """
+    import yfinance as yf
+    if period and period[-1] == 'm':
+        period = period + 'o'
+    if start is not None:
+        df = yf.download(tickers, start=start, progress=False, group_by='column')
+    else:
+        df = yf.download(tickers, period=period, progress=False, group_by='column')
+    close = df['Close']
+    if isinstance(close, pd.Series):
+        close = close.to_frame(tickers[0])
+    prices = {}
+    for ticker in tickers:
+        if ticker in close.columns:
+            series = close[ticker].dropna()
+            if len(series) > 0:
+                prices[ticker] = series.to_frame('Close')
+    return prices
+
+
+def offline_series(ticker: str, end=None) -> pd.Series:
+    """
+    deterministic geometric brownian motion close prices for any ticker on business days,
+    seeded by the ticker so every call returns the same price for the same date
+    """
+    end = pd.Timestamp(end or date.today())
+    dates = pd.bdate_range(OFFLINE_EPOCH, end, name='Date')
+    seed = zlib.crc32(ticker.encode())
+    rng = np.random.default_rng(seed)
+    mu = 0.02 + (seed % 100) / 1000
+    sigma = 0.15 + (seed % 37) / 100
+    dt = 1 / 252
+    log_returns = (mu - sigma ** 2 / 2) * dt + sigma * dt ** 0.5 * rng.standard_normal(len(dates))
+    log_returns[0] = 0
+    prices = (10 + seed % 490) * np.exp(np.cumsum(log_returns))
+    return pd.Series(prices, index=dates, name='Close')
+
+
+def download_offline(tickers: list, period: str = None, start=None) -> dict:
+    """
+    stand-in for download_yfinance that never touches the network, used for tests and benchmarks
+    """
+    if OFFLINE_LATENCY:
+        time.sleep(OFFLINE_LATENCY)
+    if start is None:
+        start = date.today() - period_delta(period)
+    prices = {}
+    for ticker in tickers:
+        prices[ticker] = offline_series(ticker).loc[pd.Timestamp(start):].to_frame('Close')
+    return prices
+
+
+PRICE_SOURCES = {'yfinance': download_yfinance,
+                 'offline': download_offline}
+
+
+def get_price_source(name: str = None):
+    name = name or DEFAULT_PRICE_SOURCE
+    if name not in PRICE_SOURCES:
+        raise ValueError(f'unknown price source {name}, available: {list(PRICE_SOURCES)}')
+    return PRICE_SOURCES[name]
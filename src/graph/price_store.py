@@ -0,0 +1,207 @@
+import hashlib
+import os
+import time
+from contextlib import ExitStack
+from datetime import date, datetime
+from pathlib import Path
+
+import pandas as pd
+
+from src.graph.artifacts import to_bytes, write_artifact, read_series, cache_put, artifact_suffix, remove_artifact
+from src.graph.catalog import active_artifacts
+from src.graph.logger import get_logger
+from src.graph.price_source import get_price_source, DEFAULT_PRICE_SOURCE
+from src.graph.util import get_data_dir, period_delta, period_days, file_lock, write_json_atomic, load_json
+
+logger = get_logger('price_store')
+
+STORE_ENABLED = os.getenv('AGENTFLOW_PRICE_STORE', '1') != '0'
+# seconds after which a ticker is topped up with the missing trailing days
+STORE_MAX_AGE = float(os.getenv('AGENTFLOW_STORE_MAX_AGE', 6 * 3600))
+STORE_MAX_BYTES = int(os.getenv('AGENTFLOW_STORE_MAX_BYTES', 512 * 1024 ** 2))
+# an artifact served within this many seconds is not evicted, it may be in use by a run the catalog has not
+# recorded it for yet
+STORE_EVICT_GRACE = float(os.getenv('AGENTFLOW_STORE_EVICT_GRACE', 3600))
+# wait for the download lock of a ticker, and age after which a lock left over by a crashed process is taken
+# over. a lock is held for the download of the tickers, well under the stale age: it must never be taken from
+# a live download
+STORE_LOCK_TIMEOUT = 300
+STORE_LOCK_STALE_AFTER = 1800
+
+# the price history of a ticker is kept once under data/_store as content-addressed artifacts
+# (<ticker>-<sha256 prefix>.parquet or .feather). An artifact is never modified after it is written, so runs
+# reference it from AgentState['data'] instead of copying it. index.json keeps the current artifact
+# of each ticker, the first date it covers and when it was topped up, and size/last access for eviction.
+def get_store_dir(source: str = 'yfinance'):
+    # data of stand-in sources is kept apart so it never mixes with real prices
+    path = get_data_dir() / ('_store' if source == 'yfinance' else f'_store_{source}')
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _read_index(store_dir):
+    return load_json(store_dir / 'index.json', default={'tickers': {}, 'artifacts': {}})
+
+
+def _write_artifact(store_dir, ticker: str, df: pd.DataFrame):
+    content = to_bytes(df)
+    fname = f'{ticker}-{hashlib.sha256(content).hexdigest()[:16]}{artifact_suffix()}'
+    fpath = store_dir / fname
+    if fpath.exists():
+        cache_put(fpath, df.squeeze(axis=1))
+    else:
+        write_artifact(fpath, df, content)
+    return fpath, len(content)
+
+
+def _merge(old: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    df = pd.concat([old, new])
+    return df[~df.index.duplicated(keep='last')].sort_index()
+
+
+def evict(store_dir, index: dict, max_bytes: int = None):
+    """
+    drop least recently used artifacts until the store fits into max_bytes,
+    superseded artifacts go before the current artifact of any ticker.
+    artifacts still in use are kept even above max_bytes: those of running or watched runs of the catalog,
+    and those served within STORE_EVICT_GRACE seconds
+    """
+    max_bytes = STORE_MAX_BYTES if max_bytes is None else max_bytes
+    artifacts = index['artifacts']
+    total = sum(a['nbytes'] for a in artifacts.values())
+    if total <= max_bytes:
+        return []
+    current = {entry['artifact'] for entry in index['tickers'].values()}
+    in_use = {Path(path).name for path in active_artifacts() if Path(path).parent == Path(store_dir)}
+    recent = time.time() - STORE_EVICT_GRACE
+    order = sorted(artifacts, key=lambda f: (f in current, artifacts[f].get('last_access', 0)))
+    evicted = []
+    for fname in order:
+        if total <= max_bytes:
+            break
+        if fname in in_use or artifacts[fname].get('last_access', 0) > recent:
+            continue
+        total -= artifacts[fname]['nbytes']
+        remove_artifact(store_dir / fname)
+        evicted.append(fname)
+        ticker = artifacts[fname]['ticker']
+        if fname in current and index['tickers'][ticker]['artifact'] == fname:
+            del index['tickers'][ticker]
+        del artifacts[fname]
+    logger.info(f'evicted {len(evicted)} artifacts from the price store')
+    return evicted
+
+
+def get_price_paths(periods: dict, source: str = None, max_age: float = None) -> dict:
+    """
+    serve the price history of several tickers from the store, downloading only what is missing:
+    - nothing when the stored history covers the period and was topped up recently
+    - the trailing days since the last stored bar when it is stale
+    - the full period when the stored history starts too late or does not exist
+    all tickers that need a full download share one multi-ticker request for the longest period,
+    all stale tickers share one top-up request. If a download fails the stored history is served as is
+    :param periods: dict of ticker -> period
+    :param source: price source name, see price_source.PRICE_SOURCES
+    :param max_age: seconds after which stored history is topped up, STORE_MAX_AGE by default, 0 always tops up
+    :return: dict of ticker -> (path of the shared artifact, note for the execution status)
+    """
+    source = source or DEFAULT_PRICE_SOURCE
+    max_age = STORE_MAX_AGE if max_age is None else max_age
+    download = get_price_source(source)
+    store_dir = get_store_dir(source)
+    today = date.today()
+    result, old, covers, full, top_up = {}, {}, {}, {}, {}
+    with ExitStack() as stack:
+        # one download per ticker at a time, locks are taken in sorted order so batches cannot deadlock
+        for ticker in sorted(periods):
+            stack.enter_context(file_lock(store_dir / f'{ticker}.lock', timeout=STORE_LOCK_TIMEOUT,
+                                                   stale_after=STORE_LOCK_STALE_AFTER))
+        index = _read_index(store_dir)
+        for ticker, period in periods.items():
+            start_needed = today - period_delta(period)
+            entry = index['tickers'].get(ticker)
+            if not entry or not (store_dir / entry['artifact']).exists():
+                full[ticker] = period
+                continue
+            fpath = store_dir / entry['artifact']
+            covers[ticker] = date.fromisoformat(entry['covers_from'])
+            if covers[ticker] <= start_needed and time.time() - entry['fetched_at'] <= max_age:
+                result[ticker] = (fpath, ' (price store hit)')
+                continue
+            old[ticker] = read_series(fpath).to_frame('Close')
+            if covers[ticker] > start_needed:
+                full[ticker] = period
+            else:
+                top_up[ticker] = old[ticker].index[-1].date()
+
+        new, errors = {}, {}
+        if full:
+            longest = max(full.values(), key=period_days)
+            try:
+                new.update(download(list(full), period=longest))
+                covers.update({ticker: today - period_delta(longest) for ticker in full if ticker in new})
+            except Exception as e:
+                errors.update({ticker: e for ticker in full})
+        if top_up:
+            try:
+                new.update(download(list(top_up), start=min(top_up.values())))
+            except Exception as e:
+                errors.update({ticker: e for ticker in top_up})
+
+        updates = {}
+        for ticker in list(full) + list(top_up):
+            if ticker in new:
+                df = _merge(old[ticker], new[ticker]) if ticker in old else new[ticker]
+                fpath, nbytes = _write_artifact(store_dir, ticker, df)
+                note = ' (price store top-up)' if ticker in old else ''
+            elif ticker in old:
+                fpath, nbytes = store_dir / index['tickers'][ticker]['artifact'], None
+                note = ''
+                if ticker in errors:
+                    logger.warning(f'price download for {ticker} failed, serving stored data: {errors[ticker]}')
+                    note = f' (stale price store data, download failed: {errors[ticker]})'
+            else:
+                raise ValueError(f'no price data returned for {ticker}: {errors.get(ticker, "empty response")}')
+            result[ticker] = (fpath, note)
+            if ticker not in errors:
+                updates[ticker] = (fpath.name, nbytes, covers[ticker])
+        _update_index(store_dir, [path.name for path, _ in result.values()], updates)
+    return result
+
+
+def get_price_path(ticker: str, period: str, source: str = None):
+    """
+    single ticker version of get_price_paths
+    :return: path of the shared artifact and a note for the execution status
+    """
+    return get_price_paths({ticker: period}, source)[ticker]
+
+
+def _update_index(store_dir, touched: list, updates: dict):
+    """
+    touch the last access of the served artifacts and record new or topped up artifacts as current
+    :param touched: artifact names served
+    :param updates: dict of ticker -> (artifact name, nbytes or None when the artifact did not change, covers_from)
+    """
+    with file_lock(store_dir / 'index.lock'):
+        index = _read_index(store_dir)
+        for ticker, (fname, nbytes, covers_from) in updates.items():
+            if nbytes is not None:
+                index['artifacts'][fname] = {'ticker': ticker, 'nbytes': nbytes}
+            index['tickers'][ticker] = {'artifact': fname,
+                                        'covers_from': covers_from.isoformat(),
+                                        'fetched_at': time.time()}
+        for fname in touched:
+            if fname in index['artifacts']:
+                index['artifacts'][fname]['last_access'] = time.time()
+        evict(store_dir, index)
+        write_json_atomic(store_dir / 'index.json', index)
+
+
+def store_stats(source: str = None):
+    index = _read_index(get_store_dir(source or DEFAULT_PRICE_SOURCE))
+    return {'tickers': len(index['tickers']),
+            'artifacts': len(index['artifacts']),
+            'nbytes': sum(a['nbytes'] for a in index['artifacts'].values()),
+            'oldest_fetch': min([datetime.fromtimestamp(e['fetched_at']).isoformat()
+                                 for e in index['tickers'].values()], default=None)}
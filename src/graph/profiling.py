@@ -0,0 +1,180 @@
+import argparse
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from src.graph.logger import get_logger
+
+logger = get_logger('profiling')
+
+# the records go into the checkpointed state and grow with the run, so profiling is opt-in
+PROFILE_ENABLED = os.getenv('AGENTFLOW_PROFILE', '0') != '0'
+# tracemalloc slows allocations down noticeably, the peak memory is only measured on demand
+PROFILE_MEMORY = os.getenv('AGENTFLOW_PROFILE_MEMORY', '0') != '0'
+COUNTERS = ['llm_calls', 'llm_prompt_tokens', 'llm_response_tokens', 'bytes_read', 'bytes_written',
+            'metric_cache_hits', 'metric_cache_misses']
+
+# open spans of the current context, innermost last
+_spans = contextvars.ContextVar('profile_spans', default=())
+# finished span records of the current profile scope
+_collector = contextvars.ContextVar('profile_collector', default=None)
+
+
+def count(name: str, n: int = 1):
+    """
+    add to a counter of the innermost open span, counters are exclusive of nested spans
+    """
+    spans = _spans.get()
+    if spans:
+        counters = spans[-1]['counters']
+        counters[name] = counters.get(name, 0) + n
+
+
+def estimate_tokens(text) -> int:
+    # about 4 characters per token, used when the llm response carries no usage metadata
+    return -(-len(str(text)) // 4)
+
+
+@contextmanager
+def span(name: str, kind: str):
+    """
+    time a block: wall and cpu time (of the running thread), peak traced memory above the start and the counters.
+    the finished record is added to the current profile scope
+    """
+    if not PROFILE_ENABLED:
+        yield {}
+        return
+    if PROFILE_MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    frame = {'counters': {}, 'child_peak': 0,
+             'start_mem': tracemalloc.get_traced_memory()[0] if PROFILE_MEMORY else 0}
+    if PROFILE_MEMORY:
+        tracemalloc.reset_peak()
+    record = {'name': name, 'kind': kind, 'start': time.time(), 'thread': threading.current_thread().name}
+    wall, cpu = time.perf_counter(), time.thread_time()
+    token = _spans.set(_spans.get() + (frame,))
+    try:
+        yield record
+    finally:
+        _spans.reset(token)
+        record['wall_s'] = time.perf_counter() - wall
+        record['cpu_s'] = time.thread_time() - cpu
+        if PROFILE_MEMORY:
+            # nested spans reset the peak, their peaks are carried up
+            peak = max(tracemalloc.get_traced_memory()[1] - frame['start_mem'], frame['child_peak'])
+            record['mem_peak_bytes'] = peak
+            parents = _spans.get()
+            if parents:
+                parents[-1]['child_peak'] = max(parents[-1]['child_peak'],
+                                                peak + frame['start_mem'] - parents[-1]['start_mem'])
+        record.update(frame['counters'])
+        collector = _collector.get()
+        if collector is not None:
+            collector.append(record)
+
+
+@contextmanager
+def profile_scope(name: str, kind: str):
+    """
+    span whose record and the records of every span opened inside it are collected in the yielded list,
+    for the caller to return in its state update under 'profile'
+    """
+    records = []
+    token = _collector.set(records)
+    try:
+        with span(name, kind):
+            yield records
+    finally:
+        _collector.reset(token)
+
+
+def with_profile(update: dict, records: list) -> dict:
+    if not records:
+        return update
+    return {**update, 'profile': update.get('profile', []) + records}
+
+
+def profiled(kind: str):
+    """
+    decorator for the graph nodes and tools, adds the profile records of the call to the returned state update
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_scope(func.__name__, kind) as records:
+                update = func(*args, **kwargs)
+            return with_profile(update, records)
+
+        return wrapper
+
+    return decorator
+
+
+def chrome_trace(runs: dict) -> dict:
+    """
+    Chrome trace event format (chrome://tracing, Perfetto) of the profile records, one process per run
+    :param runs: run_id -> profile records
+    """
+    events = []
+    for pid, (run_id, records) in enumerate(runs.items()):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': run_id}})
+        for record in records:
+            args = {key: value for key, value in record.items()
+                    if key not in ['name', 'kind', 'start', 'wall_s', 'thread']}
+            events.append({'name': record['name'], 'cat': record['kind'], 'ph': 'X', 'pid': pid,
+                           'tid': record['thread'], 'ts': record['start'] * 1e6, 'dur': record['wall_s'] * 1e6,
+                           'args': args})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def profile_report(runs: dict) -> dict:
+    """
+    per kind and name across runs: calls, p50/p95 wall time, total cpu time and the summed counters
+    """
+    # util imports this module
+    from src.graph.util import percentile
+    groups = {}
+    for records in runs.values():
+        for record in records:
+            groups.setdefault(f'{record["kind"]}:{record["name"]}', []).append(record)
+    report = {}
+    for key, records in sorted(groups.items()):
+        walls = [r['wall_s'] for r in records]
+        report[key] = {'calls': len(records),
+                       'wall_p50_s': percentile(walls, 0.5),
+                       'wall_p95_s': percentile(walls, 0.95),
+                       'wall_total_s': sum(walls),
+                       'cpu_total_s': sum(r['cpu_s'] for r in records),
+                       **{name: sum(r.get(name, 0) for r in records) for name in COUNTERS},
+                       'mem_peak_max_bytes': max((r.get('mem_peak_bytes', 0) for r in records), default=0)}
+    return report
+
+
+def load_profiles(run_ids: list) -> dict:
+    from src.graph.checkpoint import load_state
+    return {run_id: load_state(run_id).get('profile') or [] for run_id in run_ids}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='per node profile of finished runs')
+    parser.add_argument('run_ids', nargs='*')
+    parser.add_argument('--batch', default=None, help='results JSONL of src.graph.batch, profiles all its runs')
+    parser.add_argument('--trace', default=None, help='write a Chrome trace JSON file')
+    args = parser.parse_args()
+
+    run_ids = list(args.run_ids)
+    if args.batch:
+        with open(args.batch, 'r', encoding='utf-8') as f:
+            run_ids += [json.loads(line)['run_id'] for line in f if line.strip()]
+    runs = load_profiles(run_ids)
+    if args.trace:
+        with open(args.trace, 'w', encoding='utf-8') as f:
+            json.dump(chrome_trace(runs), f)
+        logger.info(f'trace of {len(runs)} runs written to {args.trace}')
+    print(json.dumps(profile_report(runs), indent=2))
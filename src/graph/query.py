@@ -0,0 +1,36 @@
+import re
+
+# upper case words that look like tickers but are not
+NOT_TICKERS = {'A', 'I', 'AND', 'OR', 'THE', 'VS', 'US', 'USA', 'USD', 'ETF', 'CEO', 'EPS', 'PE', 'YTD',
+               'IPO', 'AI', 'OK', 'TO', 'OF', 'FOR', 'IN', 'ON', 'BY', 'RISK', 'VOL', 'PNL', 'GDP'}
+TICKER_PATTERN = re.compile(r'\b[A-Z]{1,5}(?:[.-][A-Z]{1,2})?\b')
+PERIOD_PATTERN = re.compile(r'\b(\d{1,2})\s*-?\s*(years?|yrs?|y|months?|mos?|mo|m|days?|d)\b', re.IGNORECASE)
+SINGLE_PERIOD_PATTERN = re.compile(r'\b(?:past|last)\s+(year|month|day)\b', re.IGNORECASE)
+
+
+def ticker_spans(query: str) -> list:
+    return [(m.start(), m.end(), m.group()) for m in TICKER_PATTERN.finditer(query) if m.group() not in NOT_TICKERS]
+
+
+def period_spans(query: str) -> list:
+    """
+    periods written in the query, normalized to the plan format 1y, 6m, 5d
+    """
+    spans = [(m.start(), m.end(), f'{int(m.group(1))}{m.group(2)[0].lower()}') for m in PERIOD_PATTERN.finditer(query)]
+    spans += [(m.start(), m.end(), f'1{m.group(1)[0].lower()}') for m in SINGLE_PERIOD_PATTERN.finditer(query)]
+    return sorted(spans)
+
+
+def _unique(values):
+    return list(dict.fromkeys(values))
+
+
+def extract_tickers(query: str) -> list:
+    """
+    tickers mentioned in the query in order of appearance, a cheap deterministic guess, not a validation
+    """
+    return _unique(ticker for _, _, ticker in ticker_spans(query))
+
+
+def extract_periods(query: str) -> list:
+    return _unique(period for _, _, period in period_spans(query))
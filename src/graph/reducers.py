@@ -0,0 +1,198 @@
+import itertools
+import json
+import os
+
+# entries of a trace log (call_stack, execution_status, profile) kept in memory, older ones roll to
+# data/<run_id>/<key>.jsonl. 0 keeps everything in memory
+TRACE_CAP = int(os.getenv('AGENTFLOW_TRACE_CAP', 0))
+TRACE_KEYS = ['call_stack', 'execution_status', 'profile']
+
+# write ids of the node updates, increasing in the process
+_write_ids = itertools.count(1)
+
+
+class AppendLog(list):
+    """
+    list the append_log reducer owns and extends in place. json sees a plain list and it pickles as one
+    """
+    # write id of the last stamped update applied, see stamp_writes
+    applied = 0
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+class LogWrite(list):
+    """
+    update of a list channel stamped with the write id of its node update, copies and pickles keep the id
+    """
+
+    def __init__(self, entries, write_id: int):
+        super().__init__(entries)
+        self.write_id = write_id
+
+    def __reduce__(self):
+        return LogWrite, (list(self), self.write_id)
+
+
+class ShardWrite(dict):
+    """
+    update of a dict channel stamped with the write id of its node update, copies and pickles keep the id
+    """
+
+    def __init__(self, shards, write_id: int):
+        super().__init__(shards)
+        self.write_id = write_id
+
+    def __reduce__(self):
+        return ShardWrite, (dict(self), self.write_id)
+
+
+class Trim(list):
+    """
+    update of a trace log: the new entries, then roll the oldest entries to path so keep are left in memory.
+    journaled as the plain list of the new entries, pickled as the stamped write without the roll
+    """
+
+    def __init__(self, entries, keep: int, path: str, write_id: int = None):
+        super().__init__(entries)
+        self.keep = keep
+        self.path = path
+        self.write_id = write_id
+
+    def __reduce__(self):
+        return (LogWrite, (list(self), self.write_id)) if self.write_id else (list, (list(self),))
+
+
+class Shards(dict):
+    """
+    dict of per-key shards (tickers of execution_result, data) the merge_shards reducer owns and merges in place
+    """
+    # see AppendLog.applied
+    applied = 0
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+class Replace(dict):
+    """
+    value of an update that replaces the value it lands on instead of being merged into it, for results computed
+    again as a whole (a chart, a cross-asset entry) whose lists would otherwise be appended
+    """
+
+
+def roll(log: AppendLog, keep: int, path: str):
+    """
+    append the oldest entries of the log to the jsonl file at path and drop them, keep the last keep in memory
+    """
+    rolled = len(log) - keep
+    if rolled <= 0:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        for entry in log[:rolled]:
+            f.write(json.dumps(entry, default=str) + '\n')
+    del log[:rolled]
+
+
+def stamp_writes(update: dict, keys) -> dict:
+    """
+    stamp the values of the reducer channels (keys) of a node update with one write id, larger than the id of
+    every update stamped before it in the process
+    """
+    write_id = next(_write_ids)
+    stamped = dict(update)
+    for key in keys:
+        value = update.get(key)
+        if isinstance(value, Trim):
+            value.write_id = write_id
+        elif isinstance(value, list):
+            stamped[key] = LogWrite(value, write_id)
+        elif isinstance(value, dict):
+            stamped[key] = ShardWrite(value, write_id)
+    return stamped
+
+
+def already_applied(channel, new) -> bool:
+    """
+    whether a stamped update was applied to the channel: LangGraph may apply a node's writes more than once
+    (to a copy of the channels to evaluate a conditional edge, then to the channels, the copy sharing the log),
+    stamped updates are applied in increasing write id order, so an id up to the last one applied was applied.
+    unstamped updates (journal replay, watch, the executor merging a wave) are always applied
+    """
+    write_id = getattr(new, 'write_id', None)
+    if not write_id:
+        return False
+    if write_id <= channel.applied:
+        return True
+    channel.applied = write_id
+    return False
+
+
+def append_log(old, new):
+    """
+    reducer of the list channels: old + new in amortized O(len(new)). the first call copies old into an
+    AppendLog, later calls extend that one, so a list handed in by the caller or a node is never mutated
+    """
+    log = old if isinstance(old, AppendLog) else AppendLog(old or [])
+    if new is None or already_applied(log, new):
+        return log
+    log.extend(new)
+    if isinstance(new, Trim):
+        roll(log, new.keep, new.path)
+    return log
+
+
+def merge_value(old, new):
+    """
+    deep merge as always_merger does (dicts merged, lists appended, anything else replaced), copying instead
+    of mutating: below the shards the values are small and may be shared with a node's update
+    """
+    if isinstance(new, Replace):
+        return dict(new)
+    if isinstance(old, dict) and isinstance(new, dict):
+        merged = dict(old)
+        for key, value in new.items():
+            merged[key] = merge_value(merged[key], value) if key in merged else value
+        return merged
+    if isinstance(old, list) and isinstance(new, list):
+        return old + new
+    return new
+
+
+def merge_shards(old, new):
+    """
+    reducer of the dict channels: each key of new is a shard (a ticker) merged into its shard of old in O(size of
+    the update), instead of going through the whole dict. the first call copies old and its shards into Shards
+    """
+    if isinstance(old, Shards):
+        shards = old
+    else:
+        shards = Shards((key, dict(value) if isinstance(value, dict) else value) for key, value in (old or {}).items())
+    if new is None or already_applied(shards, new):
+        return shards
+    for key, value in new.items():
+        shard = shards.get(key)
+        if isinstance(shard, dict) and isinstance(value, dict) and not isinstance(value, Replace):
+            for name, item in value.items():
+                shard[name] = merge_value(shard[name], item) if name in shard else item
+        else:
+            shards[key] = dict(value) if isinstance(value, dict) else merge_value(shard, value)
+    return shards
+
+
+def trim_traces(agent_state: dict, update: dict) -> dict:
+    """
+    with AGENTFLOW_TRACE_CAP set, turn the trace entries of an update into a Trim once a log grows past twice
+    the cap, so a log is rolled to disk once every cap entries and stays between cap and 2 x cap
+    """
+    run_id = agent_state.get('run_id')
+    if not TRACE_CAP or not run_id:
+        return update
+    # util imports the state, which imports this module
+    from src.graph.util import get_data_dir
+    for key in TRACE_KEYS:
+        if key in update and len(agent_state.get(key) or []) + len(update[key]) > 2 * TRACE_CAP:
+            update = {**update, key: Trim(update[key], TRACE_CAP, str(get_data_dir() / run_id / f'{key}.jsonl'))}
+    return update
@@ -0,0 +1,119 @@
+import argparse
+from pathlib import Path
+
+from src.graph.catalog import list_runs
+from src.graph.graph import build_graph
+from src.graph.logger import get_logger
+from src.graph.scheduler import next_pending
+from src.graph.state import AgentState
+from src.graph.tools import cross_asset_key
+from src.graph.util import load_state
+from src.graph.validation import FETCH_ACTIONS, PAIRWISE_METRICS, plan_tickers
+
+logger = get_logger('resume')
+
+
+def step_output_missing(step: dict, agent_state: AgentState) -> bool:
+    """
+    whether the output a completed plan step left in the state is gone:
+    the price artifact of a fetch, the chart file of a plot, the metric keys of a calculation
+    """
+    action = step['action']
+    params = step['params']
+    data = agent_state.get('data', {})
+    execution_result = agent_state.get('execution_result', {})
+    tickers = plan_tickers(step)
+    if action in FETCH_ACTIONS:
+        return any(ticker not in data or not Path(data[ticker]).exists() for ticker in tickers)
+    if action == 'plan_plot':
+        chart = execution_result.get(params['ticker'], {}).get('chart', {})
+        return chart.get('status') != 'ok' or not Path(chart.get('path', '')).exists()
+    if action == 'plan_plot_multi':
+        charts = [execution_result.get(ticker, {}).get('chart_combined', {}) for ticker in tickers]
+        return any(chart.get('status') != 'ok' or not Path(chart.get('path', '')).exists() for chart in charts)
+    if action in ['plan_calculate_return', 'plan_calculate_vol']:
+        metric = 'return' if action == 'plan_calculate_return' else 'vol'
+        return f'{metric}_{params["period"]}' not in execution_result.get(params['ticker'], {})
+    if action == 'plan_calculate_metrics':
+        return any(f'{metric}_{period}' not in execution_result.get(ticker, {})
+                   for ticker in tickers for period in params['periods'] for metric in params['metrics'])
+    if action == 'plan_calculate_cross_asset':
+        period = params['period']
+        cross_asset = execution_result.get('cross_asset', {})
+        pairwise = [metric for metric in params['metrics'] if metric in PAIRWISE_METRICS]
+        per_ticker = [metric for metric in params['metrics'] if metric not in PAIRWISE_METRICS]
+        key = cross_asset_key(params['tickers'], params.get('benchmark'))
+        return any(f'{metric}_{period}_{key}' not in cross_asset for metric in pairwise) \
+            or any(f'{metric}_{period}' not in execution_result.get(ticker, {})
+                   for ticker in params['tickers'] for metric in per_ticker)
+    return False
+
+
+def prepare_resume(run_id: str) -> AgentState:
+    """
+    reload a run and turn it into the initial state of a new invoke that continues where it stopped:
+    plans, data and execution_result are kept, steps whose output is gone are scheduled again
+    and the answer is redone only if a step is rerun
+    :param run_id:
+    :return:
+    """
+    agent_state = load_state(run_id)
+    agent_state.pop('next_node', None)
+    plans = agent_state.get('plans')
+    if not plans:
+        logger.info(f'run {run_id} has no plan yet, resuming from the planner')
+        return agent_state
+
+    if 'completed_steps' in agent_state:
+        completed = set(agent_state['completed_steps'])
+    else:
+        # checkpoints written before completed_steps existed
+        completed = set(range(agent_state.get('next_plan_index', 0)))
+    rerun = sorted(i for i in completed if step_output_missing(plans[i], agent_state))
+    completed -= set(rerun)
+
+    # invalid artifact pointers are dropped, the rerun fetch registers them again
+    agent_state['data'] = {ticker: path for ticker, path in agent_state.get('data', {}).items() if Path(path).exists()}
+    agent_state['completed_steps'] = sorted(completed)
+    agent_state['next_plan_index'] = next_pending(plans, completed)
+    if rerun or agent_state['next_plan_index'] < len(plans):
+        for key in ['draft_answer', 'final_answer', 'critic_result', 'answer_stream']:
+            agent_state.pop(key, None)
+    # the step budget applies to each invoke
+    agent_state['nsteps'] = 0
+    agent_state['execution_status'] = agent_state.get('execution_status', []) + [
+        f'resume run {run_id}: {len(completed)}/{len(plans)} steps done, rerun {rerun}']
+    logger.info(agent_state['execution_status'][-1])
+    return agent_state
+
+
+def resume_run(run_id: str, graph_app=None):
+    """
+    continue a run from its checkpoint without calling the planner again
+    :param run_id:
+    :param graph_app: compiled graph, build_graph() is compiled when not given
+    :return: final state
+    """
+    agent_state = prepare_resume(run_id)
+    if graph_app is None:
+        graph_app = build_graph().compile()
+    return graph_app.invoke(agent_state)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='resume an agentflow run from its checkpoint')
+    parser.add_argument('run_id', nargs='?')
+    parser.add_argument('--unfinished', action='store_true',
+                        help='resume every run the catalog has as running or failed')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be rerun')
+    args = parser.parse_args()
+    run_ids = [args.run_id] if args.run_id else []
+    if args.unfinished:
+        run_ids += [run['run_id'] for run in list_runs(status=['running', 'failed'], limit=-1)]
+    for run_id in run_ids:
+        if args.dry_run:
+            state = prepare_resume(run_id)
+            print(state['execution_status'][-1] if state.get('plans') else f'{run_id}: no plan yet, the planner runs again')
+        else:
+            result = resume_run(run_id)
+            print(result.get('final_answer'))
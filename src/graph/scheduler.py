@@ -0,0 +1,144 @@
+import atexit
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from src.graph.state import AgentState
+from src.graph.reducers import append_log, merge_shards
+from src.graph.tools import PLAN_TOOL_NAME_MAP, TOOLS_REGISTRY, fetch_prices
+from src.graph.util import period_days
+from src.graph.validation import plan_dependencies, FETCH_ACTIONS
+from src.graph.logger import get_logger
+from src.graph.profiling import profile_scope, with_profile
+
+logger = get_logger('scheduler')
+
+DEFAULT_MAX_WORKERS = 8
+
+_pools = {}
+
+
+def get_pool(kind: str, max_workers: int):
+    """
+    pools are kept for the life of the process, so a process pool is not re-spawned on every wave
+    :param kind: thread or process
+    :param max_workers:
+    :return:
+    """
+    key = (kind, max_workers)
+    if key not in _pools:
+        if kind == 'process':
+            # spawn: the batch runner has threads, a forked worker would inherit the locks they hold
+            _pools[key] = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+        elif kind == 'thread':
+            _pools[key] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='executor')
+        else:
+            raise ValueError(f'unknown executor pool {kind}')
+    return _pools[key]
+
+
+@atexit.register
+def shutdown_pools():
+    for pool in _pools.values():
+        pool.shutdown(wait=True, cancel_futures=True)
+    _pools.clear()
+
+
+def run_step(step: dict, agent_state: AgentState) -> dict:
+    action = step['action']
+    tool_name = PLAN_TOOL_NAME_MAP.get(action)
+    tool_func = TOOLS_REGISTRY[tool_name]
+    kwargs = step['params'].copy()
+    kwargs['agent_state'] = agent_state
+    logger.info(f'executing plan: {step}')
+    with profile_scope(action, 'tool') as records:
+        update = tool_func(**kwargs)
+    return with_profile(update, records)
+
+
+def pending_fetches(plans: list, completed) -> list:
+    return [i for i, step in enumerate(plans) if i not in completed and step['action'] in FETCH_ACTIONS]
+
+
+def run_fetch_batch(plans: list, indices: list, agent_state: AgentState) -> dict:
+    """
+    coalesce several plan_get_stock_price steps into one batched download at the longest period asked per ticker
+    """
+    periods = {}
+    for i in indices:
+        params = plans[i]['params']
+        ticker, period = params['ticker'], params['period']
+        if ticker not in periods or period_days(period) > period_days(periods[ticker]):
+            periods[ticker] = period
+    logger.info(f'batched price fetch for steps {indices}: {periods}')
+    with profile_scope('batch_fetch', 'tool') as records:
+        update = fetch_prices(periods, agent_state)
+    return with_profile(update, records)
+
+
+def next_pending(plans: list, completed, start: int = 0) -> int:
+    """
+    first plan index at or after start that has not been executed, len(plans) when all are done
+    """
+    index = start
+    while index < len(plans) and index in completed:
+        index += 1
+    return index
+
+
+def ready_steps(plans: list, completed) -> list:
+    """
+    indices of the steps whose dependencies are all completed
+    """
+    deps = plan_dependencies(plans)
+    return [i for i in range(len(plans)) if i not in completed and deps[i] <= completed]
+
+
+def merge_updates(updates: list) -> dict:
+    """
+    merge the tool outputs with the AgentState reducers: lists are appended, dicts merged per shard
+    """
+    merged = {}
+    for update in updates:
+        for key, value in update.items():
+            if isinstance(value, list):
+                merged[key] = append_log(merged.get(key), value)
+            elif isinstance(value, dict):
+                merged[key] = merge_shards(merged.get(key), value)
+            else:
+                merged[key] = value
+    return merged
+
+
+def run_wave(agent_state: AgentState) -> dict:
+    """
+    run every ready step of the plan at the same time on a bounded pool
+    :param agent_state:
+    :return: merged state update of the wave
+    """
+    plans = agent_state['plans']
+    completed = set(agent_state.get('completed_steps') or [])
+    wave = ready_steps(plans, completed)
+    if len(wave) == 0:
+        raise RuntimeError(f'no runnable step left in plan, completed steps: {sorted(completed)}')
+
+    jobs = [(run_step, plans[i]) for i in wave]
+    if agent_state.get('batch_fetch') and any(plans[i]['action'] in FETCH_ACTIONS for i in wave):
+        fetches = pending_fetches(plans, completed)
+        jobs = [(run_step, plans[i]) for i in wave if i not in fetches] + [(run_fetch_batch, plans, fetches)]
+        wave = sorted(set(wave) | set(fetches))
+
+    max_workers = agent_state.get('max_workers') or DEFAULT_MAX_WORKERS
+    if len(jobs) == 1:
+        func, *args = jobs[0]
+        updates = [func(*args, agent_state)]
+    else:
+        pool = get_pool(agent_state.get('executor_pool', 'thread'), max_workers)
+        logger.info(f'running steps {wave} in parallel')
+        # the state handed to the tools is a plain dict so it can be pickled for the process pool
+        futures = [pool.submit(func, *args, dict(agent_state)) for func, *args in jobs]
+        updates = [future.result() for future in futures]
+
+    completed.update(wave)
+    return {**merge_updates(updates),
+            'completed_steps': wave,
+            'next_plan_index': next_pending(plans, completed)}
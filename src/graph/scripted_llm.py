@@ -0,0 +1,137 @@
+import json
+import os
+import random
+import threading
+
+from src.graph.context import context_results, format_value
+from src.graph.coverage import check_coverage, metric_name, NON_TICKER_KEYS
+from src.graph.query import extract_tickers, extract_periods
+from src.graph.util import period_days
+
+# mode='scripted': an offline stand-in of the llm that answers from the query and the state instead of the
+# canned AAPL/MSFT responses of mode='test', used by the end-to-end benchmarks
+# mean simulated round-trip of a call in seconds, each call is off by up to +-SCRIPTED_JITTER of it
+SCRIPTED_LATENCY = float(os.getenv('AGENTFLOW_SCRIPTED_LATENCY', 0))
+SCRIPTED_JITTER = float(os.getenv('AGENTFLOW_SCRIPTED_JITTER', 0.2))
+# share of runs whose first plan fails validation (a step calls a tool that does not exist) and whose first
+# answer leaves out a ticker, the retry of the planner or of the answer gets a valid response
+SCRIPTED_PLAN_FAILURE = float(os.getenv('AGENTFLOW_SCRIPTED_PLAN_FAILURE', 0))
+SCRIPTED_ANSWER_FAILURE = float(os.getenv('AGENTFLOW_SCRIPTED_ANSWER_FAILURE', 0))
+SCRIPTED_SEED = int(os.getenv('AGENTFLOW_SCRIPTED_SEED', 0))
+# plans and answers without a ticker in the query are about this one
+DEFAULT_TICKER = 'AAPL'
+# query words that select the steps of the plan
+METRIC_QUERY_WORDS = {'return': ['return', 'performance', 'perform', 'gain'],
+                      'vol': ['vol', 'risk']}
+CHART_QUERY_WORDS = ['chart', 'plot', 'graph']
+CROSS_ASSET_QUERY_WORDS = {'corr': ['correlat', 'diversif'], 'beta': ['beta'], 'drawdown': ['drawdown']}
+
+# planner calls per run, the first one of a run is the one that can fail
+_planner_calls = {}
+_lock = threading.Lock()
+
+
+def roll(run_id: str, node: str, rate: float) -> bool:
+    """
+    whether the first call of the node fails for this run, the same for a run_id whatever the call order
+    """
+    return rate > 0 and random.Random(f'{SCRIPTED_SEED}:{run_id}:{node}').random() < rate
+
+
+def latency(run_id: str, node: str) -> float:
+    if not SCRIPTED_LATENCY:
+        return 0.0
+    jitter = random.Random(f'{SCRIPTED_SEED}:{run_id}:{node}:latency').uniform(-SCRIPTED_JITTER, SCRIPTED_JITTER)
+    return SCRIPTED_LATENCY * (1 + jitter)
+
+
+def script_plan(query: str) -> list:
+    """
+    the plan a planner would make for the query: a fetch per ticker at the longest period, the metrics its words
+    ask for (return and vol when none), charts and cross-asset metrics when asked for
+    """
+    tickers = extract_tickers(query) or [DEFAULT_TICKER]
+    periods = extract_periods(query) or ['1y']
+    lowered = query.lower()
+    metrics = [metric for metric, words in METRIC_QUERY_WORDS.items() if any(word in lowered for word in words)]
+    metrics = metrics or list(METRIC_QUERY_WORDS)
+    longest = max(periods, key=period_days)
+    plans = [{'action': 'plan_get_stock_price', 'params': {'ticker': ticker, 'period': longest}}
+             for ticker in tickers]
+    if len(tickers) == 1 and len(periods) == 1:
+        plans += [{'action': f'plan_calculate_{metric}', 'params': {'ticker': tickers[0], 'period': periods[0]}}
+                  for metric in metrics]
+    else:
+        plans.append({'action': 'plan_calculate_metrics',
+                      'params': {'tickers': tickers, 'periods': periods, 'metrics': metrics}})
+    cross_asset = [metric for metric, words in CROSS_ASSET_QUERY_WORDS.items()
+                   if any(word in lowered for word in words)]
+    if cross_asset and len(tickers) > 1:
+        plans.append({'action': 'plan_calculate_cross_asset',
+                      'params': {'tickers': tickers, 'period': longest, 'metrics': cross_asset}})
+    if any(word in lowered for word in CHART_QUERY_WORDS):
+        if len(tickers) == 1:
+            plans.append({'action': 'plan_plot', 'params': {'ticker': tickers[0]}})
+        else:
+            plans.append({'action': 'plan_plot_multi', 'params': {'tickers': tickers}})
+    return plans
+
+
+def script_answer(execution_result: dict, query: str, leave_out: bool = False) -> str:
+    """
+    an answer quoting every ticker, metric and value the coverage checks expect, formatted as in the prompt
+    context. leave_out drops the last ticker, for the critic to send the answer back
+    """
+    results = context_results(execution_result, query)
+    tickers = [ticker for ticker, values in results.items() if isinstance(values, dict) and ticker not in NON_TICKER_KEYS]
+    if leave_out and len(tickers) > 1:
+        tickers = tickers[:-1]
+    lines = [f'Results for {", ".join(tickers)}:']
+    for ticker in tickers:
+        parts = []
+        for key, value in results[ticker].items():
+            name = metric_name(key)
+            if name == 'chart':
+                parts.append(f'{key.replace("_", " ")} {format_value(key, value)}')
+            elif name in METRIC_QUERY_WORDS and isinstance(value, (int, float)):
+                parts.append(f'{name} over {key[len(name) + 1:]} {format_value(key, value)}')
+        lines.append(f'- {ticker}: ' + ', '.join(parts))
+    for key, value in (execution_result.get('cross_asset') or {}).items():
+        if isinstance(value, dict) and value.get('most_correlated'):
+            a, b, rho = value['most_correlated'][0]
+            lines.append(f'- most correlated over {key}: {a}/{b} {rho:.2f}')
+    return '\n'.join(lines)
+
+
+def script_critic(draft_answer: str, execution_result: dict, query: str) -> str:
+    coverage = check_coverage(draft_answer, context_results(execution_result, query))
+    status = 'retry' if coverage['status'] == 'retry' else 'ok'
+    return '```json\n' + json.dumps({'critic_result': {'status': status, 'reason': coverage['reason']}}) + '\n```'
+
+
+def scripted_response(node: str, agent_state: dict) -> tuple:
+    """
+    response of the node for the run, built from its query and state
+    :return: text, simulated latency in seconds
+    """
+    run_id = agent_state.get('run_id', '')
+    query = agent_state.get('query', '')
+    execution_result = agent_state.get('execution_result') or {}
+    if node == 'planner':
+        with _lock:
+            _planner_calls[run_id] = _planner_calls.get(run_id, 0) + 1
+            first = _planner_calls[run_id] == 1
+        plans = script_plan(query)
+        if first and roll(run_id, node, SCRIPTED_PLAN_FAILURE):
+            # a tool that does not exist, the plan optimizer cannot fix it
+            plans = plans + [{'action': 'plan_get_news', 'params': {'ticker': plans[0]['params']['ticker']}}]
+        text = '```json\n' + json.dumps(plans, indent=2) + '\n```'
+    elif node == 'answer':
+        retry = (agent_state.get('critic_result') or {}).get('status') == 'retry'
+        text = script_answer(execution_result, query,
+                             leave_out=not retry and roll(run_id, node, SCRIPTED_ANSWER_FAILURE))
+    elif node == 'critic':
+        text = script_critic(agent_state.get('draft_answer', ''), execution_result, query)
+    else:
+        raise ValueError(f'no scripted response for node {node}')
+    return text, latency(run_id, node)
@@ -0,0 +1,271 @@
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from src.graph.catalog import allocate_run_id, connect, transaction, set_status
+from src.graph.logger import get_logger
+from src.graph.prefetch import finish_prefetch
+from src.graph.util import get_state_path
+
+logger = get_logger('service')
+
+HEARTBEAT_EVERY = float(os.getenv('AGENTFLOW_HEARTBEAT_EVERY', 5))
+# a running job whose worker has not sent a heartbeat for this long is considered crashed
+STALE_AFTER = float(os.getenv('AGENTFLOW_JOB_STALE_AFTER', 30))
+MAX_ATTEMPTS = int(os.getenv('AGENTFLOW_JOB_MAX_ATTEMPTS', 3))
+POLL_INTERVAL = float(os.getenv('AGENTFLOW_JOB_POLL_INTERVAL', 0.2))
+
+JOB_SCHEMA = """
+create table if not exists jobs (
+    job_id integer primary key autoincrement,
+    run_id text unique,
+    state text,
+    payload text,
+    worker text,
+    attempts integer default 0,
+    created_at real,
+    started_at real,
+    heartbeat_at real,
+    finished_at real,
+    result text,
+    error text
+);
+create index if not exists jobs_state on jobs (state, job_id);
+"""
+
+
+def jobs_connection():
+    connection = connect()
+    connection.executescript(JOB_SCHEMA)
+    return connection
+
+
+def submit(query: str, **fields) -> str:
+    """
+    queue a query, the run id is allocated right away so the caller can follow the job
+    :param fields: AgentState fields of the run, e.g. mode, price_source, executor_mode
+    :return: run_id
+    """
+    jobs_connection()
+    payload = {'mode': 'test', **fields, 'query': query}
+    payload.setdefault('run_id', allocate_run_id(payload['mode'], query))
+    with transaction() as connection:
+        connection.execute('insert into jobs (run_id, state, payload, created_at) values (?, ?, ?, ?)',
+                           (payload['run_id'], 'queued', json.dumps(payload), time.time()))
+    set_status(payload['run_id'], 'queued')
+    return payload['run_id']
+
+
+def claim(worker: str):
+    """
+    take the oldest queued job
+    :return: job row as a dict, None when the queue is empty
+    """
+    jobs_connection()
+    with transaction() as connection:
+        row = connection.execute("select * from jobs where state = 'queued' order by job_id limit 1").fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        connection.execute("update jobs set state = 'running', worker = ?, attempts = attempts + 1, started_at = ?, "
+                           "heartbeat_at = ? where job_id = ?", (worker, now, now, row['job_id']))
+    job = dict(row)
+    job['attempts'] += 1
+    job['payload'] = json.loads(job['payload'])
+    return job
+
+
+def heartbeat(job_id: int, worker: str):
+    with transaction() as connection:
+        connection.execute("update jobs set heartbeat_at = ? where job_id = ? and worker = ? and state = 'running'",
+                           (time.time(), job_id, worker))
+
+
+def finish(job_id: int, worker: str, state: str, result=None, error: str = None):
+    with transaction() as connection:
+        connection.execute('update jobs set state = ?, finished_at = ?, result = ?, error = ? '
+                           'where job_id = ? and worker = ?',
+                           (state, time.time(), json.dumps(result, default=str), error, job_id, worker))
+
+
+def requeue_stale(stale_after: float = None) -> list:
+    """
+    put the running jobs without a recent heartbeat back in the queue, they resume from their checkpoint.
+    jobs that crashed MAX_ATTEMPTS times are failed
+    :return: requeued run ids
+    """
+    cutoff = time.time() - (STALE_AFTER if stale_after is None else stale_after)
+    jobs_connection()
+    requeued = []
+    with transaction() as connection:
+        rows = connection.execute("select job_id, run_id, attempts from jobs where state = 'running' "
+                                  "and heartbeat_at < ?", (cutoff,)).fetchall()
+        for row in rows:
+            if row['attempts'] >= MAX_ATTEMPTS:
+                connection.execute("update jobs set state = 'failed', finished_at = ?, error = ? where job_id = ?",
+                                   (time.time(), f'worker lost {row["attempts"]} times', row['job_id']))
+            else:
+                connection.execute("update jobs set state = 'queued', worker = null where job_id = ?",
+                                   (row['job_id'],))
+                requeued.append(row['run_id'])
+    if requeued:
+        logger.warning(f'requeued jobs of lost workers: {requeued}')
+    return requeued
+
+
+def job_status(run_id: str):
+    row = jobs_connection().execute('select * from jobs where run_id = ?', (run_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job['payload'] = json.loads(job['payload'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+
+def queue_counts() -> dict:
+    rows = jobs_connection().execute('select state, count(*) as n from jobs group by state').fetchall()
+    return {row['state']: row['n'] for row in rows}
+
+
+def run_job(graph_app, job: dict) -> dict:
+    """
+    run a claimed job, a job claimed again after its worker was lost resumes from the last checkpoint
+    """
+    from src.graph.resume import prepare_resume
+    run_id = job['run_id']
+    if job['attempts'] > 1 and get_state_path(run_id).exists():
+        logger.info(f'resuming {run_id}, attempt {job["attempts"]}')
+        initial_state = prepare_resume(run_id)
+    else:
+        initial_state = job['payload']
+    return graph_app.invoke(initial_state)
+
+
+def worker_main(worker: str, stop_when_idle: bool = False):
+    """
+    worker process: compiles the graph and warms the llm client once, then runs jobs until stopped
+    :param worker: worker name, the process id is appended to it
+    """
+    worker = f'{worker}-{os.getpid()}'
+    from src.graph import charts
+    from src.graph.graph import build_graph
+    from src.graph.llm import get_client
+    # the workers are the parallelism, charts render inside the job instead of a pool per worker
+    charts.CHART_POOL = 'inline'
+    if os.getenv('GEMINI_API_KEY'):
+        get_client()
+    graph_app = build_graph().compile()
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    logger.info(f'worker {worker} ready')
+
+    while not stopping.is_set():
+        job = claim(worker)
+        if job is None:
+            if stop_when_idle:
+                break
+            time.sleep(POLL_INTERVAL)
+            continue
+        done = threading.Event()
+
+        def beat(job_id=job['job_id']):
+            while not done.wait(HEARTBEAT_EVERY):
+                heartbeat(job_id, worker)
+
+        beating = threading.Thread(target=beat, daemon=True)
+        beating.start()
+        try:
+            final_state = run_job(graph_app, job)
+            finish(job['job_id'], worker, 'done', {'final_answer': final_state.get('final_answer'),
+                                                   'nsteps': final_state.get('nsteps')})
+        except Exception as e:
+            logger.error(f'job {job["run_id"]} failed: {e}')
+            finish(job['job_id'], worker, 'failed', error=repr(e))
+            set_status(job['run_id'], 'failed')
+            finish_prefetch(job['run_id'])
+        finally:
+            done.set()
+            beating.join()
+
+
+def run_service(workers: int = None, stop_when_idle: bool = False):
+    """
+    start the worker processes and supervise them: lost jobs are requeued and dead workers replaced
+    :param workers: number of worker processes, the number of cores by default
+    :param stop_when_idle: return once the queue is drained, used by the load test
+    """
+    workers = workers or os.cpu_count()
+    # spawn: a worker starts from a clean interpreter, no sqlite connection or lock is inherited by a fork
+    context = multiprocessing.get_context('spawn')
+    host = socket.gethostname()
+    processes = {}
+
+    def start(i):
+        name = f'{host}-w{i}'
+        process = context.Process(target=worker_main, args=(name, stop_when_idle), name=name)
+        process.start()
+        processes[i] = process
+
+    for i in range(workers):
+        start(i)
+    stopping = threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+        signal.signal(signal.SIGINT, lambda *_: stopping.set())
+    logger.info(f'service started with {workers} workers')
+    try:
+        while not stopping.is_set():
+            requeue_stale()
+            for i, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+                if process.exitcode != 0:
+                    logger.warning(f'worker {process.name} exited with {process.exitcode}, restarting it')
+                    start(i)
+                elif stop_when_idle:
+                    processes.pop(i)
+            if not processes:
+                counts = queue_counts()
+                if counts.get('queued'):
+                    # jobs of a lost worker were requeued after the others went idle
+                    start(0)
+                elif not counts.get('running'):
+                    break
+            stopping.wait(min(HEARTBEAT_EVERY, 1))
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+    logger.info(f'service stopped, jobs: {queue_counts()}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='agentflow worker service and its job queue')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='run the worker processes')
+    serve_parser.add_argument('--workers', type=int, default=None)
+    serve_parser.add_argument('--stop-when-idle', action='store_true')
+    submit_parser = commands.add_parser('submit', help='queue a query')
+    submit_parser.add_argument('query')
+    submit_parser.add_argument('--mode', default='test')
+    submit_parser.add_argument('--price-source', default=None)
+    status_parser = commands.add_parser('status', help='job of a run, or the queue counts')
+    status_parser.add_argument('run_id', nargs='?')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        run_service(args.workers, args.stop_when_idle)
+    elif args.command == 'submit':
+        fields = {'mode': args.mode}
+        if args.price_source:
+            fields['price_source'] = args.price_source
+        print(submit(args.query, **fields))
+    else:
+        print(json.dumps(job_status(args.run_id) if args.run_id else queue_counts(), indent=2, default=str))
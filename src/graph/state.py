@@ -1,5 +1,5 @@
 from typing import TypedDict, Annotated
-from deepmerge import always_merger
+from src.graph.reducers import append_log, merge_shards
 
 
 # def merge_dicts(old: dict | None, new: dict) -> dict:
@@ -18,19 +18,34 @@ class AgentState(TypedDict):
 
     plans: list
     next_plan_index: int
+    completed_steps: Annotated[list, append_log]
+    executor_mode: str
+    executor_pool: str
+    max_workers: int
+    batch_fetch: bool
+    price_source: str
+    prefetch: bool
+    prefetch_stats: dict
 
     next_node: str
 
-    call_stack: Annotated[list, add_message]
+    call_stack: Annotated[list, append_log]
     nsteps: int
+    max_steps: int
+    profile: Annotated[list, append_log]
 
-    execution_status: Annotated[list, add_message]
-    data: Annotated[dict, always_merger.merge]
-    execution_result: Annotated[dict, always_merger.merge]
+    execution_status: Annotated[list, append_log]
+    data: Annotated[dict, merge_shards]
+    data_periods: Annotated[dict, merge_shards]
+    execution_result: Annotated[dict, merge_shards]
 
+    stream_answer: bool
+    answer_stream: dict
     draft_answer: str
     final_answer: str
     critic_result: dict
+    watch: dict
+    batch: dict
 
     mode: str
     run_id: str
@@ -0,0 +1,124 @@
+import os
+import threading
+import time
+
+from src.graph.coverage import METRIC_PATTERNS, mention_pattern, required_coverage
+from src.graph.util import get_data_dir
+
+# seconds between two checkpoints of the partial answer
+PARTIAL_CHECKPOINT_EVERY = float(os.getenv('AGENTFLOW_PARTIAL_CHECKPOINT_EVERY', 0.5))
+# characters per required ticker after which an answer that still leaves a ticker or metric out is stopped,
+# the rest of it is not waited for (0 waits for the whole answer)
+STREAM_COVERAGE_CHARS = int(os.getenv('AGENTFLOW_STREAM_COVERAGE_CHARS', 1500))
+
+_sinks = {}
+_lock = threading.Lock()
+
+
+def register_sink(run_id: str, sink):
+    """
+    sink(text) is called with every chunk of the answer of the run as it streams
+    """
+    with _lock:
+        _sinks[run_id] = sink
+
+
+def unregister_sink(run_id: str):
+    with _lock:
+        _sinks.pop(run_id, None)
+
+
+def get_sink(run_id: str):
+    with _lock:
+        return _sinks.get(run_id)
+
+
+class CoverageTracker:
+    """
+    checks, while the answer streams, which tickers and metrics of execution_result it has mentioned so far
+    """
+
+    def __init__(self, execution_result: dict):
+        self.required = required_coverage(execution_result)
+        self.ticker_pattern = mention_pattern(self.required) if self.required else None
+        self.text = ''
+        self.covered_tickers = set()
+        self.covered_metrics = set()
+
+    def update(self, chunk: str):
+        # the tail of the previous text is kept so words split across chunks are still found
+        window = self.text[-20:] + chunk
+        self.text += chunk
+        if self.ticker_pattern is None:
+            return
+        self.covered_tickers.update(match.group() for match in self.ticker_pattern.finditer(window))
+        for metrics in self.required.values():
+            for metric in metrics:
+                if metric not in self.covered_metrics and METRIC_PATTERNS[metric].search(window):
+                    self.covered_metrics.add(metric)
+
+    def missing(self) -> list:
+        missing = [f'ticker {ticker}' for ticker in self.required if ticker not in self.covered_tickers]
+        metrics = {metric for metrics in self.required.values() for metric in metrics}
+        missing += [f'metric {metric}' for metric in sorted(metrics - self.covered_metrics)]
+        return missing
+
+    def gave_up(self) -> bool:
+        """
+        whether the text is past its length budget and still leaves something out
+        """
+        return bool(STREAM_COVERAGE_CHARS and self.required
+                    and len(self.text) > STREAM_COVERAGE_CHARS * len(self.required) and self.missing())
+
+
+def get_partial_answer_path(run_id: str):
+    path = get_data_dir() / run_id
+    path.mkdir(parents=True, exist_ok=True)
+    return path / 'answer.partial.txt'
+
+
+def write_partial_answer(run_id: str, text: str):
+    path = get_partial_answer_path(run_id)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def stream_answer(chunks, agent_state, execution_result: dict):
+    """
+    consume the answer stream: every chunk goes to the sink registered for the run, the partial text is
+    checkpointed and the coverage of execution_result is tracked as the text arrives. when the text is past
+    its length budget and still leaves a ticker or metric out, the stream is closed without waiting for the rest
+    :return: text, stream stats with time to first token, what the answer left out and whether it was stopped
+    """
+    run_id = agent_state['run_id']
+    sink = get_sink(run_id)
+    tracker = CoverageTracker(execution_result)
+    start = time.perf_counter()
+    first_token_s = None
+    last_checkpoint = start
+    nchunks = 0
+    stopped = False
+    for chunk in chunks:
+        now = time.perf_counter()
+        if first_token_s is None:
+            first_token_s = now - start
+        nchunks += 1
+        tracker.update(chunk)
+        if sink is not None:
+            sink(chunk)
+        if now - last_checkpoint >= PARTIAL_CHECKPOINT_EVERY:
+            write_partial_answer(run_id, tracker.text)
+            last_checkpoint = now
+        if tracker.gave_up():
+            stopped = True
+            # closes the llm stream, the response is neither counted as accepted nor cached
+            chunks.close()
+            break
+    write_partial_answer(run_id, tracker.text)
+    return tracker.text, {'first_token_s': first_token_s,
+                          'total_s': time.perf_counter() - start,
+                          'chunks': nchunks,
+                          'missing': tracker.missing(),
+                          'stopped': stopped}
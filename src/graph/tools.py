@@ -1,30 +1,59 @@
-from dateutil.relativedelta import relativedelta
-import matplotlib.pyplot as plt
+import hashlib
+
+import numpy as np
 from src.graph.state import AgentState
-import yfinance as yf
 from src.graph.plan_tools import *
 
-from src.graph.util import get_price_data_path, get_chart_path
+from src.graph.util import get_price_data_path, get_chart_path, get_multi_chart_path, period_days, period_delta, get_data_dir
+from src.graph.price_source import get_price_source
+from src.graph.artifacts import read_series, write_artifact, artifact_suffix
+from src.graph import price_store
+from src.graph.charts import chart_line, chart_status, submit_chart
+from src.graph.prefetch import take_prefetched
+from src.graph import panel as price_panel
+from src.graph import metric_cache
+from src.graph.catalog import add_artifacts
+
+SUPPORTED_METRICS = ['return', 'vol']
+CROSS_ASSET_METRICS = ['corr', 'cov', 'beta', 'drawdown', 'portfolio_vol']
+# ranked pairs of a correlation kept in the state, and the size up to which the matrices are kept too
+TOP_PAIRS = 10
+INLINE_MATRIX_MAX = 10
+
+
+def price_path(ticker: str, agent_state: AgentState):
+    """
+    the price artifact registered for the ticker in AgentState['data'], which may be a shared price store artifact
+    """
+    return agent_state.get('data', {}).get(ticker) or get_price_data_path(ticker, agent_state['run_id'])
+
+
+def fetched_series(ticker: str, agent_state: AgentState):
+    """
+    the prices of the ticker over the period it was fetched for: a price store artifact holds the longest
+    history fetched so far
+    """
+    series = read_series(price_path(ticker, agent_state))
+    period = (agent_state.get('data_periods') or {}).get(ticker)
+    if period and len(series):
+        series = series.loc[series.index[-1] - period_delta(period):]
+    return series
 
 
 def calculate_return_runtime(ticker: str,
                              period: str,
                              agent_state: AgentState) -> dict:
-    price_data_path = get_price_data_path(ticker, agent_state['run_id'])
-    daily_price = pd.read_parquet(price_data_path).squeeze()
-    current_date = daily_price.index[-1]
-    if period[-1] == 'y':
-        time_delta = relativedelta(years=int(period[:-1]))
-    elif period[-1] == 'm':
-        time_delta = relativedelta(months=int(period[:-1]))
-    elif period[-1] == 'd':
-        time_delta = relativedelta(days=int(period[:-1]))
-    start_date = current_date - time_delta
-    price = daily_price.loc[start_date:]
-    return {'execution_result':
-                {ticker:
-                     {f'return_{period}': float(price.iloc[-1] / price.iloc[0] - 1)}
-                 },
+    price_data_path = price_path(ticker, agent_state)
+    key = f'return_{period}'
+    cached = metric_cache.get_metrics({ticker: price_data_path}, [key])
+    if ticker in cached:
+        return {'execution_result': cached,
+                'execution_status': [f'{period} return calculation of {ticker} status: success (cached)']}
+    daily_price = read_series(price_data_path)
+    price = daily_price.loc[daily_price.index[-1] - period_delta(period):]
+    execution_result = {ticker: {key: float(price.iloc[-1] / price.iloc[0] - 1)}}
+    metric_cache.put_metrics({ticker: price_data_path}, execution_result)
+    return {'execution_result': execution_result,
             'execution_status': [f'{period} return calculation of {ticker} status: success']
             }
 
@@ -32,24 +61,19 @@ def calculate_return_runtime(ticker: str,
 def calculate_vol_runtime(ticker: str,
                           period: str,
                           agent_state: AgentState) -> dict:
-    price_data_path = get_price_data_path(ticker, agent_state['run_id'])
-    daily_price = pd.read_parquet(price_data_path).squeeze()
+    price_data_path = price_path(ticker, agent_state)
+    key = f'vol_{period}'
+    cached = metric_cache.get_metrics({ticker: price_data_path}, [key])
+    if ticker in cached:
+        return {'execution_result': cached,
+                'execution_status': [f'status for {period} volatility calculate of {ticker}: success (cached)']}
+    daily_price = read_series(price_data_path)
     if daily_price is None:
         raise ValueError(f'the daily price for {ticker} is missing')
-    current_date = daily_price.index[-1]
-    if period[-1] == 'y':
-        time_delta = relativedelta(years=int(period[:-1]))
-    elif period[-1] == 'm':
-        time_delta = relativedelta(months=int(period[:-1]))
-    elif period[-1] == 'd':
-        time_delta = relativedelta(days=int(period[:-1]))
-    else:
-        raise ValueError(f'unsupported period: {period}')
-    start_date = current_date - time_delta
-    price = daily_price.loc[start_date:]
-    return {'execution_result':
-                {ticker: {f'vol_{period}': float(price.pct_change().std() * 252 ** 0.5)}
-                 },
+    price = daily_price.loc[daily_price.index[-1] - period_delta(period):]
+    execution_result = {ticker: {key: float(price.pct_change().std() * 252 ** 0.5)}}
+    metric_cache.put_metrics({ticker: price_data_path}, execution_result)
+    return {'execution_result': execution_result,
             'execution_status': [f'status for {period} volatility calculate of {ticker}: success']
             }
 
@@ -57,52 +81,270 @@ def calculate_vol_runtime(ticker: str,
 def get_stock_price_runtime(ticker: str,
                             period: str,
                             agent_state: AgentState) -> dict:
-    if period[-1] == 'm':
-        period = period + 'o'
-    df = yf.download(ticker, period=period)
-    df.columns = df.columns.droplevel(1)
+    return fetch_prices({ticker: period}, agent_state)
+
+
+def fetch_prices(periods: dict, agent_state: AgentState) -> dict:
+    """
+    fetch the price data of several tickers with one multi-ticker request to the price source
+    (AgentState['price_source'], yfinance by default) and register a per-ticker artifact in data.
+    tickers prefetched while the planner ran are served from the prefetch
+    :param periods: dict of ticker -> period
+    :param agent_state:
+    :return:
+    """
+    prefetched, periods = take_prefetched(periods, agent_state)
+    if not periods:
+        return prefetched
+    update = download_prices(periods, agent_state)
+    if prefetched:
+        update = {'data': {**prefetched['data'], **update['data']},
+                  'data_periods': {**prefetched['data_periods'], **update['data_periods']},
+                  'execution_status': prefetched['execution_status'] + update['execution_status']}
+    return update
 
-    fpath = get_price_data_path(ticker, agent_state['run_id'])
-    df[['Close']].to_parquet(fpath)
 
-    return {'data': {ticker: str(fpath)},
-            'execution_status': [f'load {period} price data for {ticker} status: success']
+def download_prices(periods: dict, agent_state: AgentState, subdir: str = None) -> dict:
+    """
+    the download of fetch_prices, through the price store when it is enabled
+    :param subdir: directory under data/<run_id> of the run artifacts written when the store is disabled
+    """
+    source = agent_state.get('price_source')
+    if price_store.STORE_ENABLED:
+        paths = price_store.get_price_paths(periods, source)
+        # the store does not evict the artifacts of a running run, recorded before the run ends
+        add_artifacts(agent_state['run_id'], [fpath for fpath, _ in paths.values()])
+        return {'data': {ticker: str(fpath) for ticker, (fpath, _) in paths.items()},
+                'data_periods': dict(periods),
+                'execution_status': [f'load {periods[ticker]} price data for {ticker} status: success{note}'
+                                     for ticker, (_, note) in paths.items()]
+                }
+    longest = max(periods.values(), key=period_days)
+    prices = get_price_source(source)(list(periods), period=longest)
+    data = {}
+    for ticker in periods:
+        if ticker not in prices:
+            raise ValueError(f'no price data returned for {ticker}')
+        fpath = write_artifact(get_price_data_path(ticker, agent_state['run_id'], subdir=subdir), prices[ticker])
+        data[ticker] = str(fpath)
+
+    return {'data': data,
+            'data_periods': dict(periods),
+            'execution_status': [f'load {period} price data for {ticker} status: success'
+                                 for ticker, period in periods.items()]
             }
 
 
+def calculate_metrics_runtime(tickers: list,
+                              periods: list,
+                              metrics: list,
+                              agent_state: AgentState) -> dict:
+    """
+    returns and volatilities of every (ticker, period) pair, from the metric cache or computed for the
+    tickers it misses in one pass over their price panel
+    """
+    unknown = set(metrics) - set(SUPPORTED_METRICS)
+    if unknown:
+        raise ValueError(f'unsupported metrics {sorted(unknown)}, use {SUPPORTED_METRICS}')
+    tickers = list(dict.fromkeys(tickers))
+    keys = [f'{metric}_{period}' for period in periods for metric in SUPPORTED_METRICS if metric in metrics]
+    paths = {ticker: str(price_path(ticker, agent_state)) for ticker in tickers}
+    cached = metric_cache.get_metrics(paths, keys)
+    missing = [ticker for ticker in tickers if len(cached.get(ticker, {})) < len(keys)]
+    computed = {}
+    if missing:
+        computed = panel_metrics(missing, periods, metrics, agent_state)
+        metric_cache.put_metrics({ticker: paths[ticker] for ticker in missing}, computed)
+    execution_result = {ticker: {key: computed[ticker][key] if ticker in computed else cached[ticker][key]
+                                 for key in keys}
+                        for ticker in tickers}
+    note = f' ({len(tickers) - len(missing)} tickers cached)' if len(missing) < len(tickers) else ''
+    return {'execution_result': execution_result,
+            'execution_status': [f'{"/".join(metrics)} calculation of {tickers} for {periods} status: success{note}']
+            }
+
+
+def panel_metrics(tickers: list, periods: list, metrics: list, agent_state: AgentState) -> dict:
+    """
+    returns and volatilities of the tickers in one pass over a date-aligned price matrix.
+    each window is answered from prefix sums: the return from the log price (prefix sum of log returns)
+    at both ends of the window, the volatility from prefix sums of simple returns and squared returns.
+    gives the same numbers as calculate_return_runtime/calculate_vol_runtime
+    :return: ticker -> {metric_period: value}
+    """
+    panel = price_panel.build_panel(tickers, agent_state)
+    tickers = panel.tickers
+    dates = panel.dates
+    n_dates = len(dates)
+    observed = ~np.isnan(panel.prices)
+    filled = pd.DataFrame(panel.prices).ffill().to_numpy(dtype=np.float64)
+
+    # simple returns against the previous observation of the same ticker, as pct_change on its own series
+    rets = np.full(filled.shape, np.nan)
+    rets[1:] = np.where(observed[1:], filled[1:] / filled[:-1] - 1, np.nan)
+    has_ret = ~np.isnan(rets)
+    rets = np.where(has_ret, rets, 0.0)
+    zeros = np.zeros((1, len(tickers)))
+    sum1 = np.vstack([zeros, np.cumsum(rets, axis=0)])
+    sum2 = np.vstack([zeros, np.cumsum(rets ** 2, axis=0)])
+    count = np.vstack([zeros, np.cumsum(has_ret, axis=0)])
+    log_price = np.log(filled)
+
+    # first observed row at or after each row, per ticker
+    rows = np.where(observed, np.arange(n_dates)[:, None], n_dates)
+    next_observed = np.minimum.accumulate(rows[::-1], axis=0)[::-1]
+    cols = np.arange(len(tickers))
+    end = n_dates - 1 - np.argmax(observed[::-1], axis=0)
+    last_dates = dates[end]
+
+    execution_result = {ticker: {} for ticker in tickers}
+    for period in periods:
+        unit = {'y': 'years', 'm': 'months', 'd': 'days'}[period[-1]]
+        start_dates = last_dates - pd.DateOffset(**{unit: int(period[:-1])})
+        first = next_observed[np.searchsorted(dates, start_dates, side='left'), cols]
+        values = {}
+        if 'return' in metrics:
+            values['return'] = np.exp(log_price[end, cols] - log_price[first, cols]) - 1
+        if 'vol' in metrics:
+            # the first return inside the window is measured against a price outside of it
+            s1 = sum1[end + 1, cols] - sum1[first + 1, cols]
+            s2 = sum2[end + 1, cols] - sum2[first + 1, cols]
+            n = count[end + 1, cols] - count[first + 1, cols]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                variance = (s2 - s1 ** 2 / n) / (n - 1)
+            values['vol'] = np.sqrt(np.maximum(variance, 0) * 252)
+        for metric, metric_values in values.items():
+            for ticker, value in zip(tickers, metric_values):
+                execution_result[ticker][f'{metric}_{period}'] = float(value)
+    return execution_result
+
+
 def plot_runtime(ticker: str,
                  agent_state: AgentState) -> dict:
-    price_data_path = get_price_data_path(ticker, agent_state['run_id'])
-    time_series = pd.read_parquet(price_data_path).squeeze()
+    time_series = fetched_series(ticker, agent_state)
     if len(time_series) == 0:
         raise ValueError(f'the price data for {ticker} is missing')
-    fig, ax = plt.subplots()
-    time_series.plot(ax=ax)
-
     fpath = get_chart_path(ticker, agent_state['run_id'])
-
-    plt.savefig(fpath)
-    plt.close(fig)
+    label = f'chat plot for {ticker}'
+    chart = submit_chart(agent_state['run_id'], [ticker], 'chart', fpath,
+                         [chart_line(ticker, time_series)], title=ticker, label=label)
 
     return {'execution_result':
-                {ticker: {'chart': {'status': 'ok',
-                                    'path': str(fpath)
-                                    }
-                          }
+                {ticker: {'chart': chart}
                  },
-            'execution_status': [f'chat plot for {ticker} status: success']
+            'execution_status': chart_status(label, chart)
+            }
+
+
+def plot_multi_runtime(tickers: list,
+                       agent_state: AgentState) -> dict:
+    lines = []
+    series = {ticker: fetched_series(ticker, agent_state).dropna() for ticker in tickers}
+    if any(len(s) == 0 for s in series.values()):
+        raise ValueError(f'the price data for {[t for t, s in series.items() if len(s) == 0]} is missing')
+    # every line is rebased to 100 at the first date all tickers have a price
+    start = max(s.index[0] for s in series.values())
+    for ticker, s in series.items():
+        s = s.loc[start:]
+        lines.append(chart_line(ticker, s / s.iloc[0] * 100))
+
+    fpath = get_multi_chart_path(tickers, agent_state['run_id'])
+    label = f'combined chart for {tickers}'
+    chart = submit_chart(agent_state['run_id'], tickers, 'chart_combined', fpath, lines,
+                         title=', '.join(tickers), ylabel='rebased to 100', label=label)
+
+    return {'execution_result': {ticker: {'chart_combined': chart} for ticker in tickers},
+            'execution_status': chart_status(label, chart)
+            }
+
+
+def cross_asset_key(tickers: list, benchmark: str = None) -> str:
+    """
+    short key of the ticker set and benchmark of a cross-asset step, in its result keys and artifact names
+    so steps over other tickers of the same period do not overwrite them
+    """
+    return hashlib.sha256(f'{",".join(sorted(set(tickers)))}|{benchmark or ""}'.encode()).hexdigest()[:8]
+
+
+def calculate_cross_asset_runtime(tickers: list,
+                                  period: str,
+                                  metrics: list,
+                                  agent_state: AgentState,
+                                  benchmark: str = None,
+                                  weights: list = None) -> dict:
+    """
+    cross-asset analytics of several tickers over the period, vectorized over the aligned price panel:
+    - corr/cov: matrices written as artifacts under data/<run_id>, the most and least correlated pairs
+      (and the matrices themselves for a few tickers) go into execution_result['cross_asset'], keyed by
+      <metric>_<period>_<cross_asset_key>
+    - beta against the benchmark and max drawdown: per ticker, beta_<period> and drawdown_<period>
+    - portfolio_vol: annualized vol of the tickers with the weights, equal weights by default
+    """
+    unknown = set(metrics) - set(CROSS_ASSET_METRICS)
+    if unknown:
+        raise ValueError(f'unsupported metrics {sorted(unknown)}, use {CROSS_ASSET_METRICS}')
+    tickers = list(dict.fromkeys(tickers))
+    columns = tickers + [benchmark] if benchmark and benchmark not in tickers else tickers
+    panel = price_panel.build_panel(columns, agent_state)
+    prices = price_panel.window(panel, period)
+    returns = price_panel.daily_returns(prices)
+    n = len(tickers)
+    suffix = f'{period}_{cross_asset_key(tickers, benchmark)}'
+
+    execution_result = {ticker: {} for ticker in tickers}
+    cross_asset = {}
+    if {'corr', 'cov', 'portfolio_vol'} & set(metrics):
+        cov, corr, _ = price_panel.pairwise_cov(returns[:, :n])
+        run_dir = get_data_dir() / agent_state['run_id']
+        for metric, matrix in [('corr', corr), ('cov', cov)]:
+            if metric not in metrics:
+                continue
+            frame = pd.DataFrame(matrix, index=tickers, columns=tickers)
+            path = write_artifact(run_dir / f'{metric}_{suffix}{artifact_suffix()}', frame)
+            entry = {'path': str(path)}
+            if metric == 'corr':
+                entry['most_correlated'], entry['least_correlated'] = price_panel.ranked_pairs(corr, tickers, TOP_PAIRS)
+            if n <= INLINE_MATRIX_MAX:
+                entry['matrix'] = {ticker: {other: round(float(v), 6) for other, v in zip(tickers, row)}
+                                   for ticker, row in zip(tickers, matrix)}
+            cross_asset[f'{metric}_{suffix}'] = entry
+        if 'portfolio_vol' in metrics:
+            w = np.full(n, 1 / n) if not weights else np.asarray(weights, dtype=np.float64) / np.sum(weights)
+            cross_asset[f'portfolio_vol_{suffix}'] = price_panel.portfolio_vol(cov, w)
+            if weights:
+                cross_asset[f'portfolio_weights_{suffix}'] = dict(zip(tickers, map(float, w)))
+    if 'beta' in metrics:
+        if not benchmark:
+            raise ValueError('beta needs a benchmark ticker')
+        values = price_panel.betas(returns, columns.index(benchmark))
+        for ticker, value in zip(tickers, values):
+            execution_result[ticker][f'beta_{period}'] = float(value)
+    if 'drawdown' in metrics:
+        for ticker, value in zip(tickers, price_panel.max_drawdowns(prices[:, :n])):
+            execution_result[ticker][f'drawdown_{period}'] = float(value)
+    if cross_asset:
+        execution_result['cross_asset'] = cross_asset
+
+    return {'execution_result': execution_result,
+            'execution_status': [f'{"/".join(metrics)} of {len(tickers)} tickers for {period} status: success']
             }
 
 
 tools = [calculate_return_runtime,
          calculate_vol_runtime,
          get_stock_price_runtime,
-         plot_runtime]
+         plot_runtime,
+         calculate_metrics_runtime,
+         plot_multi_runtime,
+         calculate_cross_asset_runtime]
 tool_names = [t.__name__ for t in tools]
 plan_tools = [plan_calculate_return,
               plan_calculate_vol,
               plan_get_stock_price,
-              plan_plot]
+              plan_plot,
+              plan_calculate_metrics,
+              plan_plot_multi,
+              plan_calculate_cross_asset]
 plan_tool_names = [t.__name__ for t in plan_tools]
 
 TOOLS_REGISTRY = {}
@@ -1,35 +1,39 @@
+import hashlib
 import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
 from pathlib import Path
 
+from dateutil.relativedelta import relativedelta
+
+from src.graph.profiling import count
 from src.graph.state import AgentState
 
 
 def get_next_run_id(agent_state:AgentState):
-    data_dir = get_data_dir()
-    folder_names = [dir_name for dir_name in data_dir.iterdir() if agent_state['mode'] in str(dir_name)]
-    if len(folder_names)==0:
-        return agent_state['mode']+f"_{1:04d}"
-    else:
-        max_num = max([int(str(folder_name).split('_')[-1]) for folder_name in folder_names])
-        return agent_state['mode'] + f'_{max_num+1:04d}'
+    from src.graph.catalog import allocate_run_id
+    return allocate_run_id(agent_state['mode'], agent_state.get('query'))
 
 
 def save_state(agent_state:AgentState):
-    state_path = get_state_path(agent_state['run_id'])
-    with open(state_path,'w') as f:
-        f.write(json.dumps(agent_state,indent=2, default=str))
+    from src.graph.checkpoint import save_state as checkpoint_save_state
+    checkpoint_save_state(agent_state)
 
 
 def load_state(run_id:str):
-    state_path = get_state_path(run_id)
-    with open(state_path,'r',encoding='utf-8') as f:
-        agent_state = json.loads(f.read())
-    return agent_state
+    from src.graph.checkpoint import load_state as checkpoint_load_state
+    return checkpoint_load_state(run_id)
 
 
-def get_price_data_path(ticker, run_id):
-    fname = f"{ticker}.parquet"
-    path = Path.cwd().parent.parent / 'data' / run_id
+def get_price_data_path(ticker, run_id, fmt=None, subdir=None):
+    from src.graph.artifacts import artifact_suffix
+    fname = f"{ticker}{artifact_suffix(fmt)}"
+    path = get_data_dir() / run_id
+    if subdir:
+        path = path / subdir
     path.mkdir(parents=True, exist_ok=True)
     fpath = path / fname
     return fpath
@@ -37,23 +41,133 @@ def get_price_data_path(ticker, run_id):
 
 def get_chart_path(ticker, run_id):
     fname = f"{ticker}.png"
-    path = Path.cwd().parent.parent / 'data' / run_id
+    path = get_data_dir() / run_id
+    path.mkdir(parents=True, exist_ok=True)
+    fpath = path / fname
+    return fpath
+
+
+def get_multi_chart_path(tickers, run_id):
+    """
+    chart of several tickers, named by a short hash of the sorted tickers so the name does not grow with them
+    """
+    key = hashlib.sha256('-'.join(sorted(tickers)).encode()).hexdigest()[:12]
+    fname = f"multi-{key}.png"
+    path = get_data_dir() / run_id
     path.mkdir(parents=True, exist_ok=True)
     fpath = path / fname
     return fpath
 
 
 def get_state_path(run_id):
-    path = Path.cwd().parent.parent / 'data' / run_id
+    path = get_data_dir() / run_id
     path.mkdir(parents=True, exist_ok=True)
     fpath = path / 'state.json'
     return fpath
 
 
 def get_data_dir():
-    path = Path.cwd().parent.parent / 'data'
+    path = Path(os.getenv('AGENTFLOW_DATA_DIR', Path.cwd().parent.parent / 'data'))
+    path.mkdir(parents=True, exist_ok=True)
     return path
 
 
 def gemini_json(response:str):
     return json.loads(response.replace('```json','').replace('```','').strip())
+
+
+def period_delta(period: str) -> relativedelta:
+    if period[-1] == 'y':
+        return relativedelta(years=int(period[:-1]))
+    elif period[-1] == 'm':
+        return relativedelta(months=int(period[:-1]))
+    elif period[-1] == 'd':
+        return relativedelta(days=int(period[:-1]))
+    raise ValueError(f'unsupported period: {period}')
+
+
+def period_days(period: str) -> int:
+    """
+    length of a period in calendar days counted back from today, used to compare periods
+    """
+    today = date.today()
+    return (today - (today - period_delta(period))).days
+
+
+@contextmanager
+def file_lock(path, timeout: float = 30, stale_after: float = 120):
+    """
+    cross-process lock based on exclusive creation of a lock file, works the same on windows and posix
+    :param path: lock file path
+    :param timeout: seconds to wait for the lock
+    :param stale_after: a lock file older than this is considered left over by a crashed process,
+        on posix a lock whose owner process is gone is taken over right away
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - path.stat().st_mtime > stale_after or _lock_owner_dead(path):
+                    path.unlink()
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'could not acquire lock {path}')
+            time.sleep(0.01)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _lock_owner_dead(path) -> bool:
+    if os.name != 'posix':
+        return False
+    try:
+        pid = int(path.read_text())
+    except ValueError:
+        # the owner has not written its pid yet
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def load_json(path, default=None):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return default
+
+
+def write_json_atomic(path, obj):
+    path = Path(path)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    content = json.dumps(obj, indent=2, default=str)
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    count('bytes_written', len(content))
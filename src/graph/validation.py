@@ -1,7 +1,35 @@
+import copy
 import inspect
+import json
 import re
 
-from src.graph.tools import plan_tool_names, PLAN_TOOL_TOOL_MAP
+from src.graph.tools import plan_tool_names, PLAN_TOOL_TOOL_MAP, SUPPORTED_METRICS, CROSS_ASSET_METRICS
+from src.graph.util import period_days
+
+FETCH_ACTIONS = ['plan_get_stock_price']
+DATA_ACTIONS = ['plan_calculate_vol', 'plan_calculate_return', 'plan_plot', 'plan_calculate_metrics', 'plan_plot_multi',
+                'plan_calculate_cross_asset']
+# metrics each action supports
+ACTION_METRICS = {'plan_calculate_metrics': SUPPORTED_METRICS, 'plan_calculate_cross_asset': CROSS_ASSET_METRICS}
+# cross-asset metrics comparing tickers with each other
+PAIRWISE_METRICS = ['corr', 'cov', 'portfolio_vol']
+PERIOD_PATTERN = r'^\d{1,2}(d|m|y)$'
+LOOSE_PERIOD_PATTERN = r'^\s*(\d{1,2})\s*(years?|yrs?|y|months?|mos?|mo|m|days?|d)\s*$'
+# fetch period inserted for a ticker that is only plotted
+DEFAULT_FETCH_PERIOD = '1y'
+
+
+def plan_tickers(plan) -> list:
+    """
+    tickers a plan step works on, from its ticker or tickers parameter, and its benchmark
+    """
+    params = plan['params']
+    if 'ticker' in params:
+        return [params['ticker']] if isinstance(params['ticker'], str) else []
+    tickers = params.get('tickers', [])
+    tickers = [ticker for ticker in tickers if isinstance(ticker, str)] if isinstance(tickers, list) else []
+    benchmark = params.get('benchmark')
+    return tickers + [benchmark] if isinstance(benchmark, str) and benchmark not in tickers else tickers
 
 
 def check_parameters(func:callable, params:dict):
@@ -33,17 +61,41 @@ def check_data_availability(plans):
     data_seen = set()
     for plan in plans:
 
-        ticker = plan['params']['ticker']
-        if plan['action'] == 'plan_get_stock_price':
-            data_seen.add(ticker)
-        elif plan['action'] in ['plan_calculate_vol', 'plan_calculate_return', 'plan_plot']:
-            if not ticker in data_seen:
-                msg.append(
-                    f'data for {ticker} not seen, use plan_get_stock_price to get the data, period needs to be equal to or longer than the period required for metrics calculations')
+        for ticker in plan_tickers(plan):
+            if plan['action'] in FETCH_ACTIONS:
+                data_seen.add(ticker)
+            elif plan['action'] in DATA_ACTIONS:
+                if not ticker in data_seen:
+                    msg.append(
+                        f'data for {ticker} not seen, use plan_get_stock_price to get the data, period needs to be equal to or longer than the period required for metrics calculations')
     msg = list(set(msg))
     return msg
 
 
+def plan_dependencies(plans):
+    """
+    turn the plan into a dependency graph with the fetch-before-compute rule of check_data_availability:
+    a compute step depends on the latest fetch of each of its tickers, a fetch depends on every earlier step of its ticker
+    :param plans:
+    :return: list of sets, the plan indices each step waits for
+    """
+    deps = []
+    last_fetch = {}
+    ticker_steps = {}
+    for i, plan in enumerate(plans):
+        step_deps = set()
+        for ticker in plan_tickers(plan):
+            if plan['action'] in FETCH_ACTIONS:
+                step_deps.update(ticker_steps.get(ticker, []))
+                last_fetch[ticker] = i
+            elif ticker in last_fetch:
+                step_deps.add(last_fetch[ticker])
+            ticker_steps.setdefault(ticker, []).append(i)
+        step_deps.discard(i)
+        deps.append(step_deps)
+    return deps
+
+
 def check_plans(plans: list):
     msg = []
     invalid_functions = []
@@ -68,11 +120,174 @@ def check_plans(plans: list):
     for plan in plans:
         period = plan['params'].get('period')
         if period:
-            pattern = '^\d{1,2}(d|m|y)$'
-            if not bool(re.match(pattern, period)):
+            if not bool(re.match(PERIOD_PATTERN, period)):
                 func = plan['action']
                 ticker = plan['params'].get('ticker')
                 msg.append(
                     f'period for func {func} and ticker {ticker} must follow 1d, 2m, or 1y')
+        periods = plan['params'].get('periods')
+        if isinstance(periods, list):
+            for period in periods:
+                if not isinstance(period, str) or not bool(re.match(PERIOD_PATTERN, period)):
+                    msg.append(
+                        f'periods for func {plan["action"]} must follow 1d, 2m, or 1y, get {period}')
 
+    ## check metrics
+    for plan in plans:
+        metrics = plan['params'].get('metrics')
+        if isinstance(metrics, list):
+            supported = ACTION_METRICS.get(plan['action'], SUPPORTED_METRICS)
+            unknown = [metric for metric in metrics if metric not in supported]
+            if unknown:
+                msg.append(
+                    f'metrics {unknown} for func {plan["action"]} not supported, use {supported}')
+
+    msg = msg + check_cross_asset(plans)
     return msg
+
+
+def check_cross_asset(plans: list):
+    """
+    multi-ticker rules of plan_calculate_cross_asset: pairwise metrics need two tickers,
+    beta needs a benchmark, weights need one number per ticker
+    """
+    msg = []
+    for plan in plans:
+        if plan['action'] != 'plan_calculate_cross_asset':
+            continue
+        params = plan['params']
+        tickers = params.get('tickers')
+        metrics = params.get('metrics')
+        if not isinstance(tickers, list) or not isinstance(metrics, list):
+            continue
+        if len(set(tickers)) < 2 and set(metrics) & set(PAIRWISE_METRICS):
+            msg.append(f'{plan["action"]}: {sorted(set(metrics) & set(PAIRWISE_METRICS))} need at least 2 tickers, '
+                       f'get {tickers}')
+        benchmark = params.get('benchmark')
+        if 'beta' in metrics and not isinstance(benchmark, str):
+            msg.append(f'{plan["action"]}: beta needs a benchmark ticker, e.g. "SPY"')
+        weights = params.get('weights')
+        if weights is not None:
+            if not isinstance(weights, list) or len(weights) != len(tickers) \
+                    or not all(isinstance(w, (int, float)) and w >= 0 for w in weights) or not sum(weights):
+                msg.append(f'{plan["action"]}: weights must be {len(tickers)} non-negative numbers, '
+                           f'one per ticker, get {weights}')
+    return msg
+
+
+def normalize_period(period):
+    """
+    bring period spellings like 1Y, 12mo, 6 months, 1 year to the plan format 1y, 12m, 6m
+    """
+    if not isinstance(period, str):
+        return period
+    match = re.match(LOOSE_PERIOD_PATTERN, period, re.IGNORECASE)
+    if not match:
+        return period
+    return f'{int(match.group(1))}{match.group(2)[0].lower()}'
+
+
+def _valid_period(period) -> bool:
+    return isinstance(period, str) and bool(re.match(PERIOD_PATTERN, period))
+
+
+def _longest(period_a, period_b):
+    if period_a is None:
+        return period_b
+    if period_b is None:
+        return period_a
+    return period_a if period_days(period_a) >= period_days(period_b) else period_b
+
+
+def _step_periods(plan) -> list:
+    params = plan['params']
+    if 'period' in params:
+        return [params['period']]
+    periods = params.get('periods', [])
+    return periods if isinstance(periods, list) else []
+
+
+def optimize_plans(plans):
+    """
+    fix and tighten a plan locally before it is validated, so the planner LLM is only asked again
+    for errors that cannot be fixed here:
+    - period spellings are normalized
+    - every ticker gets exactly one fetch, inserted when missing and covering the longest period its steps need
+    - duplicated steps are dropped
+    - steps are grouped by ticker after the fetches, so the price series of a ticker is read back to back
+    tickers with a period that still does not validate are left as they are for check_plans to report
+    :param plans: plan from the planner
+    :return: optimized plan, list of changes made
+    """
+    well_formed = isinstance(plans, list) and all(
+        isinstance(plan, dict) and 'action' in plan and isinstance(plan.get('params'), dict) for plan in plans)
+    if not well_formed:
+        return plans, []
+    plans = copy.deepcopy(plans)
+    changes = []
+
+    for plan in plans:
+        params = plan['params']
+        if 'period' in params:
+            period = normalize_period(params['period'])
+            if period != params['period']:
+                changes.append(f'period {params["period"]} of {plan["action"]} normalized to {period}')
+                params['period'] = period
+        if isinstance(params.get('periods'), list):
+            periods = [normalize_period(period) for period in params['periods']]
+            if periods != params['periods']:
+                changes.append(f'periods {params["periods"]} of {plan["action"]} normalized to {periods}')
+                params['periods'] = periods
+
+    tickers, fetch_period, fetch_count, needed, skipped = [], {}, {}, {}, set()
+    for plan in plans:
+        for ticker in plan_tickers(plan):
+            if ticker not in tickers:
+                tickers.append(ticker)
+            periods = _step_periods(plan)
+            if not all(_valid_period(period) for period in periods):
+                skipped.add(ticker)
+                continue
+            if plan['action'] in FETCH_ACTIONS:
+                fetch_count[ticker] = fetch_count.get(ticker, 0) + 1
+                fetch_period[ticker] = _longest(fetch_period.get(ticker), periods[0] if periods else None)
+            elif plan['action'] in DATA_ACTIONS:
+                needed.setdefault(ticker, None)
+                for period in periods:
+                    needed[ticker] = _longest(needed[ticker], period)
+
+    fetches = []
+    for ticker in tickers:
+        if ticker in skipped or (ticker not in fetch_period and ticker not in needed):
+            continue
+        period = _longest(fetch_period.get(ticker), needed.get(ticker)) or DEFAULT_FETCH_PERIOD
+        fetches.append({'action': FETCH_ACTIONS[0], 'params': {'ticker': ticker, 'period': period}})
+        if ticker not in fetch_count:
+            changes.append(f'inserted plan_get_stock_price for {ticker} with period {period}')
+        elif fetch_count[ticker] > 1:
+            changes.append(f'merged {fetch_count[ticker]} plan_get_stock_price steps for {ticker} into one with period {period}')
+        elif period != fetch_period[ticker]:
+            changes.append(f'extended plan_get_stock_price period for {ticker} from {fetch_period[ticker]} to {period}')
+    merged = {fetch['params']['ticker'] for fetch in fetches}
+
+    rest, seen = [], set()
+    for plan in plans:
+        if plan['action'] in FETCH_ACTIONS and set(plan_tickers(plan)) <= merged and plan_tickers(plan):
+            continue
+        key = json.dumps(plan, sort_keys=True, default=str)
+        if key in seen:
+            changes.append(f'removed duplicate step {plan["action"]} {plan["params"]}')
+            continue
+        seen.add(key)
+        rest.append(plan)
+
+    def locality(plan):
+        step_tickers = plan_tickers(plan)
+        if len(step_tickers) == 1:
+            return tickers.index(step_tickers[0])
+        return len(tickers)
+
+    grouped = sorted(rest, key=locality)
+    if grouped != rest:
+        changes.append('grouped steps by ticker')
+    return fetches + grouped, changes
@@ -0,0 +1,345 @@
+import argparse
+import json
+import math
+import os
+import time
+from collections import deque
+from pathlib import Path
+
+import pandas as pd
+
+from src.graph import price_store
+from src.graph.artifacts import read_series, write_artifact
+from src.graph.catalog import set_status, upsert_run
+from src.graph.charts import collect_charts
+from src.graph.checkpoint import apply_update, load_state, save_state, state_reducers
+from src.graph.coverage import metric_name
+from src.graph.logger import get_logger
+from src.graph.metric_cache import put_metrics
+from src.graph.price_source import get_price_source
+from src.graph.reducers import Replace
+from src.graph.scheduler import run_step
+from src.graph.util import period_delta, period_days, get_price_data_path
+from src.graph.validation import FETCH_ACTIONS, plan_tickers
+
+logger = get_logger('watch')
+
+# change of a return or vol (as a fraction, 0.01 is one percentage point) against the value the answer was
+# written from, above which the answer and critic run again
+WATCH_THRESHOLD = float(os.getenv('AGENTFLOW_WATCH_THRESHOLD', 0.01))
+# seconds between two refreshes of the watch loop
+WATCH_EVERY = float(os.getenv('AGENTFLOW_WATCH_EVERY', 300))
+STREAMED_METRICS = ['return', 'vol']
+# plan steps whose output is updated by the rolling stats instead of running the step again
+STREAMED_ACTIONS = ['plan_calculate_return', 'plan_calculate_vol', 'plan_calculate_metrics']
+TRADING_DAYS = 252
+
+
+class RollingStats:
+    """
+    return and volatility over the prices within a period of the last date, as calculate_return_runtime and
+    calculate_vol_runtime compute them, updated in O(1) per bar: a bar adds its return to running sums,
+    bars leaving the window take theirs out
+    """
+
+    def __init__(self, period: str):
+        self.delta = period_delta(period)
+        # (date, price) of the bars in the window
+        self.window = deque()
+        # sum and sum of squares of the simple returns between consecutive bars of the window
+        self.s1 = 0.0
+        self.s2 = 0.0
+        self.evicted = 0
+
+    def _add(self, ret: float, sign: int):
+        self.s1 += sign * ret
+        self.s2 += sign * ret * ret
+
+    def push(self, day, price: float):
+        if math.isnan(price):
+            return
+        if self.window and day <= self.window[-1][0]:
+            if day < self.window[-1][0]:
+                return
+            # the last bar was revised
+            self.pop_last()
+        if self.window:
+            self._add(price / self.window[-1][1] - 1, 1)
+        self.window.append((day, price))
+        start = day - self.delta
+        while self.window[0][0] < start:
+            _, dropped = self.window.popleft()
+            self._add(self.window[0][1] / dropped - 1, -1)
+            self.evicted += 1
+        if self.evicted >= len(self.window):
+            # the running sums are summed again once per window length of evictions, rounding errors do not
+            # build up and the cost stays O(1) per bar
+            self.resum()
+
+    def pop_last(self):
+        day, price = self.window.pop()
+        if self.window:
+            self._add(price / self.window[-1][1] - 1, -1)
+
+    def resum(self):
+        prices = [price for _, price in self.window]
+        rets = [b / a - 1 for a, b in zip(prices, prices[1:])]
+        self.s1 = sum(rets)
+        self.s2 = sum(ret * ret for ret in rets)
+        self.evicted = 0
+
+    def seed(self, series: pd.Series):
+        """
+        the bars of the series within the period of its last date
+        """
+        for day, price in series.loc[series.index[-1] - self.delta:].items():
+            self.push(day, float(price))
+
+    def value(self, metric: str) -> float:
+        if metric == 'return':
+            return self.window[-1][1] / self.window[0][1] - 1
+        n = len(self.window) - 1
+        if n < 2:
+            return float('nan')
+        variance = (self.s2 - self.s1 * self.s1 / n) / (n - 1)
+        return math.sqrt(max(variance, 0.0) * TRADING_DAYS)
+
+
+def fetch_periods(plans: list) -> dict:
+    """
+    ticker -> longest period the fetch steps of the plan ask for
+    """
+    periods = {}
+    for step in plans:
+        if step['action'] not in FETCH_ACTIONS:
+            continue
+        for ticker in plan_tickers(step):
+            period = step['params']['period']
+            if ticker not in periods or period_days(period) > period_days(periods[ticker]):
+                periods[ticker] = period
+    return periods
+
+
+def append_bars(periods: dict, agent_state: dict) -> dict:
+    """
+    bring the price artifacts of the run up to date with the bars since their last date (the last one included,
+    it may have been revised): a top-up of the price store, or the per-run artifacts when the store is disabled
+    :return: ticker -> path of the up to date artifact
+    """
+    source = agent_state.get('price_source')
+    if price_store.STORE_ENABLED:
+        paths = price_store.get_price_paths(periods, source, max_age=0)
+        return {ticker: str(path) for ticker, (path, _) in paths.items()}
+    data = agent_state.get('data') or {}
+    # without the store only the run's own artifacts are topped up, a ticker whose fetch failed has none
+    missing = [ticker for ticker in periods if not data.get(ticker) or not Path(data[ticker]).exists()]
+    if missing:
+        logger.info(f'{agent_state["run_id"]}: no price artifact for {missing}, not topped up')
+        periods = {ticker: period for ticker, period in periods.items() if ticker not in missing}
+    if not periods:
+        return {}
+    old = {ticker: read_series(data[ticker]).to_frame('Close') for ticker in periods}
+    start = min(df.index[-1] for df in old.values())
+    new = get_price_source(source)(list(periods), start=start.date())
+    paths = {}
+    for ticker in periods:
+        path = get_price_data_path(ticker, agent_state['run_id'])
+        merged = pd.concat([old[ticker], new[ticker]]) if ticker in new else old[ticker]
+        merged = merged[~merged.index.duplicated(keep='last')].sort_index()
+        if not merged.equals(old[ticker]) or str(path) != data[ticker]:
+            write_artifact(path, merged)
+        paths[ticker] = str(path)
+    return paths
+
+
+def recomputed(update: dict) -> dict:
+    """
+    update of a plan step run again: its cross_asset entries replace the ones of the earlier run instead of being
+    merged into them, the ranked pairs would be appended to the old ones
+    """
+    cross_asset = update.get('execution_result', {}).get('cross_asset')
+    if not cross_asset:
+        return update
+    cross_asset = {key: Replace(value) if isinstance(value, dict) else value for key, value in cross_asset.items()}
+    return {**update, 'execution_result': {**update['execution_result'], 'cross_asset': cross_asset}}
+
+
+def streamed_values(execution_result: dict) -> dict:
+    """
+    ticker -> {key: value} of the returns and vols of execution_result
+    """
+    values = {}
+    for ticker, results in execution_result.items():
+        if not isinstance(results, dict):
+            continue
+        for key, value in results.items():
+            if metric_name(key) in STREAMED_METRICS and isinstance(value, (int, float)):
+                values.setdefault(ticker, {})[key] = value
+    return values
+
+
+class Watch:
+    """
+    keeps a completed run up to date as new bars arrive: its validated plans are reused, new bars are appended
+    to its price artifacts, returns and vols are updated by rolling stats kept in memory between refreshes,
+    the charts of tickers with new bars are rendered again, and the answer and critic only run again when a
+    metric moved past the threshold since the answer
+    """
+
+    def __init__(self, run_id: str, threshold: float = None, graph_app=None):
+        self.run_id = run_id
+        self.threshold = WATCH_THRESHOLD if threshold is None else threshold
+        self.graph_app = graph_app
+        # (ticker, period) -> RollingStats, seeded from the artifacts on the first refresh
+        self.rolling = {}
+        # ticker -> (last date, last close) seen
+        self.last_bars = {}
+        # the catalog has the run as watching
+        self.watching = False
+
+    def rolling_stats(self, ticker: str, period: str, series: pd.Series) -> RollingStats:
+        key = (ticker, period)
+        if key not in self.rolling:
+            self.rolling[key] = RollingStats(period)
+            self.rolling[key].seed(series)
+        return self.rolling[key]
+
+    def new_bars(self, ticker: str, series: pd.Series) -> pd.Series:
+        """
+        bars of the series after the last one seen, and the last one seen when it was revised
+        """
+        last = self.last_bars.get(ticker)
+        if last is None:
+            return series.iloc[:0]
+        day, price = last
+        bars = series.loc[day:]
+        if len(bars) and bars.index[0] == day and bars.iloc[0] == price:
+            bars = bars.iloc[1:]
+        return bars
+
+    def refresh(self) -> dict:
+        """
+        one refresh of the run, its checkpoint is updated
+        :return: new bars per ticker, updated and moved metrics, charts rendered again, whether the run was answered again
+        """
+        agent_state = load_state(self.run_id)
+        plans = agent_state.get('plans') or []
+        if not agent_state.get('final_answer'):
+            logger.info(f'{self.run_id}: not completed, resume it first, refresh skipped')
+            return {'run_id': self.run_id, 'skipped': 'not completed', 'new_bars': {}, 'updated': {}, 'moved': [],
+                    'charts': [], 'answered': False, 'final_answer': None}
+        reducers = state_reducers()
+        watch = agent_state.get('watch') or {}
+        # the values the answer was written from
+        answered = watch.get('answered_result') or streamed_values(agent_state.get('execution_result', {}))
+        periods = fetch_periods(plans)
+        # the windows are seeded from the data the current metrics were computed from. a ticker whose artifact
+        # is gone is seeded from the topped up data on the next refresh
+        for ticker in periods:
+            path = (agent_state.get('data') or {}).get(ticker)
+            if ticker not in self.last_bars and path and Path(path).exists():
+                series = read_series(path)
+                self.last_bars[ticker] = (series.index[-1], float(series.iloc[-1]))
+                for key in agent_state.get('execution_result', {}).get(ticker, {}):
+                    if metric_name(key) in STREAMED_METRICS:
+                        self.rolling_stats(ticker, key.split('_', 1)[1], series)
+        paths = append_bars(periods, agent_state)
+        apply_update(agent_state, {'data': paths}, reducers)
+
+        new_bars, updated = {}, {}
+        for ticker, path in paths.items():
+            # only the new bars are sliced out, the decoded series is cached by write_artifact
+            series = read_series(path)
+            bars = self.new_bars(ticker, series)
+            if len(bars) == 0:
+                continue
+            new_bars[ticker] = len(bars)
+            self.last_bars[ticker] = (series.index[-1], float(series.iloc[-1]))
+            for key in agent_state['execution_result'].get(ticker, {}):
+                if metric_name(key) not in STREAMED_METRICS:
+                    continue
+                stats = self.rolling_stats(ticker, key.split('_', 1)[1], series)
+                for day, price in bars.items():
+                    stats.push(day, float(price))
+                updated.setdefault(ticker, {})[key] = stats.value(metric_name(key))
+
+        charts, status = [], []
+        if new_bars:
+            apply_update(agent_state, {'execution_result': updated}, reducers)
+            put_metrics({ticker: paths[ticker] for ticker in updated}, updated)
+            status.append(f'watch refresh: new bars {new_bars}, {sum(map(len, updated.values()))} metrics updated')
+            for step in plans:
+                if step['action'] in FETCH_ACTIONS or step['action'] in STREAMED_ACTIONS:
+                    continue
+                tickers = plan_tickers(step)
+                if any(ticker in new_bars for ticker in tickers):
+                    # charts and cross-asset metrics of the tickers with new bars
+                    apply_update(agent_state, recomputed(run_step(step, agent_state)), reducers)
+                    charts += [ticker for ticker in tickers if step['action'].startswith('plan_plot')]
+            apply_update(agent_state, collect_charts(self.run_id), reducers)
+        else:
+            status.append('watch refresh: no new bars')
+
+        moved = [f'{ticker} {key} {answered[ticker][key]:.4f} -> {value:.4f}'
+                 for ticker, values in updated.items() for key, value in values.items()
+                 if key in answered.get(ticker, {}) and abs(value - answered[ticker][key]) > self.threshold]
+        agent_state['watch'] = {'answered_result': answered, 'refreshes': watch.get('refreshes', 0) + 1,
+                                'refreshed_at': time.time()}
+        apply_update(agent_state, {'execution_status': status}, reducers)
+        if moved:
+            logger.info(f'{self.run_id}: {", ".join(moved)}, answering again')
+            agent_state = self.answer(agent_state, plans, moved)
+        else:
+            save_state(agent_state)
+        # the price store keeps the artifacts of watched runs
+        upsert_run(agent_state, 'watching')
+        self.watching = True
+        logger.info(f'{self.run_id}: {status[0]}')
+        return {'run_id': self.run_id, 'new_bars': new_bars, 'updated': updated, 'moved': moved,
+                'charts': charts, 'answered': bool(moved), 'final_answer': agent_state.get('final_answer')}
+
+    def close(self):
+        """
+        the run is no longer watched, its artifacts may be evicted from the price store again
+        """
+        if self.watching:
+            set_status(self.run_id, 'done')
+
+    def answer(self, agent_state: dict, plans: list, moved: list) -> dict:
+        """
+        run the answer and critic nodes again through the graph: the plan is done, so the router goes
+        straight to the answer
+        """
+        if self.graph_app is None:
+            from src.graph.graph import build_graph
+            self.graph_app = build_graph().compile()
+        for key in ['draft_answer', 'final_answer', 'critic_result', 'answer_stream']:
+            agent_state.pop(key, None)
+        agent_state['next_plan_index'] = len(plans)
+        agent_state['nsteps'] = 0
+        agent_state['execution_status'] = list(agent_state['execution_status']) + [
+            f'watch refresh: answered again, moved past {self.threshold}: {", ".join(moved)}']
+        agent_state['watch']['answered_result'] = streamed_values(agent_state['execution_result'])
+        return self.graph_app.invoke(agent_state)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='keep completed runs up to date as new bars arrive')
+    parser.add_argument('run_ids', nargs='+')
+    parser.add_argument('--every', type=float, default=WATCH_EVERY, help='seconds between refreshes')
+    parser.add_argument('--threshold', type=float, default=WATCH_THRESHOLD,
+                        help='metric change that answers again, 0.01 is one percentage point')
+    parser.add_argument('--once', action='store_true', help='refresh once and exit')
+    args = parser.parse_args()
+
+    watches = [Watch(run_id, args.threshold) for run_id in args.run_ids]
+    try:
+        while True:
+            for watch in watches:
+                print(json.dumps(watch.refresh(), default=str))
+            if args.once:
+                break
+            time.sleep(args.every)
+    finally:
+        for watch in watches:
+            watch.close()